@@ -0,0 +1,15 @@
+import os
+
+from dotenv import load_dotenv
+
+dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
+if os.path.exists(dotenv_path):
+    load_dotenv(dotenv_path)
+
+# 部署时在启动 worker 之前预先编译全部模板
+os.environ.setdefault('WATCHLIST_TEMPLATE_WARMUP', '1')
+
+from watchlist.asgi import create_asgi_app
+
+# 与 wsgi.py 相同的程序，由 ASGI 服务器运行，如 uvicorn asgi:app
+app = create_asgi_app()
@@ -0,0 +1,240 @@
+"""WSGI 与 ASGI 入口在高并发下的对比：/ 与 /guestbook 的延迟分位数和吞吐量
+
+两种入口运行同一个程序和同一个数据库：
+- wsgi: werkzeug 多线程服务器，每个连接一个线程
+- asgi: asgi.py 使用的 AsgiAdapter，安装了 uvicorn 时由 uvicorn 运行，
+  否则由本文件中只支持 Connection: close 的最小 asyncio HTTP 服务器运行
+
+客户端与服务器在同一进程中，并发数远大于 WATCHLIST_ASGI_WORKERS 时才能看出排队和 503 的差别。
+数据库填充方式与 bench_http.py 相同，结果以 JSON 输出。
+
+用法:
+    python benchmarks/bench_asgi.py --size 100k -n 2000 -c 64 --output asgi.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from werkzeug.serving import make_server  # noqa: E402
+
+from bench_http import parse_size, seed, run_route, server_requester, git_revision, peak_rss_kb  # noqa: E402
+from watchlist import create_app  # noqa: E402
+from watchlist.asgi import AsgiAdapter  # noqa: E402
+
+DEFAULT_ROUTES = ['GET /', 'GET /guestbook']
+
+
+async def _serve_connection(asgi_app, reader, writer):
+    """处理一个连接上的一个请求，响应后关闭连接"""
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        writer.close()
+        return
+    lines = head.decode('latin-1').split('\r\n')
+    method, target, version = lines[0].split(' ')
+    headers = []
+    length = 0
+    for line in lines[1:]:
+        if line:
+            name, value = line.split(':', 1)
+            headers.append((name.strip().lower().encode('latin-1'), value.strip().encode('latin-1')))
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+    body = await reader.readexactly(length) if length else b''
+    path, _, query = target.partition('?')
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': version.split('/')[1],
+        'method': method, 'scheme': 'http', 'path': path, 'raw_path': path.encode('latin-1'),
+        'query_string': query.encode('latin-1'), 'root_path': '', 'headers': headers,
+        'client': writer.get_extra_info('peername')[:2], 'server': writer.get_extra_info('sockname')[:2],
+    }
+    received = [False]
+
+    async def receive():
+        if not received[0]:
+            received[0] = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        # 请求体已读完，之后只会收到断开连接
+        await reader.read()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status = message['status']
+            writer.write(('HTTP/1.1 %d %s\r\n' % (status, 'OK' if status < 400 else 'Error')).encode('latin-1'))
+            for name, value in message['headers']:
+                if name != b'connection':
+                    writer.write(name + b': ' + value + b'\r\n')
+            writer.write(b'connection: close\r\n\r\n')
+        else:
+            writer.write(message.get('body', b''))
+            await writer.drain()
+
+    try:
+        await asgi_app(scope, receive, send)
+    finally:
+        writer.close()
+
+
+class MiniServer(object):
+    """在后台线程的事件循环中运行 ASGI 程序"""
+
+    def __init__(self, asgi_app):
+        self.asgi_app = asgi_app
+        self.loop = asyncio.new_event_loop()
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.server = None
+        self._ready = threading.Event()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+
+        async def start():
+            self.server = await asyncio.start_server(
+                lambda r, w: _serve_connection(self.asgi_app, r, w), sock=self.sock, backlog=1024)
+            self._ready.set()
+        self.loop.run_until_complete(start())
+        self.loop.run_forever()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        self._ready.wait()
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class UvicornServer(object):
+    def __init__(self, asgi_app):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.sock = sock
+        self.port = sock.getsockname()[1]
+        self.server = uvicorn.Server(uvicorn.Config(asgi_app, log_level='warning', lifespan='on',
+                                                    backlog=1024))
+
+    def start(self):
+        threading.Thread(target=self.server.run, kwargs={'sockets': [self.sock]}, daemon=True).start()
+        while not self.server.started:
+            time.sleep(0.01)
+
+    def shutdown(self):
+        self.server.should_exit = True
+
+
+class WerkzeugServer(object):
+    def __init__(self, app):
+        # 不输出每个请求的访问日志
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.port = self.server.server_port
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def shutdown(self):
+        self.server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', default='1k', help='rows per table: 1k, 100k, 1M or a number (default 1k)')
+    parser.add_argument('--db', help='SQLite file to seed and reuse (default: a file per size in the temp dir)')
+    parser.add_argument('-n', '--requests', type=int, default=1000, help='requests per route (default 1000)')
+    parser.add_argument('-c', '--concurrency', type=int, default=64, help='client threads (default 64)')
+    parser.add_argument('--warmup', type=int, default=10, help='untimed requests per route (default 10)')
+    parser.add_argument('--route', action='append', dest='routes', metavar='"METHOD PATH"',
+                        help='route to benchmark, repeatable (default: %s)' % ', '.join(DEFAULT_ROUTES))
+    parser.add_argument('--workers', type=int, help='ASGI worker threads (default WATCHLIST_ASGI_WORKERS)')
+    parser.add_argument('--max-pending', type=int,
+                        help='ASGI pending request limit (default WATCHLIST_ASGI_MAX_PENDING)')
+    parser.add_argument('--no-response-cache', action='store_true', help='disable the anonymous page cache')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    size = parse_size(args.size)
+    path = args.db or os.path.join(tempfile.gettempdir(), 'watchlist-bench-%d-1u.db' % size)
+    config = {
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.abspath(path),
+        'WATCHLIST_STAMP_DIR': tempfile.mkdtemp(),
+        'WATCHLIST_RATE_LIMIT': False,
+    }
+    if args.no_response_cache:
+        config['WATCHLIST_RESPONSE_CACHE'] = 'null'
+    app = create_app(config)
+    with app.app_context():
+        seed(size)
+
+    workers = args.workers or app.config['WATCHLIST_ASGI_WORKERS']
+    max_pending = args.max_pending or app.config['WATCHLIST_ASGI_MAX_PENDING']
+    asgi_app = AsgiAdapter(app, workers, max_pending, app.config['WATCHLIST_ASGI_STREAM_WORKERS'])
+    routes = args.routes or DEFAULT_ROUTES
+    results = {
+        'meta': {
+            'size': size,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'asgi_server': 'uvicorn' if uvicorn is not None else 'asyncio',
+            'asgi_workers': workers,
+            'asgi_max_pending': max_pending,
+            'response_cache': app.config['WATCHLIST_RESPONSE_CACHE'],
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'time': datetime.utcnow().isoformat(),
+        },
+        'results': {},
+    }
+
+    for mode in ('wsgi', 'asgi'):
+        if mode == 'wsgi':
+            server = WerkzeugServer(app)
+        else:
+            server = UvicornServer(asgi_app) if uvicorn is not None else MiniServer(asgi_app)
+        server.start()
+        try:
+            for route in routes:
+                result = run_route(server_requester(server.port), route, args.requests, args.concurrency, args.warmup)
+                results['results'].setdefault(mode, {})[route] = result
+                print('%-5s %-16s p50 %7.2f  p95 %7.2f  p99 %7.2f ms  %8.1f req/s  %d errors' % (
+                    mode, route, result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                    result['throughput_rps'], result['errors']), file=sys.stderr)
+        finally:
+            server.shutdown()
+    results['meta']['asgi_rejected'] = asgi_app.rejected
+    results['meta']['peak_rss_kb'] = peak_rss_kb()
+    asgi_app.shutdown()
+
+    output = json.dumps(results, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
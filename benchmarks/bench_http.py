@@ -0,0 +1,313 @@
+"""HTTP 端点压测：/、/guestbook 与 /login 的延迟分位数、吞吐量和内存峰值
+
+不需要网络：请求通过 app.test_client() 直接调用程序，或发往本进程内在 127.0.0.1
+上启动的 WSGI 服务器 (werkzeug)，多个客户端线程并发请求。
+
+数据库按 --size 填充电影和留言 (1k / 100k / 1M 或任意整数)，电影平均分给 --users 个用户，
+填充好的数据库文件会被复用。保持每个用户的电影数不变而增加用户数，/ 的延迟应当基本不变。
+结果以 JSON 输出，可以用 --baseline 与之前保存的结果比较，p95 或吞吐量变差超过
+--threshold 时以状态码 1 退出。
+
+用法:
+    python benchmarks/bench_http.py --size 100k -n 2000 -c 8 --output result.json
+    python benchmarks/bench_http.py --size 100k -n 2000 -c 8 --baseline result.json
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from werkzeug.serving import make_server  # noqa: E402
+
+from watchlist import create_app, db  # noqa: E402
+from watchlist.models import User, Movie, Message  # noqa: E402
+
+SIZES = {'1k': 1000, '100k': 100000, '1M': 1000000}
+DEFAULT_ROUTES = ['GET /', 'GET /guestbook', 'GET /login', 'POST /login']
+USERNAME = 'admin'
+PASSWORD = 'benchmark'
+SEED_BATCH = 10000
+
+
+def parse_size(value):
+    if value in SIZES:
+        return SIZES[value]
+    return int(value)
+
+
+def seed(size, users=1):
+    """通过模型的表对象分批插入数据，数据量已经满足时跳过
+
+    第一个用户为压测登录使用的站点所有者，其余用户只有用户名。
+    """
+    db.create_all()
+    if User.query.filter_by(username=USERNAME).first() is None:
+        user = User(name='Benchmark', username=USERNAME)
+        user.set_password(PASSWORD)
+        db.session.add(user)
+        db.session.commit()
+    existing = User.query.count()
+    if existing < users:
+        db.session.execute(User.__table__.insert(), [{'name': 'user%d' % i, 'username': 'user%d' % i}
+                                                     for i in range(existing, users)])
+        db.session.commit()
+    user_ids = [id for id, in db.session.query(User.id).order_by(User.id).limit(users)]
+
+    rng = random.Random(size)
+    now = datetime.utcnow()
+    for model, make_row in (
+        (Movie, lambda i: {'title': '电影%d' % i, 'year': str(rng.randint(1920, 2020)),
+                           'user_id': user_ids[i % len(user_ids)]}),
+        (Message, lambda i: {'name': '访客%d' % (i % 1000), 'body': '第 %d 条留言' % i,
+                             'timestamp': now - timedelta(seconds=size - i)}),
+    ):
+        existing = model.query.count()
+        start = time.perf_counter()
+        for offset in range(existing, size, SEED_BATCH):
+            rows = [make_row(i) for i in range(offset, min(offset + SEED_BATCH, size))]
+            db.session.execute(model.__table__.insert(), rows)
+            db.session.commit()
+        if existing < size:
+            print('Seeded %d %s rows in %.1fs.' % (size - existing, model.__tablename__,
+                                                   time.perf_counter() - start), file=sys.stderr)
+
+
+def peak_rss_kb():
+    """整个进程的内存峰值 (只增不减，包括填充数据库和之前的路由)，每次运行只记录一次"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 以字节为单位，Linux 以 KiB 为单位
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def percentile(sorted_values, p):
+    """最近秩 (nearest-rank) 分位数"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def split_route(route):
+    method, path = route.split(' ', 1)
+    body = urlencode({'username': USERNAME, 'password': PASSWORD}) if method == 'POST' else None
+    return method, path, body
+
+
+def test_client_requester(app):
+    def make():
+        client = app.test_client()
+
+        def request(method, path, body):
+            response = client.open(path, method=method, data=body,
+                                   content_type='application/x-www-form-urlencoded' if body else None)
+            response.close()
+            return response.status_code
+        return request
+    return make
+
+
+def server_requester(port):
+    def make():
+        def request(method, path, body):
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            try:
+                headers = {'Content-Type': 'application/x-www-form-urlencoded'} if body else {}
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                return response.status
+            finally:
+                connection.close()
+        return request
+    return make
+
+
+def run_route(make_requester, route, requests, concurrency, warmup):
+    """concurrency 个线程共同发送 requests 个请求，返回统计结果"""
+    method, path, body = split_route(route)
+    warm = make_requester()
+    for _ in range(warmup):
+        warm(method, path, body)
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counts = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+
+    def worker(count):
+        request = make_requester()
+        local = []
+        failed = 0
+        for _ in range(count):
+            start = time.perf_counter()
+            try:
+                status = request(method, path, body)
+            except Exception:
+                status = None
+            local.append(time.perf_counter() - start)
+            if status is None or status >= 400:
+                failed += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker, args=(count,)) for count in counts if count]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    ms = 1000.0
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'p50_ms': percentile(latencies, 50) * ms,
+        'p95_ms': percentile(latencies, 95) * ms,
+        'p99_ms': percentile(latencies, 99) * ms,
+        'mean_ms': sum(latencies) / len(latencies) * ms,
+        'throughput_rps': len(latencies) / elapsed,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """打印与基准结果的差异，返回变差超过 threshold% 的项"""
+    regressions = []
+    for mode, routes in results['results'].items():
+        for route, current in routes.items():
+            previous = baseline.get('results', {}).get(mode, {}).get(route)
+            if previous is None:
+                continue
+            p95 = (current['p95_ms'] / previous['p95_ms'] - 1) * 100
+            rps = (current['throughput_rps'] / previous['throughput_rps'] - 1) * 100
+            print('%-11s %-16s p95 %+6.1f%%   throughput %+6.1f%%' % (mode, route, p95, rps), file=sys.stderr)
+            if p95 > threshold or -rps > threshold:
+                regressions.append((mode, route))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', default='1k', help='rows per table: 1k, 100k, 1M or a number (default 1k)')
+    parser.add_argument('--users', type=int, default=1, help='users sharing the movies (default 1)')
+    parser.add_argument('--db', help='SQLite file to seed and reuse (default: a file per size in the temp dir)')
+    parser.add_argument('-n', '--requests', type=int, default=500, help='requests per route (default 500)')
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help='client threads (default 4)')
+    parser.add_argument('--warmup', type=int, default=10, help='untimed requests per route (default 10)')
+    parser.add_argument('--route', action='append', dest='routes', metavar='"METHOD PATH"',
+                        help='route to benchmark, repeatable (default: %s)' % ', '.join(DEFAULT_ROUTES))
+    parser.add_argument('--mode', choices=['test_client', 'server', 'both'], default='both')
+    parser.add_argument('--no-response-cache', action='store_true', help='disable the anonymous page cache')
+    parser.add_argument('--rate-limit', action='store_true',
+                        help='keep the rate limiter on (all requests come from one IP)')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='allowed p95/throughput regression in percent (default 10)')
+    args = parser.parse_args()
+
+    size = parse_size(args.size)
+    path = args.db or os.path.join(tempfile.gettempdir(), 'watchlist-bench-%d-%du.db' % (size, args.users))
+    stamp_dir = tempfile.mkdtemp()
+    config = {
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.abspath(path),
+        'WATCHLIST_STAMP_DIR': stamp_dir,
+    }
+    if not args.rate_limit:
+        config['WATCHLIST_RATE_LIMIT'] = False
+    if args.no_response_cache:
+        config['WATCHLIST_RESPONSE_CACHE'] = 'null'
+    app = create_app(config)
+    with app.app_context():
+        seed(size, args.users)
+
+    modes = ['test_client', 'server'] if args.mode == 'both' else [args.mode]
+    routes = args.routes or DEFAULT_ROUTES
+    results = {
+        'meta': {
+            'size': size,
+            'users': args.users,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'response_cache': app.config['WATCHLIST_RESPONSE_CACHE'],
+            'rate_limit': app.config['WATCHLIST_RATE_LIMIT'],
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'time': datetime.utcnow().isoformat(),
+        },
+        'results': {},
+    }
+
+    for mode in modes:
+        server = None
+        if mode == 'server':
+            # 不输出每个请求的访问日志
+            logging.getLogger('werkzeug').setLevel(logging.ERROR)
+            server = make_server('127.0.0.1', 0, app, threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            make_requester = server_requester(server.server_port)
+        else:
+            make_requester = test_client_requester(app)
+        try:
+            for route in routes:
+                result = run_route(make_requester, route, args.requests, args.concurrency, args.warmup)
+                results['results'].setdefault(mode, {})[route] = result
+                print('%-11s %-16s p50 %7.2f  p95 %7.2f  p99 %7.2f ms  %8.1f req/s  %d errors' % (
+                    mode, route, result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                    result['throughput_rps'], result['errors']), file=sys.stderr)
+        finally:
+            if server is not None:
+                server.shutdown()
+    results['meta']['peak_rss_kb'] = peak_rss_kb()
+
+    output = json.dumps(results, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('Regressed: %s' % ', '.join('%s %s' % r for r in regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""测量启动耗时，并与预算比较，超出预算时以状态码 1 退出
+
+每一项都在新的 Python 进程中执行，取多次运行的中位数：
+
+- import:     import watchlist (只加载 Flask 与扩展)
+- create_app: 创建程序实例 (导入视图、注册蓝本)
+- cli:        flask --help (列出命令，不导入 watchlist.commands)
+
+用法: python benchmarks/bench_startup.py [-n 5] [--top 10]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 各项的预算 (毫秒)，可以通过命令行参数调整
+BUDGETS = {
+    'import': 800,
+    'create_app': 150,
+    'cli': 1200,
+}
+
+MEASURE = '''
+import time
+start = time.perf_counter()
+import watchlist
+imported = time.perf_counter()
+watchlist.create_app()
+print((imported - start) * 1000, (time.perf_counter() - imported) * 1000)
+'''
+
+CLI = '''
+import subprocess, sys, time
+start = time.perf_counter()
+subprocess.run([sys.executable, '-m', 'flask', '--help'], check=True, stdout=subprocess.DEVNULL)
+print((time.perf_counter() - start) * 1000)
+'''
+
+
+def run(code, *args):
+    env = dict(os.environ, FLASK_APP='watchlist')
+    output = subprocess.run([sys.executable] + list(args) + ['-c', code], cwd=ROOT, env=env, check=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    return output
+
+
+def slowest_imports(top):
+    """python -X importtime 中累计耗时最长的模块"""
+    lines = run('import watchlist', '-X', 'importtime').stderr.splitlines()
+    rows = []
+    for line in lines[1:]:
+        _, self_us, cumulative_us, name = [part.strip() for part in line.replace(':', '|', 1).split('|')]
+        rows.append((int(cumulative_us), name))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=5, help='runs per measurement')
+    parser.add_argument('--top', type=int, default=0, help='show the N slowest imports')
+    for name, budget in BUDGETS.items():
+        parser.add_argument('--%s-budget' % name.replace('_', '-'), type=float, default=budget,
+                            help='budget in ms (default %d)' % budget)
+    args = parser.parse_args()
+
+    timings = {name: [] for name in BUDGETS}
+    for _ in range(args.n):
+        import_ms, create_ms = map(float, run(MEASURE).stdout.split())
+        timings['import'].append(import_ms)
+        timings['create_app'].append(create_ms)
+        timings['cli'].append(float(run(CLI).stdout))
+
+    over = False
+    for name, values in timings.items():
+        median = statistics.median(values)
+        budget = getattr(args, '%s_budget' % name)
+        over = over or median > budget
+        print('%-11s median %7.1f ms   budget %7.1f ms   %s' % (
+            name, median, budget, 'OK' if median <= budget else 'OVER BUDGET'))
+
+    for cumulative_us, name in slowest_imports(args.top) if args.top else ():
+        print('%8.1f ms  %s' % (cumulative_us / 1000, name))
+    sys.exit(1 if over else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""对比首页在三种情况下的请求耗时：
+
+- cold:     每次请求都重新创建 Jinja Environment，模板需要重新解析编译 (新 worker 的第一个请求)
+- bytecode: 同样重新创建 Environment，但从字节码缓存读取编译结果 (配置 WATCHLIST_TEMPLATE_CACHE_DIR)
+- warm:     模板已经加载 (启动时预编译，或之后的请求)
+
+用法: python benchmarks/bench_templates.py [-n 200]
+"""
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jinja2 import FileSystemBytecodeCache  # noqa: E402
+
+from watchlist import create_app, db  # noqa: E402
+from watchlist.commands import forge  # noqa: E402
+from watchlist.templating import warm_up  # noqa: E402
+
+
+app = None
+
+
+def reset_jinja_env(bytecode_cache=None):
+    # jinja_env 是缓存属性，删除后下一次访问会重新创建
+    app.__dict__.pop('jinja_env', None)
+    app.jinja_env.bytecode_cache = bytecode_cache
+
+
+def measure(client, n, before=None):
+    timings = []
+    for _ in range(n):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        response = client.get('/')
+        timings.append(time.perf_counter() - start)
+        assert response.status_code == 200
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    print('%-9s median %7.2f ms   p95 %7.2f ms   mean %7.2f ms' % (
+        name,
+        statistics.median(timings) * 1000,
+        timings[int(len(timings) * 0.95) - 1] * 1000,
+        statistics.mean(timings) * 1000,
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=200, help='requests per scenario')
+    args = parser.parse_args()
+
+    global app
+    cache_dir = tempfile.mkdtemp()
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+        'WATCHLIST_STAMP_DIR': os.path.join(cache_dir, 'stamps'),
+        'WATCHLIST_RESPONSE_CACHE': 'null',
+    })
+    try:
+        with app.app_context():
+            db.create_all()
+            app.test_cli_runner().invoke(forge)
+        client = app.test_client()
+
+        report('cold', measure(client, args.n, reset_jinja_env))
+
+        bytecode_cache = FileSystemBytecodeCache(os.path.join(cache_dir, 'templates'))
+        os.makedirs(bytecode_cache.directory)
+        reset_jinja_env(bytecode_cache)
+        warm_up(app.jinja_env)
+        report('bytecode', measure(client, args.n, lambda: reset_jinja_env(bytecode_cache)))
+
+        reset_jinja_env()
+        warm_up(app.jinja_env)
+        report('warm', measure(client, args.n))
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    main()
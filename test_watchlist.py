@@ -1,25 +1,52 @@
+import csv
+import gzip
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
+from datetime import datetime
 
-from watchlist import app, db
-from watchlist.models import User, Movie
+from flask import request
+from werkzeug.security import generate_password_hash
+
+from watchlist import create_app, db
+from watchlist.models import User, Movie, Message, ArchivedMessage
 from watchlist.commands import forge, initdb
+from watchlist.cache import stamps, owner_cache, user_cache, response_cache
+from watchlist.writebehind import message_writer
+from watchlist.live import hub, Subscriber
+from watchlist.asgi import AsgiAdapter, create_asgi_app
+from watchlist.metrics import metrics
+from watchlist.ratelimit import BucketStore
+from watchlist.passwords import PasswordQueueFull, PasswordVerifier
 
 
 class Watchlist_TestCase(unittest.TestCase):
 
     def setUp(self):
         # 更新配置
-        app.config.update(
-            TESTING=True,
-            SQLALCHEMY_DATABASE_URI='sqlite:///:memory:'
-        )
+        self.stamp_dir = tempfile.mkdtemp()
+        # 每个测试使用独立的程序实例和内存数据库
+        self.app = create_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+            'WATCHLIST_STAMP_DIR': self.stamp_dir,
+        })
+        self.context = self.app.app_context()
+        self.context.push()
 
         # 创建数据库和表
         db.create_all()
         # 创建测试数据，一个用户和一个电影条目
         user = User(name='Test', username='test')
         user.set_password('123')
-        movie = Movie(title='千钧一发', year='1997')
+        movie = Movie(title='千钧一发', year='1997', user=user)
 
         # 使用 add_all() 方法一次添加多个模型类实例，传入列表
         db.session.add_all([user, movie])
@@ -27,21 +54,23 @@ class Watchlist_TestCase(unittest.TestCase):
 
         # 创建 测试客户端：模拟客户端请求
         # 创建 测试命令运行器：触发自定义命令
-        self.client = app.test_client()
-        self.runner = app.test_cli_runner()
+        self.client = self.app.test_client()
+        self.runner = self.app.test_cli_runner()
 
     def tearDown(self):
         # 删除 数据库会话 和 数据库表
         db.session.remove()
         db.drop_all()
+        self.context.pop()
+        shutil.rmtree(self.stamp_dir)
 
     def test_app_exist(self):
         """测试程序实例是否存在"""
-        self.assertIsNotNone(app)
+        self.assertIsNotNone(self.app)
 
     def test_app_is_testing(self):
         """测试程序是否处于测试模式"""
-        self.assertTrue(app.config['TESTING'])
+        self.assertTrue(self.app.config['TESTING'])
 
     def test_404_page(self):
         """测试 404 页面"""
@@ -61,6 +90,49 @@ class Watchlist_TestCase(unittest.TestCase):
         self.assertIn('千钧一发', data)
         self.assertEqual(response.status_code, 200)
 
+    def test_index_pagination(self):
+        """测试主页分页、排序与年份筛选"""
+        db.session.add_all([Movie(title='电影%d' % i, year=str(2000 + i), user_id=1) for i in range(1, 6)])
+        db.session.commit()
+
+        response = self.client.get('/?limit=2')
+        data = response.get_data(as_text=True)
+        self.assertIn('6 条清单', data)
+        self.assertIn('千钧一发', data)
+        self.assertIn('电影1', data)
+        self.assertNotIn('电影2', data)
+        self.assertIn('1 / 3', data)
+
+        response = self.client.get('/?limit=2&page=2&sort=year&order=desc')
+        data = response.get_data(as_text=True)
+        self.assertIn('电影3', data)
+        self.assertIn('电影2', data)
+        self.assertNotIn('电影5', data)
+
+        response = self.client.get('/?year_from=2002&year_to=2003&sort=title')
+        data = response.get_data(as_text=True)
+        self.assertIn('2 条清单', data)
+        self.assertIn('电影2', data)
+        self.assertIn('电影3', data)
+        self.assertNotIn('千钧一发', data)
+
+        # 不足 4 位的年份按数值比较
+        response = self.client.get('/?year_from=999&year_to=2001')
+        data = response.get_data(as_text=True)
+        self.assertIn('2 条清单', data)
+        self.assertIn('千钧一发', data)
+
+        # 分页链接只保留已知的查询参数
+        response = self.client.get('/?limit=2&_scheme=x&_anchor=y&extra=1')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_data(as_text=True)
+        self.assertIn('/?page=2&amp;limit=2', data)
+        self.assertNotIn('extra=', data)
+
+        self.assertEqual(self.client.get('/?page=9').status_code, 404)
+        self.assertEqual(self.client.get('/?sort=password').status_code, 400)
+        self.assertEqual(self.client.get('/?year_from=abc').status_code, 400)
+
     def login(self):
         """辅助方法，用于登录用户"""
         self.client.post('/login', data=dict(
@@ -155,6 +227,41 @@ class Watchlist_TestCase(unittest.TestCase):
         self.assertIn('该条清单已删除', data)
         self.assertNotIn('千钧一发3', data)
 
+    def test_batch_items(self):
+        """测试批量修改、删除条目"""
+        db.session.add_all([Movie(title='电影%d' % i, year='2000', user_id=1) for i in range(2, 5)])
+        db.session.commit()
+        self.login()
+
+        response = self.client.post('/movie/batch', json={
+            'update': [{'id': 1, 'title': '千钧一发4', 'year': '1998'}, {'id': 9, 'title': '不存在', 'year': '2000'}],
+            'delete': [2, 3],
+        })
+        data = response.get_json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['updated'], 1)
+        self.assertEqual(data['deleted'], 2)
+        self.assertIn({'id': 9, 'action': 'update', 'status': 'not_found'}, data['results'])
+        self.assertEqual(Movie.query.get(1).title, '千钧一发4')
+        self.assertEqual(Movie.query.count(), 2)
+
+        # 有任何无效条目时不做任何改动
+        response = self.client.post('/movie/batch', json={
+            'update': [{'id': 1, 'title': '千钧一发5', 'year': '19980'}],
+            'delete': [4],
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertIn({'id': 1, 'action': 'update', 'status': 'invalid'}, response.get_json()['results'])
+        self.assertEqual(Movie.query.count(), 2)
+
+        # 表单提交
+        response = self.client.post('/movie/batch', data={'delete': ['4'], 'title-1': '千钧一发6', 'year-1': '1999'},
+                                    follow_redirects=True)
+        data = response.get_data(as_text=True)
+        self.assertIn('已更新 1 条、删除 1 条清单', data)
+        self.assertIn('千钧一发6', data)
+        self.assertNotIn('电影4', data)
+
     def test_login_protect(self):
         """测试登录保护"""
         response = self.client.get('/')
@@ -220,6 +327,47 @@ class Watchlist_TestCase(unittest.TestCase):
         self.assertNotIn('登录成功', data)
         self.assertIn('输入的数据不能为空', data)
 
+    def test_password_rehash(self):
+        """测试登录成功时按当前配置重新生成旧的密码哈希"""
+        user = User.query.first()
+        user.password_hash = generate_password_hash('123', 'pbkdf2:sha256:1000')
+        db.session.commit()
+
+        self.client.post('/login', data=dict(username='test', password='456'))
+        self.assertTrue(User.query.first().password_hash.startswith('pbkdf2:sha256:1000$'))
+        response = self.client.post('/login', data=dict(username='test', password='123'), follow_redirects=True)
+        self.assertIn('登录成功', response.get_data(as_text=True))
+        self.assertTrue(User.query.first().password_hash.startswith('pbkdf2:sha256:150000$'))
+
+        # 切换到 scrypt
+        self.client.get('/logout')
+        self.app.config.update(WATCHLIST_PASSWORD_HASH='scrypt', WATCHLIST_SCRYPT_PARAMS=(1024, 8, 1))
+        self.client.post('/login', data=dict(username='test', password='123'))
+        self.assertTrue(User.query.first().password_hash.startswith('scrypt:1024:8:1$'))
+        self.client.get('/logout')
+        response = self.client.post('/login', data=dict(username='test', password='123'), follow_redirects=True)
+        self.assertIn('登录成功', response.get_data(as_text=True))
+        self.assertFalse(User.query.first().validate_password('456'))
+
+    def test_password_queue_limit(self):
+        """测试密码校验线程池的排队上限"""
+        verifier = PasswordVerifier()
+        self.addCleanup(verifier.stop)
+        verifier.start(max_workers=1, queue_size=1)
+        release = threading.Event()
+        first = verifier.submit(release.wait)
+        second = verifier.submit(release.wait)
+        with self.assertRaises(PasswordQueueFull):
+            verifier.submit(release.wait)
+        self.assertEqual(verifier.rejected, 1)
+
+        release.set()
+        first.result()
+        second.result()
+        self.assertTrue(verifier.verify(User.query.first().password_hash, '123'))
+        # 重新生成哈希也在线程池中计算
+        self.assertTrue(verifier.verify(verifier.hash('789'), '789'))
+
     def test_logout(self):
         """测试登出"""
         self.login()
@@ -262,6 +410,146 @@ class Watchlist_TestCase(unittest.TestCase):
         self.assertNotIn('用户名更改成功', data)
         self.assertIn('无效的输入', data)
 
+    def test_owner_cache(self):
+        """测试站点所有者缓存"""
+        response = self.client.get('/')
+        self.assertIn('Test 的观影清单', response.get_data(as_text=True))
+
+        # 绕过应用直接修改数据库，版本戳未变化时仍使用缓存
+        User.query.first().name = 'Other'
+        db.session.commit()
+        response = self.client.get('/')
+        self.assertIn('Test 的观影清单', response.get_data(as_text=True))
+
+        # 版本戳变化后重新加载
+        with self.app.app_context():
+            owner_cache.invalidate()
+        response = self.client.get('/')
+        self.assertIn('Other 的观影清单', response.get_data(as_text=True))
+
+    def test_user_cache(self):
+        """测试已登录用户缓存"""
+        self.login()
+        self.client.get('/')
+        self.client.get('/settings')
+        stats = user_cache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertGreaterEqual(stats['hits'], 2)
+        self.assertGreater(stats['hit_rate'], 0.5)
+
+        # 通过缓存加载的 current_user 仍然可以修改并提交
+        response = self.client.post('/settings', data=dict(name='Cached'), follow_redirects=True)
+        self.assertIn('Cached 的观影清单', response.get_data(as_text=True))
+        self.assertEqual(User.query.first().name, 'Cached')
+
+        # 登出后移除缓存条目
+        self.client.get('/logout')
+        self.assertEqual(user_cache.stats()['size'], 0)
+
+    def test_response_cache(self):
+        """测试匿名页面缓存"""
+        self.client.get('/')
+        self.client.get('/')
+        self.assertEqual(response_cache.stats()['hits'], 1)
+
+        # 绕过应用写入数据库时，版本戳未变化，仍返回缓存页面
+        db.session.add(Movie(title='缓存测试', year='2020', user_id=1))
+        db.session.commit()
+        response = self.client.get('/')
+        self.assertNotIn('缓存测试', response.get_data(as_text=True))
+
+        # 经由写操作路由修改数据后缓存失效
+        self.login()
+        self.client.post('/', data=dict(title='新条目', year='2021'))
+        self.client.get('/logout')
+        response = self.client.get('/')
+        data = response.get_data(as_text=True)
+        self.assertIn('缓存测试', data)
+        self.assertIn('新条目', data)
+
+        # 已登录用户不使用缓存
+        self.login()
+        hits = response_cache.stats()['hits']
+        self.client.get('/')
+        self.assertEqual(response_cache.stats()['hits'], hits)
+
+    def test_response_cache_file_backend(self):
+        """测试文件后端的匿名页面缓存"""
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.addCleanup(response_cache.clear)
+        self.app.config.update(WATCHLIST_RESPONSE_CACHE='file', WATCHLIST_RESPONSE_CACHE_DIR=cache_dir)
+        response_cache.clear()
+
+        self.client.get('/guestbook')
+        response = self.client.get('/guestbook')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('想说的话', response.get_data(as_text=True))
+        self.assertEqual(response_cache.stats()['hits'], 1)
+
+        self.client.post('/guestbook', data=dict(name='访客', body='文件缓存'))
+        response = self.client.get('/guestbook')
+        self.assertIn('文件缓存', response.get_data(as_text=True))
+
+        # 视图不读取的查询参数不产生新的条目，条目数超过上限时删除最早的文件
+        for i in range(5):
+            self.client.get('/guestbook?x=%d' % i)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        response_cache.backend.maxsize = 3
+        for i in range(5):
+            self.client.get('/?limit=%d' % (i + 1))
+        self.assertEqual(len(os.listdir(cache_dir)), 3)
+
+    def test_conditional_get(self):
+        """测试 ETag / Last-Modified 条件请求"""
+        response = self.client.get('/')
+        etag = response.headers['ETag']
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.get_data(), b'')
+
+        # 不同的查询参数对应不同的 ETag
+        response = self.client.get('/?sort=title', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+        # 留言不影响主页的 ETag
+        self.client.post('/guestbook', data=dict(name='访客', body='留言'), follow_redirects=True)
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        # 写操作之后 ETag 改变，写入所在的一秒过去之后带有 Last-Modified
+        self.login()
+        self.client.post('/', data=dict(title='新条目', year='2021'))
+        self.client.get('/logout', follow_redirects=True)
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        stamp = os.path.join(self.app.config['WATCHLIST_STAMP_DIR'], 'movie-1.stamp')
+        written = os.stat(stamp).st_mtime_ns - 2 * 10 ** 9
+        os.utime(stamp, ns=(written, written))
+        last_modified = self.client.get('/').headers['Last-Modified']
+
+        response = self.client.get('/', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+
+        # 刚刚写入时不发送 Last-Modified，同一秒内的下一次写入不会被只精确到秒的日期掩盖
+        self.login()
+        self.client.post('/', data=dict(title='又一个新条目', year='2022'))
+        self.client.get('/logout', follow_redirects=True)
+        response = self.client.get('/', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Last-Modified', response.headers)
+
+        # initdb 命令同样会让 ETag 失效
+        etag = response.headers['ETag']
+        self.runner.invoke(initdb)
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
     def test_guestbook(self):
         """测试留言板"""
         response = self.client.get('/guestbook')
@@ -303,17 +591,877 @@ class Watchlist_TestCase(unittest.TestCase):
         self.assertNotIn('您的消息已发送给全世界', data)
         self.assertNotIn('测试2号', data)
 
+    def test_relative_time(self):
+        """测试服务器生成的相对时间"""
+        from datetime import timedelta
+        from watchlist.timeago import from_now
+        now = datetime(2020, 8, 1, 12)
+        for seconds, text in [(10, '几秒前'), (45, '1 分钟前'), (90, '2 分钟前'), (2700, '1 小时前'),
+                              (5400, '2 小时前'), (79200, '1 天前'), (129600, '2 天前'), (2246400, '1 个月前'),
+                              (28000000, '1 年前'), (48000000, '2 年前'), (-30, '几秒内')]:
+            self.assertEqual(from_now(now - timedelta(seconds=seconds), now), text)
+
+        db.session.add(Message(name='访客', body='你好', timestamp=datetime.utcnow() - timedelta(minutes=3)))
+        db.session.commit()
+        data = self.client.get('/guestbook').get_data(as_text=True)
+        self.assertRegex(data, r'<time class="relative-time" datetime="[0-9T:-]+Z">3 分钟前</time>')
+        self.assertIn('relative-time.js', data)
+        self.assertNotIn('moment', data)
+
+        # 退回到 Flask-Moment，没有构建静态文件时加载完整的 Moment
+        self.app.config['WATCHLIST_RELATIVE_TIME'] = 'moment'
+        response_cache.clear()
+        data = self.client.get('/guestbook').get_data(as_text=True)
+        self.assertIn('/static/moment-with-locales.min.js', data)
+        self.assertIn('flask-moment', data)
+        self.assertNotIn('relative-time', data)
+
+    def test_guestbook_pagination(self):
+        """测试留言板游标分页"""
+        self.app.config['WATCHLIST_MESSAGE_PER_PAGE'] = 2
+
+        # 前两条留言时间戳相同，由 id 区分先后
+        timestamps = [datetime(2020, 8, 1), datetime(2020, 8, 1), datetime(2020, 8, 2),
+                      datetime(2020, 8, 3), datetime(2020, 8, 4)]
+        db.session.add_all([Message(name='访客', body='留言%d' % i, timestamp=t)
+                            for i, t in enumerate(timestamps, 1)])
+        db.session.commit()
+
+        response = self.client.get('/guestbook')
+        data = response.get_data(as_text=True)
+        self.assertIn('5 条留言', data)
+        self.assertIn('留言5', data)
+        self.assertIn('#5', data)
+        self.assertNotIn('留言3', data)
+        self.assertIn('/guestbook?before=20200803000000000000_4&amp;start=3', data)
+
+        # 按 "加载更多" 链接翻页，编号保持连续
+        response = self.client.get('/guestbook?before=20200803000000000000_4&start=3')
+        data = response.get_data(as_text=True)
+        self.assertIn('留言3', data)
+        self.assertIn('#3', data)
+        self.assertIn('留言2', data)
+        self.assertNotIn('留言4', data)
+        self.assertIn('回到最新', data)
+
+        # 未携带 start 时按游标统计编号
+        response = self.client.get('/guestbook?before=20200801000000000000_2')
+        data = response.get_data(as_text=True)
+        self.assertIn('留言1', data)
+        self.assertIn('#1', data)
+        self.assertNotIn('留言2', data)
+        self.assertNotIn('加载更多', data)
+
+        # 无效游标
+        response = self.client.get('/guestbook?before=abc')
+        self.assertEqual(response.status_code, 400)
+
+    def test_guestbook_write_behind(self):
+        """测试留言异步批量写入"""
+        self.addCleanup(message_writer.stop)
+        self.app.config.update(
+            WATCHLIST_WRITE_BEHIND=True,
+            WATCHLIST_WRITE_BEHIND_QUEUE_SIZE=2,
+            WATCHLIST_WRITE_BEHIND_INTERVAL=60
+        )
+
+        for i in range(2):
+            response = self.client.post('/guestbook', data=dict(name='访客', body='排队%d' % i))
+            self.assertEqual(response.status_code, 302)
+        self.assertEqual(Message.query.count(), 0)
+        self.assertEqual(message_writer.stats()['queue_length'], 2)
+
+        # 队列已满
+        response = self.client.post('/guestbook', data=dict(name='访客', body='排队2'))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertIn('Service Unavailable - 503', response.get_data(as_text=True))
+
+        with self.app.app_context():
+            self.assertEqual(message_writer.flush(), 2)
+        stats = message_writer.stats()
+        self.assertEqual(stats['queue_length'], 0)
+        self.assertEqual(stats['flushes'], 1)
+        self.assertEqual(stats['rejected'], 1)
+
+        response = self.client.get('/guestbook')
+        data = response.get_data(as_text=True)
+        self.assertIn('排队0', data)
+        self.assertIn('排队1', data)
+
+        # 停止时写入剩余留言
+        self.client.post('/guestbook', data=dict(name='访客', body='排队3'))
+        message_writer.stop()
+        self.assertEqual(Message.query.count(), 3)
+
+    def test_multiple_apps(self):
+        """测试同一进程中的多个程序实例各自使用自己的缓存、异步写入队列和数据库"""
+        other = create_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+            'WATCHLIST_STAMP_DIR': tempfile.mkdtemp(),
+            'WATCHLIST_WRITE_BEHIND': True,
+            'WATCHLIST_RESPONSE_CACHE': 'null',
+        })
+        self.addCleanup(shutil.rmtree, other.config['WATCHLIST_STAMP_DIR'])
+        self.app.config['WATCHLIST_WRITE_BEHIND'] = True
+        # 与部署时相同，每个请求推送自己程序实例的上下文
+        # (Flask-SQLAlchemy 的会话按线程区分，不能在一个程序实例的上下文中处理另一个实例的请求)
+        db.session.remove()
+        self.context.pop()
+        try:
+            with other.app_context():
+                db.create_all()
+
+            self.assertIn('Test 的观影清单', self.client.get('/').get_data(as_text=True))
+            self.assertIn('0 条清单', other.test_client().get('/').get_data(as_text=True))
+            self.client.post('/guestbook', data=dict(name='访客', body='第一个程序'))
+            other.test_client().post('/guestbook', data=dict(name='访客', body='第二个程序'))
+
+            for app, body, cached in ((self.app, '第一个程序', True), (other, '第二个程序', False)):
+                with app.app_context():
+                    message_writer.stop()
+                    self.assertEqual([m.body for m in Message.query], [body])
+                    self.assertEqual(response_cache.backend is not None, cached)
+        finally:
+            self.context.push()
+
+    def test_write_behind_retry(self):
+        """测试异步写入失败时重试，超过次数后才丢弃"""
+        self.addCleanup(message_writer.stop)
+        self.app.config.update(
+            WATCHLIST_WRITE_BEHIND=True,
+            WATCHLIST_WRITE_BEHIND_INTERVAL=60,
+            WATCHLIST_WRITE_BEHIND_MAX_ATTEMPTS=2
+        )
+        self.client.post('/guestbook', data=dict(name='访客', body='重试'))
+
+        # 暂时无法写入：留言保留在队列中，退避期间不重试
+        db.session.execute('ALTER TABLE message RENAME TO message_old')
+        db.session.commit()
+        with self.assertRaises(Exception):
+            message_writer.flush()
+        self.assertEqual(message_writer.flush(), 0)
+        self.assertEqual(message_writer.stats()['queue_length'], 1)
+        db.session.execute('ALTER TABLE message_old RENAME TO message')
+        db.session.commit()
+        self.assertEqual(message_writer.flush(force=True), 1)
+        self.assertEqual(Message.query.one().body, '重试')
+
+        # 连续失败达到次数上限后丢弃，并计入统计
+        self.client.post('/guestbook', data=dict(name='访客', body='丢弃'))
+        db.session.execute('ALTER TABLE message RENAME TO message_old')
+        db.session.commit()
+        for _ in range(2):
+            with self.assertRaises(Exception):
+                message_writer.flush(force=True)
+        db.session.execute('ALTER TABLE message_old RENAME TO message')
+        db.session.commit()
+        stats = message_writer.stats()
+        self.assertEqual(stats['queue_length'], 0)
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['retries'], 2)
+
+    def test_guestbook_events(self):
+        """测试留言实时推送：Last-Event-ID 补齐、广播与连接数上限"""
+        self.app.config.update(
+            WATCHLIST_LIVE=True,
+            WATCHLIST_LIVE_TIMEOUT=0.2,
+            WATCHLIST_LIVE_POLL_INTERVAL=0.05,
+            WATCHLIST_LIVE_LOOKBACK=0,
+            WATCHLIST_LIVE_MAX_CLIENTS=1,
+        )
+        db.session.add_all([Message(name='访客', body='留言%d' % i, timestamp=datetime(2020, 8, i))
+                            for i in range(1, 4)])
+        db.session.commit()
+
+        data = self.client.get('/guestbook').get_data(as_text=True)
+        self.assertIn('data-since="20200803000000000000_3"', data)
+
+        # 从 Last-Event-ID 之后补齐
+        response = self.client.get('/guestbook/events', headers={'Last-Event-ID': '20200801000000000000_1'})
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        data = response.get_data(as_text=True)
+        self.assertNotIn('留言1', data)
+        self.assertIn('id: 20200802000000000000_2\ndata: {"id":2,"name":"访客","body":"留言2"', data)
+        self.assertIn('id: 20200803000000000000_3\n', data)
+        self.assertEqual(hub.clients, 0)
+
+        # 连接建立后提交的留言只推送一次
+        catch_ups = hub.stats()['catch_ups']
+        response = self.client.get('/guestbook/events?since=20200803000000000000_3')
+        self.assertEqual(self.client.get('/guestbook/events').status_code, 503)
+        self.client.post('/guestbook', data=dict(name='访客', body='新留言'))
+        data = response.get_data(as_text=True)
+        self.assertEqual(data.count('"body":"新留言"'), 1)
+        self.assertNotIn('留言3', data)
+        response.close()
+        self.assertEqual(hub.clients, 0)
+        # 本进程写入的留言已经广播过，版本戳变化时不需要补查数据库
+        self.assertEqual(hub.stats()['catch_ups'], catch_ups)
+
+        # 需要补齐的留言太多时让客户端刷新页面
+        self.app.config['WATCHLIST_LIVE_BACKLOG'] = 1
+        response = self.client.get('/guestbook/events?since=20200801000000000000_1')
+        self.assertIn('event: reload', response.get_data(as_text=True))
+        self.assertEqual(self.client.get('/guestbook/events?since=abc').status_code, 400)
+
+    def test_live_hub(self):
+        """测试广播中心的有界缓冲区与异步写入的广播"""
+        subscriber = Subscriber(2)
+        subscriber.put([1, 2])
+        self.assertEqual(subscriber.get(0), [1, 2])
+        subscriber.put([1, 2, 3])
+        self.assertTrue(subscriber.overflowed)
+        self.assertEqual(subscriber.get(0), [])
+
+        self.addCleanup(message_writer.stop)
+        self.app.config['WATCHLIST_WRITE_BEHIND_INTERVAL'] = 60
+        subscriber = hub.subscribe(10, 10)
+        self.addCleanup(hub.unsubscribe, subscriber)
+        message_writer.start()
+        message_writer.submit('访客', '第一条')
+        message_writer.submit('访客', '第二条')
+        stamp = stamps.get('message')
+        self.assertEqual(message_writer.flush(), 2)
+        ids = [id for id, timestamp, text in subscriber.get(0)]
+        self.assertEqual(ids, [m.id for m in Message.query.order_by(Message.id)])
+
+        # 区分本进程与其他进程的写入
+        current = stamps.get('message')
+        self.assertTrue(hub.own_change(stamp, current))
+        hub.bump()
+        self.assertTrue(hub.own_change(stamp, stamps.get('message')))
+        stamps.bump('message')
+        self.assertFalse(hub.own_change(current, stamps.get('message')))
+
+    def test_metrics(self):
+        """测试性能统计"""
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+        self.addCleanup(metrics.clear)
+        self.app.config.update(WATCHLIST_METRICS=True, WATCHLIST_METRICS_TOKEN='secret')
+        metrics.clear()
+
+        self.client.get('/guestbook')
+        self.client.get('/guestbook')
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+        response = self.client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('text/plain', response.headers['Content-Type'])
+        data = response.get_data(as_text=True)
+        self.assertIn('# TYPE watchlist_request_duration_seconds histogram', data)
+        self.assertIn('watchlist_request_duration_seconds_count{route="main.guestbook"} 2', data)
+        self.assertIn('watchlist_requests_total{route="main.guestbook",status="200"} 2', data)
+        # 所有者已被 404 页面缓存，第一次请求只查询留言和总数，第二次请求命中页面缓存
+        self.assertIn('watchlist_sql_queries_sum{route="main.guestbook"} 2.0', data)
+        self.assertIn('watchlist_template_render_seconds_count{route="main.guestbook"} 2', data)
+        self.assertIn('watchlist_cache{cache="response",stat="hits"} 1', data)
+
+        # 慢查询日志
+        self.app.config['WATCHLIST_SLOW_QUERY_THRESHOLD'] = 0
+        with self.assertLogs('watchlist.metrics', 'WARNING') as logs:
+            self.client.get('/?sort=title')
+        self.assertIn('Slow query', logs.output[0])
+
+        # 登录后也可以访问
+        self.login()
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+    def test_rate_limit(self):
+        """测试留言与登录的限流"""
+        self.app.config['WATCHLIST_RATE_LIMITS'] = {
+            'guestbook': {'ip': (0.01, 2), 'global': (100, 100)},
+            'login': {'ip': (100, 100), 'global': (0.5, 1)},
+        }
+        for i in range(2):
+            response = self.client.post('/guestbook', data=dict(name='访客', body='留言%d' % i))
+            self.assertEqual(response.status_code, 302)
+        response = self.client.post('/guestbook', data=dict(name='访客', body='留言2'))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '100')
+        self.assertIn('Too Many Requests - 429', response.get_data(as_text=True))
+        self.assertEqual(Message.query.count(), 2)
+        # 其他客户端不受影响，GET 请求不限流
+        response = self.client.post('/guestbook', data=dict(name='访客', body='留言3'),
+                                    environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.client.get('/guestbook').status_code, 200)
+
+        # 登录的全局限制
+        self.client.post('/login', data=dict(username='test', password='456'))
+        response = self.client.post('/login', data=dict(username='test', password='123'),
+                                    environ_base={'REMOTE_ADDR': '10.0.0.3'})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '2')
+
+        from watchlist.ratelimit import limiter
+        stats = limiter.stats()
+        self.assertEqual(stats['rejected'], {('guestbook', 'ip'): 1, ('login', 'global'): 1})
+        self.assertEqual(stats['buckets'], {'guestbook': 3, 'login': 3})
+
+    def test_trusted_proxies(self):
+        """测试反向代理后面按 X-Forwarded-For 确定客户端 IP"""
+        headers = {'X-Forwarded-For': '203.0.113.7, 10.0.0.1'}
+        for proxies, remote_addr in ((0, '127.0.0.1'), (1, '10.0.0.1'), (2, '203.0.113.7')):
+            app = create_app({'TESTING': True, 'WATCHLIST_TRUSTED_PROXIES': proxies})
+            app.add_url_rule('/ip', 'ip', lambda: request.remote_addr)
+            self.assertEqual(app.test_client().get('/ip', headers=headers).get_data(as_text=True), remote_addr)
+
+        # 关闭限流
+        self.app.config['WATCHLIST_RATE_LIMIT'] = False
+        response = self.client.post('/guestbook', data=dict(name='访客', body='留言4'))
+        self.assertEqual(response.status_code, 302)
+
+    def test_bucket_store(self):
+        """测试令牌桶的补充与 LRU 淘汰"""
+        store = BucketStore(maxsize=2)
+        self.assertEqual(store.take('a', 1, 2, now=0), 0)
+        self.assertEqual(store.take('a', 1, 2, now=0), 0)
+        self.assertEqual(store.take('a', 1, 2, now=0.5), 0.5)
+        self.assertEqual(store.take('a', 1, 2, now=1), 0)
+        store.take('b', 1, 2, now=1)
+        store.take('c', 1, 2, now=1)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.evictions, 1)
+        # 被淘汰的桶重新视为满桶
+        self.assertEqual(store.take('a', 1, 2, now=1), 0)
+
+    def test_search(self):
+        """测试全文搜索"""
+        db.session.add_all([Movie(title='疯狂的石头', year='2006', user_id=1), Movie(title='疯狂的赛车', year='2009', user_id=1),
+                            Message(name='石头迷', body='Hello World')])
+        db.session.commit()
+
+        # 三个字符以上使用 FTS5 索引，少于三个字符退回 LIKE 查询
+        response = self.client.get('/search?q=疯狂的')
+        data = response.get_data(as_text=True)
+        self.assertIn('2 部电影', data)
+        self.assertIn('疯狂的石头', data)
+
+        response = self.client.get('/search?q=石头')
+        data = response.get_data(as_text=True)
+        self.assertIn('1 部电影', data)
+        self.assertIn('1 条留言', data)
+        self.assertIn('石头迷', data)
+
+        # 索引由触发器与原表保持同步
+        self.login()
+        self.client.post('/movie/edit/2', data=dict(title='疯狂的外星人', year='2019'))
+        self.client.post('/movie/delete/3')
+        response = self.client.get('/api/search?q=疯狂的')
+        self.assertEqual(response.get_json()['movies'], [{'id': 2, 'title': '疯狂的外星人', 'year': '2019'}])
+
+        response = self.client.get('/api/search?q=hello world')
+        messages = response.get_json()['messages']
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]['name'], '石头迷')
+
+        self.assertEqual(self.client.get('/api/search').status_code, 400)
+
+    def test_reindex_command(self):
+        """测试重建搜索索引"""
+        db.session.execute('DELETE FROM movie_fts')
+        db.session.commit()
+        result = self.runner.invoke(args=['reindex'])
+        self.assertIn('Indexed 1 movie rows.', result.output)
+        response = self.client.get('/api/search?q=千钧一发')
+        self.assertEqual(len(response.get_json()['movies']), 1)
+
+    def test_api_movies(self):
+        """测试电影 JSON API"""
+        db.session.add_all([Movie(title='电影%d' % i, year='2000', user_id=1) for i in range(2, 6)])
+        db.session.commit()
+
+        response = self.client.get('/api/movies?limit=2')
+        self.assertEqual(response.mimetype, 'application/json')
+        data = response.get_json()
+        self.assertEqual(data['items'], [{'id': 1, 'title': '千钧一发', 'year': '1997'},
+                                         {'id': 2, 'title': '电影2', 'year': '2000'}])
+        self.assertEqual(data['next'], '2')
+
+        data = self.client.get('/api/movies?limit=2&after=4&fields=title').get_json()
+        self.assertEqual(data, {'items': [{'title': '电影5'}], 'next': None})
+
+        data = self.client.get('/api/movies?ids=5,1,9&fields=id,year').get_json()
+        self.assertEqual(data['items'], [{'id': 1, 'year': '1997'}, {'id': 5, 'year': '2000'}])
+
+        # 1000 个 id 分段查询，结果仍按 id 排序
+        ids = ','.join(str(i) for i in range(1000, 0, -1))
+        data = self.client.get('/api/movies?fields=id&ids=' + ids).get_json()
+        self.assertEqual(data['items'], [{'id': i} for i in range(1, 6)])
+
+        self.assertEqual(self.client.get('/api/movies?fields=password').status_code, 400)
+        self.assertEqual(self.client.get('/api/movies?ids=a,b').status_code, 400)
+
+    def test_api_messages(self):
+        """测试留言 JSON API"""
+        db.session.add_all([Message(name='访客', body='留言%d' % i, timestamp=datetime(2020, 8, i))
+                            for i in range(1, 4)])
+        db.session.commit()
+
+        data = self.client.get('/api/messages?limit=2&fields=body,timestamp').get_json()
+        self.assertEqual(data['items'], [{'body': '留言3', 'timestamp': '2020-08-03T00:00:00'},
+                                         {'body': '留言2', 'timestamp': '2020-08-02T00:00:00'}])
+        self.assertEqual(data['next'], '20200802000000000000_2')
+
+        data = self.client.get('/api/messages?before=' + data['next']).get_json()
+        self.assertEqual([item['body'] for item in data['items']], ['留言1'])
+        self.assertIsNone(data['next'])
+
+        data = self.client.get('/api/messages?ids=2&fields=name').get_json()
+        self.assertEqual(data['items'], [{'name': '访客'}])
+        self.assertEqual(self.client.get('/api/messages?before=bad').status_code, 400)
+
     def test_forge_command(self):
         """测试虚拟数据"""
         result = self.runner.invoke(forge)
         self.assertIn('Done.', result.output)
         self.assertNotEqual(Movie.query.count(), 0)
+        # 虚拟数据的所有者可以通过用户名访问，没有设置密码时不能登录
+        self.assertIn('Whxcer', self.client.get('/user/whxcer').get_data(as_text=True))
+        response = self.client.post('/login', data=dict(username='whxcer', password='123'), follow_redirects=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('验证失败', response.get_data(as_text=True))
+
+    def test_index_page_without_users(self):
+        """测试还没有用户时首页显示空清单"""
+        Movie.query.delete()
+        User.query.delete()
+        db.session.commit()
+        response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('0 条清单', response.get_data(as_text=True))
+        self.assertEqual(self.client.get('/user/test').status_code, 404)
 
     def test_initdb_command(self):
         """测试初始化数据库"""
         result = self.runner.invoke(initdb)
         self.assertIn('Initialized database.', result.output)
 
+    def test_import_export_movies(self):
+        """测试电影的批量导入导出"""
+        path = os.path.join(self.stamp_dir, 'movies.csv')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('title,year\n')
+            f.write('肖申克的救赎,1994\n霸王别姬,1993\n,2000\n星际穿越,2014\n')
+
+        result = self.runner.invoke(args=['import-movies', path, '--batch-size', '2'])
+        self.assertIn('Imported 3 rows, skipped 1 invalid rows', result.output)
+        self.assertIn('rows/s', result.output)
+        self.assertEqual(Movie.query.count(), 4)
+
+        path = os.path.join(self.stamp_dir, 'movies.jsonl')
+        result = self.runner.invoke(args=['export-movies', path])
+        self.assertIn('Exported 4 rows', result.output)
+        with open(path, encoding='utf-8') as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(rows[1], {'id': 2, 'title': '肖申克的救赎', 'year': '1994'})
+
+        # JSON 中的整数年份可以导入，其他类型的值跳过
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'title': '千与千寻', 'year': 2001}) + '\n')
+            f.write(json.dumps({'title': 123, 'year': 2001}) + '\n')
+            f.write(json.dumps({'title': '盗梦空间', 'year': [2010]}) + '\n')
+        result = self.runner.invoke(args=['import-movies', path])
+        self.assertIn('Imported 1 rows, skipped 2 invalid rows', result.output)
+        self.assertEqual(Movie.query.filter_by(title='千与千寻').one().year, '2001')
+
+    def test_import_export_messages(self):
+        """测试留言的批量导入导出"""
+        path = os.path.join(self.stamp_dir, 'messages.jsonl')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'name': '访客', 'body': '你好', 'timestamp': '2020-08-01T12:00:00'}) + '\n')
+            f.write(json.dumps({'name': '访客', 'body': '没有时间戳'}) + '\n')
+            f.write(json.dumps({'name': '访客', 'body': '错误的时间戳', 'timestamp': 'yesterday'}) + '\n')
+            f.write('{"name": "访客", "body": \n')
+            f.write(json.dumps({'name': '访客', 'body': ['不是字符串']}) + '\n')
+            f.write(json.dumps({'name': '访客', 'body': '北京时间', 'timestamp': '2020-08-01T20:00:00+08:00'}) + '\n')
+
+        result = self.runner.invoke(args=['import-messages', path])
+        self.assertIn('Imported 3 rows, skipped 3 invalid rows', result.output)
+        self.assertEqual(Message.query.get(1).timestamp, datetime(2020, 8, 1, 12))
+        # 带时区的时间转换为 UTC
+        self.assertEqual(Message.query.get(3).timestamp, datetime(2020, 8, 1, 12))
+
+        path = os.path.join(self.stamp_dir, 'messages.csv')
+        result = self.runner.invoke(args=['export-messages', path])
+        self.assertIn('Exported 3 rows', result.output)
+        with open(path, encoding='utf-8', newline='') as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(rows[0]['timestamp'], '2020-08-01T12:00:00')
+        self.assertEqual(rows[1]['body'], '没有时间戳')
+
+    def test_archive_messages(self):
+        """测试归档旧留言"""
+        from watchlist import counters
+        from watchlist.search import search_messages
+        result = self.runner.invoke(args=['archive-messages'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('No retention policy', result.output)
+
+        timestamps = [datetime(2020, 8, 1), datetime(2020, 8, 1), datetime(2020, 8, 2),
+                      datetime(2020, 8, 3), datetime.utcnow()]
+        db.session.add_all([Message(name='访客', body='留言%d' % i, timestamp=t)
+                            for i, t in enumerate(timestamps, 1)])
+        db.session.commit()
+
+        # 保留最新的 3 条，每批 1 条
+        result = self.runner.invoke(args=['archive-messages', '--max-rows', '3', '--batch-size', '1'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Archived 2 messages', result.output)
+        self.assertEqual([m.body for m in Message.query.order_by(Message.id)], ['留言3', '留言4', '留言5'])
+        self.assertEqual([m.body for m in ArchivedMessage.query.order_by(ArchivedMessage.id)], ['留言1', '留言2'])
+        self.assertEqual(counters.get('message'), 3)
+
+        # 按天数归档，与配置中的条数限制取归档较多的一方
+        self.app.config['WATCHLIST_MESSAGE_MAX_ROWS'] = 3
+        result = self.runner.invoke(args=['archive-messages', '--max-age', '30'])
+        self.assertIn('Archived 2 messages', result.output)
+        self.assertEqual(Message.query.one().body, '留言5')
+        self.assertEqual(counters.get('message'), 1)
+        self.assertEqual(search_messages('留言3'), [])
+
+        data = self.client.get('/guestbook').get_data(as_text=True)
+        self.assertIn('1 条留言', data)
+        self.assertIn('/guestbook/archive', data)
+
+        self.app.config['WATCHLIST_MESSAGE_PER_PAGE'] = 3
+        data = self.client.get('/guestbook/archive').get_data(as_text=True)
+        self.assertIn('留言4', data)
+        self.assertIn('留言2', data)
+        self.assertNotIn('留言1', data)
+        self.assertIn('/guestbook/archive?before=20200801000000000000_2', data)
+        data = self.client.get('/guestbook/archive?before=20200801000000000000_2').get_data(as_text=True)
+        self.assertIn('留言1', data)
+        self.assertNotIn('加载更多', data)
+
+    def test_check_db_command(self):
+        """测试 SQLite 性能配置"""
+        db.session.remove()
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(self.stamp_dir, 'test.db')
+        self.addCleanup(db.engine.dispose)
+
+        result = self.runner.invoke(args=['check-db'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('QueuePool', result.output)
+        self.assertIn('journal_mode   wal', result.output)
+        self.assertIn('synchronous    1', result.output)
+        self.assertIn('auto_vacuum    2            incremental', result.output)
+        self.assertNotIn('MISMATCH', result.output)
+
+        # 没有开启增量回收的旧数据库只给出提示
+        path = os.path.join(self.stamp_dir, 'old.db')
+        connection = sqlite3.connect(path)
+        connection.execute('CREATE TABLE t (x)')
+        connection.close()
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+        result = self.runner.invoke(args=['check-db'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('archive-messages --vacuum', result.output)
+        self.assertNotIn('MISMATCH', result.output)
+
+    def test_counters(self):
+        """测试电影和留言总数计数器"""
+        from watchlist import counters
+        self.assertEqual(counters.get('movie'), 1)
+        self.assertEqual(counters.get('message'), 0)
+
+        self.client.post('/login', data=dict(username='test', password='123'))
+        self.client.post('/', data=dict(title='新电影', year='2019'))
+        self.client.post('/movie/delete/1')
+        self.client.post('/', data=dict(title='另一部电影', year='2020'))
+        self.client.post('/guestbook', data=dict(name='访客', body='留言'))
+        self.runner.invoke(forge)
+        self.assertEqual(counters.get('movie'), Movie.query.count())
+        self.assertEqual(counters.get('message'), 1)
+        # 按用户的计数器，forge 生成的电影属于另一个用户
+        self.assertEqual(counters.get('movie', 1), 2)
+        self.assertEqual(counters.get('movie', 2), Movie.query.filter_by(user_id=2).count())
+        self.assertEqual(counters.get('movie', 3), 0)
+
+        response = self.client.get('/')
+        self.assertIn('2 条清单', response.get_data(as_text=True))
+        response = self.client.get('/guestbook')
+        self.assertIn('1 条留言', response.get_data(as_text=True))
+
+    def test_recount_command(self):
+        """测试检查与修复计数器"""
+        result = self.runner.invoke(args=['recount', '--check'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('movie    counter 1        rows 1        OK', result.output)
+
+        db.session.execute("UPDATE stat SET value = 5 WHERE name = 'movie'")
+        db.session.execute('DROP TRIGGER message_stat_ai')
+        db.session.commit()
+        db.session.add(Message(name='访客', body='留言'))
+        db.session.commit()
+        result = self.runner.invoke(args=['recount', '--check'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('movie    counter 5        rows 1        MISMATCH', result.output)
+        self.assertIn('message  counter 0        rows 1        MISMATCH', result.output)
+
+        result = self.runner.invoke(args=['recount'])
+        self.assertIn('Done.', result.output)
+        self.assertEqual(self.runner.invoke(args=['recount', '--check']).exit_code, 0)
+        # 触发器已重新创建
+        db.session.add(Message(name='访客', body='留言'))
+        db.session.commit()
+        self.assertEqual(self.runner.invoke(args=['recount', '--check']).exit_code, 0)
+
+        # 旧版本创建的数据库：没有 stat 表和触发器，页面退回 COUNT 查询
+        for name, in db.session.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE '%stat%'"):
+            db.session.execute('DROP TRIGGER %s' % name)
+        db.session.execute('DROP TABLE stat')
+        db.session.commit()
+        self.assertIn('1 条清单', self.client.get('/').get_data(as_text=True))
+        self.assertIn('2 条留言', self.client.get('/guestbook').get_data(as_text=True))
+        result = self.runner.invoke(args=['recount', '--check'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('movie    counter None     rows 1        MISMATCH', result.output)
+        self.assertIn('Done.', self.runner.invoke(args=['recount']).output)
+        self.assertEqual(self.runner.invoke(args=['recount', '--check']).exit_code, 0)
+
+    def test_multi_tenant(self):
+        """测试多用户：每个用户的清单、修改与搜索都只涉及自己的电影"""
+        result = self.runner.invoke(args=['create-user', '--username', 'peter', '--password', '456'])
+        self.assertIn('/user/peter', result.output)
+        self.assertIn('already exists', self.runner.invoke(
+            args=['create-user', '--username', 'peter', '--password', '456']).output)
+        peter = User.query.filter_by(username='peter').first()
+        db.session.add(Movie(title='彼得的电影', year='2001', user_id=peter.id))
+        db.session.commit()
+
+        # 匿名访问首页为站点所有者的清单
+        response = self.client.get('/')
+        etag, peter_etag = response.headers['ETag'], self.client.get('/user/peter').headers['ETag']
+        data = response.get_data(as_text=True)
+        self.assertIn('千钧一发', data)
+        self.assertNotIn('彼得的电影', data)
+        data = self.client.get('/user/peter?sort=year').get_data(as_text=True)
+        self.assertIn('peter 的观影清单', data)
+        self.assertIn('1 条清单', data)
+        self.assertIn('彼得的电影', data)
+        self.assertNotIn('千钧一发', data)
+        self.assertIn('/user/peter?sort=title', data)
+        self.assertNotIn('编辑', data)
+        self.assertEqual(self.client.get('/user/nobody').status_code, 404)
+        self.assertIn('彼得的电影', self.client.get('/search?q=彼得&user=peter').get_data(as_text=True))
+        self.assertNotIn('彼得的电影', self.client.get('/search?q=彼得').get_data(as_text=True))
+        items = json.loads(self.client.get('/api/movies?user=peter').get_data(as_text=True))['items']
+        self.assertEqual([item['title'] for item in items], ['彼得的电影'])
+
+        # 登录后首页为自己的清单，不能修改其他用户的电影
+        self.client.post('/login', data=dict(username='peter', password='456'))
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('彼得的电影', data)
+        self.assertNotIn('千钧一发', data)
+        self.assertEqual(self.client.get('/movie/edit/1').status_code, 404)
+        self.assertEqual(self.client.post('/movie/delete/1').status_code, 404)
+        response = self.client.post('/movie/batch', json={'delete': [1]})
+        self.assertEqual(response.get_json()['results'], [{'id': 1, 'action': 'delete', 'status': 'not_found'}])
+        self.client.post('/', data=dict(title='新电影', year='2020'))
+        self.assertEqual(Movie.query.filter_by(title='新电影').first().user_id, peter.id)
+        # 只有 peter 的清单失效，其他用户的页面缓存和 ETag 不受影响
+        self.client.get('/logout', follow_redirects=True)
+        self.assertEqual(self.client.get('/', headers={'If-None-Match': etag}).status_code, 304)
+        self.assertEqual(self.client.get('/user/peter', headers={'If-None-Match': peter_etag}).status_code, 200)
+        self.client.post('/login', data=dict(username='peter', password='456'))
+        self.assertEqual(Movie.query.filter_by(user_id=1).count(), 1)
+
+        # 每个用户的查询都只扫描复合索引中该用户的范围
+        plan = db.session.execute('EXPLAIN QUERY PLAN SELECT id FROM movie WHERE user_id = 1 '
+                                  'ORDER BY year, id LIMIT 20').fetchall()
+        self.assertIn('ix_movie_user_id_year', ' '.join(row[-1] for row in plan))
+        self.assertNotIn('TEMP B-TREE', ' '.join(row[-1] for row in plan))
+
+    def test_migrate_owners(self):
+        """测试为已有数据库添加电影所有者并分批回填"""
+        db.session.execute('DROP INDEX ix_movie_user_id_id')
+        db.session.execute('DROP INDEX ix_user_username')
+        db.session.execute('CREATE INDEX ix_movie_title ON movie (title)')
+        db.session.execute('UPDATE movie SET user_id = NULL')
+        db.session.add_all([Movie(title='电影%d' % i, year='2000') for i in range(5)])
+        db.session.commit()
+        self.runner.invoke(args=['recount'])
+
+        result = self.runner.invoke(args=['migrate-owners', '--batch-size', '2'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Created index ix_movie_user_id_id.', result.output)
+        self.assertIn('Created index ix_user_username.', result.output)
+        self.assertIn('Dropped index ix_movie_title.', result.output)
+        self.assertIn('Assigned 6 movies to test', result.output)
+        self.assertEqual(Movie.query.filter(Movie.user_id.is_(None)).count(), 0)
+        self.assertEqual(self.runner.invoke(args=['recount', '--check']).exit_code, 0)
+        self.assertIn('6 条清单', self.client.get('/').get_data(as_text=True))
+
+        # 重复执行不会改变已有的所有者
+        result = self.runner.invoke(args=['migrate-owners'])
+        self.assertIn('Assigned 0 movies', result.output)
+        self.assertEqual(self.runner.invoke(args=['migrate-owners', '--username', 'nobody']).exit_code, 1)
+
+    def asgi_request(self, adapter, method, path, body=b'', headers=()):
+        """通过 ASGI 接口发送一个请求，返回 (状态码, 响应头, 响应体)"""
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'headers': [
+            (b'host', b'localhost'), (b'content-length', str(len(body)).encode())] + list(headers)}
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        sent = []
+
+        async def receive():
+            if messages:
+                return messages.pop()
+            await asyncio.sleep(3600)
+
+        async def send(message):
+            sent.append(message)
+
+        async def run():
+            await adapter(scope, receive, send)
+            adapter.shutdown()
+        asyncio.run(run())
+        return (sent[0]['status'], dict(sent[0]['headers']),
+                b''.join(message.get('body', b'') for message in sent[1:]))
+
+    def test_asgi(self):
+        """测试 ASGI 入口"""
+        adapter = AsgiAdapter(self.app, max_workers=2)
+        status, headers, body = self.asgi_request(adapter, 'GET', '/')
+        self.assertEqual(status, 200)
+        self.assertIn('千钧一发', body.decode('utf-8'))
+        self.assertEqual(int(headers[b'content-length']), len(body))
+
+        form = b'name=Grey&body=Hello'
+        status, headers, body = self.asgi_request(adapter, 'POST', '/guestbook', form, [
+            (b'content-type', b'application/x-www-form-urlencoded')])
+        self.assertEqual(status, 302)
+        self.assertEqual(Message.query.count(), 1)
+
+        # 没有 Content-Length 的流式响应在视图所在的线程中迭代
+        status, headers, body = self.asgi_request(adapter, 'GET', '/api/movies')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode('utf-8'))['items'][0]['title'], '千钧一发')
+
+        status, headers, body = self.asgi_request(AsgiAdapter(self.app, max_pending=0), 'GET', '/')
+        self.assertEqual(status, 503)
+        self.assertEqual(headers[b'retry-after'], b'1')
+
+        # 请求体超过上限时返回 413，Content-Length 不可信时按实际读取的字节数判断
+        status, headers, body = self.asgi_request(AsgiAdapter(self.app, max_body=8), 'POST', '/guestbook', form)
+        self.assertEqual(status, 413)
+        status, headers, body = self.asgi_request(AsgiAdapter(self.app, max_body=8), 'POST', '/guestbook', form,
+                                                  [(b'content-length', b'1')])
+        self.assertEqual(status, 413)
+        self.assertEqual(Message.query.count(), 1)
+
+    def test_asgi_lifespan(self):
+        """测试 ASGI 的启动和关闭事件"""
+        adapter = AsgiAdapter(self.app)
+        messages = [{'type': 'lifespan.shutdown'}, {'type': 'lifespan.startup'}]
+        sent = []
+
+        async def receive():
+            return messages.pop()
+
+        async def send(message):
+            sent.append(message['type'])
+        asyncio.run(adapter({'type': 'lifespan'}, receive, send))
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertIsNone(adapter._executor)
+
+        # 留言实时推送只在 ASGI 入口中默认开启
+        self.assertFalse(self.app.config['WATCHLIST_LIVE'])
+        asgi_app = create_asgi_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:'})
+        self.assertTrue(asgi_app.wsgi_app.config['WATCHLIST_LIVE'])
+        self.assertEqual(asgi_app.max_body, asgi_app.wsgi_app.config['WATCHLIST_ASGI_MAX_BODY'])
+
+    def test_build_assets(self):
+        """测试静态文件构建：带摘要的文件名、预压缩与长期缓存"""
+        dist = os.path.join(self.stamp_dir, 'dist')
+        self.app.config['WATCHLIST_ASSETS_DIR'] = dist
+        self.assertIn('/static/style.css', self.client.get('/').get_data(as_text=True))
+
+        result = self.runner.invoke(args=['build-assets'])
+        self.assertIn('Built', result.output)
+        with open(os.path.join(dist, 'manifest.json'), encoding='utf-8') as f:
+            manifest = json.load(f)
+        style = manifest['files']['style.css']
+        self.assertRegex(style, r'^dist/style\.[0-9a-f]{12}\.css$')
+
+        data = self.client.get('/guestbook').get_data(as_text=True)
+        self.assertIn('/static/' + style, data)
+        self.assertIn('/static/' + manifest['files']['relative-time.js'], data)
+        self.assertNotIn('moment', data)
+
+        # 精简的 Moment 只写入构建目录，不修改源文件目录
+        bundle = manifest['files']['moment-zh-cn.min.js']
+        self.assertRegex(bundle, r'^dist/moment-zh-cn\.min\.[0-9a-f]{12}\.js$')
+        self.assertFalse(os.path.exists(os.path.join(self.app.static_folder, 'moment-zh-cn.min.js')))
+        self.app.config['WATCHLIST_RELATIVE_TIME'] = 'moment'
+        response_cache.clear()
+        self.assertIn('/static/' + bundle, self.client.get('/guestbook').get_data(as_text=True))
+        self.app.config['WATCHLIST_RELATIVE_TIME'] = 'server'
+
+        with open(os.path.join(self.app.static_folder, 'style.css'), 'rb') as f:
+            original = f.read()
+        response = self.client.get('/static/' + style, headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertTrue(response.content_type.startswith('text/css'))
+        self.assertEqual(gzip.decompress(response.data), original)
+        response.close()
+
+        response = self.client.get('/static/' + style)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.data, original)
+        response.close()
+
+        # 未构建的路径和原始文件名按原来的方式处理
+        self.assertEqual(self.client.get('/static/dist/nothing.css').status_code, 404)
+        response = self.client.get('/static/style.css')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('immutable', response.headers['Cache-Control'])
+        response.close()
+
+    def test_trim_moment(self):
+        """测试精简 Moment 语言包"""
+        from watchlist.assets import trim_moment
+        with open(os.path.join(self.app.static_folder, 'moment-with-locales.min.js'), encoding='utf-8') as f:
+            source = f.read()
+        trimmed = trim_moment(source, ('zh-cn',))
+        self.assertLess(len(trimmed), len(source) / 2)
+        self.assertIn('defineLocale("zh-cn"', trimmed)
+        self.assertNotIn('defineLocale("zh-tw"', trimmed)
+        self.assertTrue(trimmed.rstrip().endswith('a.locale("en"),a});'))
+        with self.assertRaises(ValueError):
+            trim_moment(source, ('xx',))
+
+    def test_compile_templates_command(self):
+        """测试预编译模板"""
+        cache_dir = os.path.join(self.stamp_dir, 'templates')
+        result = self.runner.invoke(args=['compile-templates', '--cache-dir', cache_dir])
+        self.assertIn('Compiled', result.output)
+        self.assertEqual(len(os.listdir(cache_dir)), len(self.app.jinja_env.list_templates(extensions=['html'])))
+
+    def test_lazy_imports(self):
+        """测试导入 watchlist 包不会加载视图和命令，创建程序实例不会加载命令"""
+        code = ('import sys, watchlist; loaded = set(sys.modules); watchlist.create_app(); '
+                'print(sorted(loaded & {"watchlist.routes", "watchlist.models", "watchlist.commands"}), '
+                '"watchlist.commands" in sys.modules)')
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         universal_newlines=True)
+        self.assertEqual(output.strip(), '[] False')
+
+    def test_lazy_commands(self):
+        """测试命令列表中的说明与命令本身一致，调用时才导入命令"""
+        from watchlist.cli import COMMANDS, load_command
+        for name, (import_path, help) in COMMANDS.items():
+            self.assertEqual(load_command(import_path).help, help)
+
+        result = self.runner.invoke(args=['forge', '--help'])
+        self.assertIn('Generate fake data.', result.output)
+
     def test_admin_command(self):
         """测试生成管理员账户"""
         db.drop_all()
@@ -334,6 +1482,13 @@ class Watchlist_TestCase(unittest.TestCase):
         self.assertEqual(User.query.first().username, 'peter')
         self.assertTrue(User.query.first().validate_password('456'))
 
+        # 用户名已被其他用户使用
+        self.runner.invoke(args=['create-user', '--username', 'grey', '--password', '789'])
+        result = self.runner.invoke(args=['admin', '--username', 'grey', '--password', '456'])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('User grey already exists.', result.output)
+        self.assertEqual(User.query.first().username, 'peter')
+
 
 if __name__ == '__main__':
     unittest.main()
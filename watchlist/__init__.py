@@ -1,51 +1,104 @@
-import os
-import sys
+import threading
 
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, current_app
 from flask_login import LoginManager
-from flask_moment import Moment
 
+try:
+    from flask_moment import Moment
+except ImportError:  # 可选依赖，只有 WATCHLIST_RELATIVE_TIME = 'moment' 时需要
+    Moment = None
 
-# 在扩展类实例化之前设置好配置项
-WIN = sys.platform.startswith('win')
-if WIN:
-    # 如果是 Windows 系统，则使用三个斜线
-    prefix = 'sqlite:///'
-else:
-    # 否则使用四个斜线
-    prefix = 'sqlite:////'
+from watchlist.sqlite import TunedSQLAlchemy
 
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = prefix + os.path.join(os.path.dirname(app.root_path), os.getenv('DATABASE_FILE', 'data.db'))
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False            # 关闭对模型修改的监控
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev')
+# 扩展对象在导入时创建，在 create_app() 中绑定到程序实例
+db = TunedSQLAlchemy()
+login_manager = LoginManager()
+login_manager.login_view = 'main.login'
+login_manager.login_message = '请先登录.'
+moment = Moment() if Moment is not None else None
 
+_extensions_lock = threading.Lock()
 
-# 扩展 初始化 操作
-db = SQLAlchemy(app)
-login_manager = LoginManager(app)
-login_manager.login_view = 'login'
-login_manager.login_message = '请先登录.'
-moment = Moment(app)
+
+def app_extension(name, factory):
+    """当前程序实例的 name 对象 (保存在 app.extensions 中)，第一次使用时由 factory(app) 创建
+
+    缓存、异步写入队列、密码校验线程池等都按程序实例分别保存，同一进程中的多个程序实例
+    (如测试、多个站点) 各自使用自己的配置和数据库。模块中的 owner_cache 等名字是
+    LocalProxy，总是指向当前程序实例的对象。
+    """
+    app = current_app._get_current_object()
+    extension = app.extensions.get(name)
+    if extension is None:
+        with _extensions_lock:
+            extension = app.extensions.get(name)
+            if extension is None:
+                extension = app.extensions[name] = factory(app)
+    return extension
+
+
+def create_app(config=None):
+    """创建程序实例
+
+    视图、错误处理函数等模块在这里才导入，导入 watchlist 包本身只需要加载 Flask 和扩展；
+    命令行命令在被调用时才导入 (见 watchlist/cli.py)。config 为字典，覆盖默认配置，
+    测试可以为每个用例创建一个使用独立内存数据库的程序实例。
+    """
+    app = Flask(__name__)
+    app.config.from_object('watchlist.settings')
+    if config:
+        app.config.update(config)
+
+    # 反向代理后面按 X-Forwarded-* 请求头确定客户端 IP (限流按 IP 计算)
+    proxies = app.config['WATCHLIST_TRUSTED_PROXIES']
+    if proxies:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies)
+
+    # 扩展 初始化 操作
+    db.init_app(app)
+    login_manager.init_app(app)
+    if moment is not None:
+        moment.init_app(app)
+    elif app.config['WATCHLIST_RELATIVE_TIME'] == 'moment':
+        raise RuntimeError('WATCHLIST_RELATIVE_TIME = "moment" requires Flask-Moment.')
+
+    from watchlist.metrics import metrics
+    from watchlist.ratelimit import limiter
+    from watchlist import templating, timeago, cli
+    metrics.init_app(app)
+    limiter.init_app(app)
+
+    from watchlist.routes import bp as main_bp
+    from watchlist.api import bp as api_bp
+    from watchlist.errors import bp as errors_bp
+    app.register_blueprint(main_bp)
+    app.register_blueprint(api_bp)
+    app.register_blueprint(errors_bp)
+    app.context_processor(inject_user)
+
+    from watchlist.assets import assets
+    assets.init_app(app)
+
+    cli.init_app(app)
+    timeago.init_app(app)
+    templating.init_app(app)
+    return app
 
 
 # 用户加载回调函数
 @login_manager.user_loader
 def load_user(user_id):
-    from watchlist.models import User
-    user = User.query.get(int(user_id))
+    from watchlist.cache import user_cache
+    user = user_cache.get(int(user_id))
     return user
 
 
 # 模板上下文处理函数
-@app.context_processor
 def inject_user():
-    from watchlist.models import User
-    user = User.query.first()
+    from watchlist.cache import owner_cache
+    # 已登录时为当前用户，否则为站点所有者；所有者数据缓存在进程内，只有版本戳变化时才查询数据库
+    user = owner_cache.for_request()
     # 等同于 return {'user': user}
     return dict(user=user)
-
-
-from watchlist import routes, errors, commands
\ No newline at end of file
@@ -0,0 +1,155 @@
+import itertools
+import json
+from datetime import datetime
+
+from flask import Blueprint, current_app, request, abort, jsonify, stream_with_context
+
+from watchlist import db
+from watchlist.models import Movie, Message
+from watchlist.cache import owner_cache
+from watchlist.pagination import decode_cursor, encode_cursor, chunks
+from watchlist.search import search_movies, search_messages
+
+
+bp = Blueprint('api', __name__, url_prefix='/api')
+
+# 各资源允许通过 fields= 选择的字段
+MOVIE_FIELDS = {
+    'id': Movie.id,
+    'title': Movie.title,
+    'year': Movie.year,
+}
+MESSAGE_FIELDS = {
+    'id': Message.id,
+    'name': Message.name,
+    'body': Message.body,
+    'timestamp': Message.timestamp,
+}
+
+
+def _dumps(obj):
+    # 紧凑输出：去掉多余空格，中文不转义
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'),
+                      default=lambda o: o.isoformat() if isinstance(o, datetime) else str(o))
+
+
+def _get_fields(allowed):
+    fields = request.args.get('fields')
+    if not fields:
+        return list(allowed)
+    fields = [f.strip() for f in fields.split(',') if f.strip()]
+    if not fields or any(f not in allowed for f in fields):
+        abort(400)
+    return fields
+
+
+def _get_ids():
+    ids = request.args.get('ids')
+    if ids is None:
+        return None
+    try:
+        ids = sorted({int(i) for i in ids.split(',') if i.strip()})
+    except ValueError:
+        abort(400)
+    if not ids or len(ids) > current_app.config['WATCHLIST_API_MAX_LIMIT']:
+        abort(400)
+    return ids
+
+
+def _get_limit():
+    limit = request.args.get('limit', current_app.config['WATCHLIST_API_PER_PAGE'], type=int)
+    if limit < 1:
+        abort(400)
+    return min(limit, current_app.config['WATCHLIST_API_MAX_LIMIT'])
+
+
+def _get_owner():
+    # ?user=<username>，默认为已登录用户或站点所有者
+    owner = owner_cache.for_request(request.args.get('user'))
+    if owner is None:
+        abort(404)
+    return owner
+
+
+def _by_ids(query, column, ids):
+    """按 ids 分段查询，返回查询列表；ids 已排序，各段按 column 排序后依次输出即为整体顺序"""
+    return [query.filter(column.in_(chunk)) for chunk in chunks(ids)]
+
+
+def _stream(query, fields, limit, make_cursor):
+    """逐行输出 JSON，响应体再大也不需要在内存中拼出整个列表
+
+    query 的前 len(fields) 列为输出字段，其余列只用于生成下一页游标；也可以是查询列表 (见 _by_ids)，
+    依次输出。多取一行用于判断是否还有下一页。
+    """
+    queries = query if isinstance(query, list) else [query]
+
+    def generate():
+        yield '{"items":['
+        last = None
+        count = 0
+        per_page = current_app.config['WATCHLIST_API_PER_PAGE']
+        rows = itertools.chain.from_iterable(q.limit(limit + 1).yield_per(per_page) for q in queries)
+        for row in rows:
+            if count == limit:
+                break
+            yield (',' if count else '') + _dumps(dict(zip(fields, row)))
+            last = row
+            count += 1
+        else:
+            last = None
+        yield '],"next":%s}' % _dumps(make_cursor(last) if last is not None else None)
+
+    return current_app.response_class(stream_with_context(generate()), mimetype='application/json')
+
+
+@bp.route('/movies')
+def movies():
+    """电影列表：?user=<username> 选择用户，?after=<id> 游标分页，?ids=1,2,3 批量查询，?fields=title,year 选择字段"""
+    fields = _get_fields(MOVIE_FIELDS)
+    columns = [MOVIE_FIELDS[f] for f in fields] + [Movie.id]
+    # 走 (user_id, id) 复合索引
+    query = db.session.query(*columns).filter(Movie.user_id == _get_owner().id).order_by(Movie.id)
+
+    ids = _get_ids()
+    if ids is not None:
+        return _stream(_by_ids(query, Movie.id, ids), fields, len(ids), lambda row: None)
+
+    after = request.args.get('after', type=int)
+    if after is not None:
+        query = query.filter(Movie.id > after)
+    return _stream(query, fields, _get_limit(), lambda row: str(row[-1]))
+
+
+@bp.route('/messages')
+def messages():
+    """留言列表：按时间倒序，?before=<timestamp>_<id> 游标分页，其余参数同 /api/movies"""
+    fields = _get_fields(MESSAGE_FIELDS)
+    columns = [MESSAGE_FIELDS[f] for f in fields] + [Message.timestamp, Message.id]
+    query = db.session.query(*columns)
+
+    ids = _get_ids()
+    if ids is not None:
+        return _stream(_by_ids(query.order_by(Message.id), Message.id, ids), fields, len(ids), lambda row: None)
+
+    before = request.args.get('before')
+    if before:
+        cursor = decode_cursor(before)
+        if cursor is None:
+            abort(400)
+        query = query.filter(db.tuple_(Message.timestamp, Message.id) < cursor)
+    query = query.order_by(Message.timestamp.desc(), Message.id.desc())
+    return _stream(query, fields, _get_limit(), lambda row: encode_cursor(row[-2], row[-1]))
+
+
+@bp.route('/search')
+def search():
+    q = request.args.get('q', '').strip()
+    limit = min(request.args.get('limit', current_app.config['WATCHLIST_SEARCH_LIMIT'], type=int), 100)
+    if not q or limit < 1:
+        abort(400)
+
+    messages = search_messages(q, limit)
+    for message in messages:
+        message['timestamp'] = message['timestamp'].isoformat()
+    return jsonify(q=q, movies=search_movies(q, _get_owner().id, limit), messages=messages)
@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import tuple_
+
+from watchlist import db
+from watchlist.models import Message, ArchivedMessage
+
+
+def boundary(max_age=0, max_rows=0, now=None):
+    """按保留策略计算归档边界 (timestamp, id)，排序键小于边界的留言需要归档
+
+    max_age 为保留的天数，max_rows 为保留的条数，0 表示不限制；都设置时取归档较多的一方。
+    不需要归档时返回 None。
+    """
+    candidates = []
+    if max_age:
+        candidates.append(((now or datetime.utcnow()) - timedelta(days=max_age), 0))
+    if max_rows:
+        # 第 max_rows 新的留言，沿 timestamp 索引倒序扫描
+        row = db.session.query(Message.timestamp, Message.id) \
+            .order_by(Message.timestamp.desc(), Message.id.desc()).offset(max_rows - 1).limit(1).first()
+        if row is not None:
+            candidates.append(tuple(row))
+    return max(candidates) if candidates else None
+
+
+def archive(boundary, batch_size, progress=None):
+    """把排序键小于 boundary 的留言按时间顺序分批移入归档表，返回移动的条数
+
+    每批按 (timestamp, id) 范围复制并删除，一个短事务，不会长时间持有写锁；
+    删除时由触发器同步维护留言计数器和全文索引。progress 在每批之后以已移动条数调用。
+    """
+    source, target = Message.__table__, ArchivedMessage.__table__
+    key = tuple_(source.c.timestamp, source.c.id)
+    moved = 0
+    while True:
+        upper = db.session.execute(
+            db.select([source.c.timestamp, source.c.id]).where(key < boundary)
+            .order_by(source.c.timestamp, source.c.id).offset(batch_size - 1).limit(1)).first()
+        condition = key <= tuple(upper) if upper is not None else key < boundary
+        db.session.execute(target.insert().from_select(
+            ['name', 'body', 'timestamp'],
+            db.select([source.c.name, source.c.body, source.c.timestamp]).where(condition)
+            .order_by(source.c.timestamp, source.c.id)))
+        result = db.session.execute(source.delete().where(condition))
+        db.session.commit()
+        moved += result.rowcount
+        if progress is not None and result.rowcount:
+            progress(moved)
+        if upper is None:
+            return moved
+
+
+def compact(vacuum=False):
+    """回收删除留言后的空闲页并更新查询规划器的统计信息，返回 (之前, 之后) 的空闲页数
+
+    以 auto_vacuum = INCREMENTAL 创建的数据库 (见 WATCHLIST_SQLITE_PRAGMAS) 执行 incremental_vacuum，
+    只截断空闲页；其他数据库的空闲页留给之后的写入复用。vacuum 为 True 时执行完整的 VACUUM，
+    重写整个文件 (期间阻塞写入)，同时把旧数据库转换为增量模式。
+    """
+    with db.engine.connect() as connection:
+        before = connection.execute('PRAGMA freelist_count').scalar()
+        incremental = connection.execute('PRAGMA auto_vacuum').scalar() == 2
+        # 通过 DB-API 的 executescript() 执行：VACUUM 不能在事务中执行，
+        # incremental_vacuum 每一步释放一页，execute() 只会执行第一步
+        if vacuum:
+            connection.connection.executescript('PRAGMA auto_vacuum = INCREMENTAL; VACUUM;')
+        elif incremental:
+            connection.connection.executescript('PRAGMA incremental_vacuum;')
+        connection.execute('PRAGMA optimize')
+        after = connection.execute('PRAGMA freelist_count').scalar()
+    return before, after
@@ -0,0 +1,276 @@
+import asyncio
+import io
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+# 超出排队上限、请求体过大时直接返回的响应
+_BUSY_BODY = b'Service Unavailable - 503'
+_TOO_LARGE_BODY = b'Request Entity Too Large - 413'
+
+
+async def _send_error(send, status, body, headers=()):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'text/plain')] + list(headers)})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _environ(scope, body):
+    """由 ASGI 的 http scope 构造 WSGI environ"""
+    path = scope['path']
+    root_path = scope.get('root_path', '')
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        # WSGI 要求把 UTF-8 编码的路径按 latin-1 解码
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    client = scope.get('client')
+    if client:
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = client[0], str(client[1])
+    for name, value in scope.get('headers', []):
+        name, value = name.decode('latin-1'), value.decode('latin-1')
+        if name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        elif name == 'content-type':
+            key = 'CONTENT_TYPE'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future, exc):
+    if not future.done():
+        future.set_exception(exc)
+
+
+class _Response(object):
+    """在执行请求的线程与事件循环之间传递响应
+
+    状态码、响应头和普通响应的响应体通过 started 传递；流式响应的数据块通过队列传递，
+    线程最多领先 window 块，客户端读得慢时线程等待，客户端断开 (closed) 后线程停止迭代。
+    """
+
+    def __init__(self, loop, window=8):
+        self.loop = loop
+        self.started = loop.create_future()
+        self.chunks = asyncio.Queue()
+        self.closed = threading.Event()
+        self._window = threading.Semaphore(window)
+
+    def _call_soon(self, callback, *args):
+        try:
+            self.loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:  # 事件循环已关闭
+            self.closed.set()
+
+    def start(self, status, headers, body=None):
+        self._call_soon(_set_result, self.started, (status, headers, body))
+
+    def fail(self, exc):
+        self._call_soon(_set_exception, self.started, exc)
+
+    def put(self, chunk):
+        """由线程调用，chunk 为 None 表示结束；客户端已断开时返回 False"""
+        while not self._window.acquire(timeout=1):
+            if self.closed.is_set():
+                return False
+        if self.closed.is_set():
+            return False
+        self._call_soon(self.chunks.put_nowait, chunk)
+        return True
+
+    async def get(self):
+        chunk = await self.chunks.get()
+        self._window.release()
+        return chunk
+
+    def close(self):
+        self.closed.set()
+
+
+class AsgiAdapter(object):
+    """在有界线程池中运行 Flask (WSGI) 程序的 ASGI 入口
+
+    事件循环负责网络读写，读取请求体、等待慢客户端都不占用线程；路由、模板和数据库访问仍是
+    同步代码，最多 max_workers 个请求同时在线程中执行。max_workers 不应超过 SQLite 连接池的大小
+    (WATCHLIST_SQLITE_POOL_SIZE + WATCHLIST_SQLITE_POOL_OVERFLOW)。等待执行的请求超过 max_pending
+    时直接返回 503，不会无限排队。
+
+    流式响应 (如 SSE、流式 JSON) 必须在调用视图的同一线程中迭代，stream_with_context 保存的
+    请求上下文属于该线程；响应开始后它不再计入 max_workers，另外最多占用 stream_workers 个线程，
+    stream_workers 应大于 WATCHLIST_LIVE_MAX_CLIENTS。
+
+    请求体在交给线程之前读入内存，超过 max_body 字节时直接返回 413 (None 表示不限制)。
+    """
+
+    def __init__(self, wsgi_app, max_workers=8, max_pending=256, stream_workers=128, max_body=None):
+        self.wsgi_app = wsgi_app
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.stream_workers = stream_workers
+        self.max_body = max_body
+        self._executor = None
+        self._slots = None
+        # 只在事件循环线程中修改，不需要加锁
+        self.pending = 0
+        self.rejected = 0
+
+    def _start(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers + self.stream_workers, thread_name_prefix='asgi')
+            self._slots = asyncio.Semaphore(self.max_workers)
+
+    def shutdown(self):
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError('Unsupported ASGI scope type: %s' % scope['type'])
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _call(self, environ, response):
+        """在线程中调用 WSGI 程序，带 Content-Length 的响应一次读完，否则在本线程中继续迭代"""
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [int(status.split(' ', 1)[0]), headers]
+
+        streaming = False
+        iterable = None
+        try:
+            iterable = self.wsgi_app(environ, start_response)
+            status, headers = started
+            if any(name.lower() == 'content-length' for name, value in headers):
+                response.start(status, headers, b''.join(iterable))
+                return
+            response.start(status, headers)
+            streaming = True
+            for chunk in iterable:
+                if chunk and not response.put(chunk):
+                    return
+        except BaseException as e:
+            if not streaming:
+                response.fail(e)
+                return
+            logger.exception('Error while streaming the response.')
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+        response.put(None)
+
+    async def _http(self, scope, receive, send):
+        self._start()
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            await _send_error(send, 503, _BUSY_BODY, [(b'retry-after', b'1')])
+            return
+        if self.max_body is not None:
+            length = dict(scope.get('headers', ())).get(b'content-length', b'')
+            if length.isdigit() and int(length) > self.max_body:
+                await _send_error(send, 413, _TOO_LARGE_BODY)
+                return
+
+        self.pending += 1
+        try:
+            # 请求体在事件循环中读完，线程不会等待慢客户端上传；
+            # 没有 Content-Length (分块上传) 或与实际长度不符时按已读取的字节数限制
+            chunks = []
+            size = 0
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                chunk = message.get('body', b'')
+                size += len(chunk)
+                if self.max_body is not None and size > self.max_body:
+                    await _send_error(send, 413, _TOO_LARGE_BODY)
+                    return
+                chunks.append(chunk)
+                if not message.get('more_body'):
+                    break
+
+            loop = asyncio.get_event_loop()
+            response = _Response(loop)
+            async with self._slots:
+                loop.run_in_executor(self._executor, self._call, _environ(scope, b''.join(chunks)), response)
+                try:
+                    status, headers, body = await response.started
+                except BaseException:
+                    response.close()
+                    raise
+        finally:
+            self.pending -= 1
+
+        try:
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                    for name, value in headers]})
+            if body is not None:
+                await send({'type': 'http.response.body', 'body': body})
+                return
+            while True:
+                chunk = await response.get()
+                if chunk is None:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            # 客户端断开时 send() 抛出异常或任务被取消，通知线程停止迭代
+            response.close()
+
+
+def create_asgi_app(config=None):
+    """创建 ASGI 程序，线程池大小等由 WATCHLIST_ASGI_* 配置
+
+    SSE 连接等待期间不占用处理请求的线程，除非设置了 WATCHLIST_LIVE=0，否则开启留言实时推送。
+    请求体上限为 MAX_CONTENT_LENGTH，没有设置时为 WATCHLIST_ASGI_MAX_BODY。
+    """
+    from watchlist import create_app
+    config = dict(config or {})
+    config.setdefault('WATCHLIST_LIVE', os.getenv('WATCHLIST_LIVE', '1') == '1')
+    app = create_app(config)
+    return AsgiAdapter(app, app.config['WATCHLIST_ASGI_WORKERS'], app.config['WATCHLIST_ASGI_MAX_PENDING'],
+                       app.config['WATCHLIST_ASGI_STREAM_WORKERS'],
+                       app.config.get('MAX_CONTENT_LENGTH') or app.config['WATCHLIST_ASGI_MAX_BODY'])
@@ -0,0 +1,238 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+try:
+    import brotli
+except ImportError:  # 可选依赖，未安装时只生成 .gz
+    brotli = None
+
+from flask import current_app, request, send_from_directory
+
+
+# 构建结果的 URL 前缀：url_for('static', filename='dist/...')
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+# 图片等本身已经压缩过的文件不再预压缩
+COMPRESSIBLE = ('.css', '.js', '.ico', '.svg', '.json', '.txt')
+MIN_COMPRESS_SIZE = 512
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+MOMENT_SOURCE = 'moment-with-locales.min.js'
+
+
+# 这些字符或关键字之后的 / 是正则表达式的开始，而不是除号
+_REGEX_PREFIX_CHARS = set('(,=:[!&|?{};+-*%<>~^')
+_REGEX_PREFIX_WORDS = re.compile(r'(?<![\w$])(return|typeof|case|void|throw|in|of)\s*$')
+
+
+def _skip_string(source, i):
+    quote = source[i]
+    i += 1
+    while source[i] != quote:
+        i += 2 if source[i] == '\\' else 1
+    return i + 1
+
+
+def _skip_regex(source, i):
+    i += 1
+    in_class = False
+    while in_class or source[i] != '/':
+        if source[i] == '\\':
+            i += 1
+        elif source[i] == '[':
+            in_class = True
+        elif source[i] == ']':
+            in_class = False
+        i += 1
+    i += 1
+    while i < len(source) and source[i].isalpha():
+        i += 1
+    return i
+
+
+def _match_paren(source, i):
+    """返回与 source[i] 处的左括号匹配的右括号位置，跳过字符串和正则表达式中的括号"""
+    depth = 0
+    prev = ''
+    while i < len(source):
+        c = source[i]
+        if c in '"\'':
+            i = _skip_string(source, i)
+            prev = c
+            continue
+        if c == '/' and (prev in _REGEX_PREFIX_CHARS or _REGEX_PREFIX_WORDS.search(source[max(0, i - 10):i])):
+            i = _skip_regex(source, i)
+            prev = '/'
+            continue
+        if c in '([{':
+            depth += 1
+        elif c in ')]}':
+            depth -= 1
+            if depth == 0:
+                return i
+        if not c.isspace():
+            prev = c
+        i += 1
+    raise ValueError('Unbalanced parentheses at %d.' % i)
+
+
+def trim_moment(source, locales):
+    """从 moment-with-locales.min.js 中去掉 locales 以外的语言
+
+    把每个 a.defineLocale("xx", {...}) 调用替换为 0，压缩后的代码中这些调用都位于逗号表达式
+    或单独的语句中，替换后语法不变；语言使用的辅助变量仍会保留。
+    """
+    marker = 'a.defineLocale("'
+    parts = []
+    last = 0
+    found = set()
+    for m in re.finditer(re.escape(marker), source):
+        start = m.start()
+        name = source[start + len(marker):source.index('"', start + len(marker))]
+        if name in locales:
+            found.add(name)
+            continue
+        end = _match_paren(source, start + len(marker) - 2)
+        parts.extend([source[last:start], '0'])
+        last = end + 1
+    parts.append(source[last:])
+    missing = set(locales) - found
+    if missing:
+        raise ValueError('Unknown moment locales: %s' % ', '.join(sorted(missing)))
+    # 去掉各语言的版权说明注释
+    return re.sub(r'\n//![^\n]*', '', ''.join(parts))
+
+
+def moment_bundle_name(locales):
+    return 'moment-%s.min.js' % '-'.join(locales)
+
+
+def _is_moment_bundle(filename):
+    return filename.startswith('moment-') and filename.endswith('.min.js') and filename != MOMENT_SOURCE
+
+
+def _compress(path, data):
+    """生成 .gz 和 .br (安装了 brotli 时)，只保留比原文件小的版本，返回编码列表"""
+    encodings = []
+    variants = [('br', '.br', lambda d: brotli.compress(d, quality=11))] if brotli is not None else []
+    variants.append(('gzip', '.gz', lambda d: gzip.compress(d, 9, mtime=0)))
+    for encoding, ext, compress in variants:
+        compressed = compress(data)
+        if len(compressed) < len(data):
+            with open(path + ext, 'wb') as f:
+                f.write(compressed)
+            encodings.append(encoding)
+    return encodings
+
+
+def build(static_folder, target, moment_locales=('zh-cn',)):
+    """构建静态文件：文件名加入内容摘要并预压缩，生成精简的 Moment，最后写入清单
+
+    所有输出只写入构建目录 target，不修改 static_folder；精简的 Moment 只存在于构建结果中，
+    清单把 moment-<语言>.min.js 映射到它。已有的构建结果不会删除，使用旧页面缓存的客户端仍能取到旧文件。
+    返回清单。
+    """
+    files = {}
+    encodings = {}
+    target = os.path.abspath(target)
+
+    def add(filename, data):
+        base, ext = os.path.splitext(filename)
+        hashed = '%s.%s%s' % (base, hashlib.sha256(data).hexdigest()[:12], ext)
+        output = os.path.join(target, hashed)
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        if not os.path.exists(output):
+            # 先写临时文件再原子替换，正在运行的程序不会读到写了一半的文件
+            with open(output + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(output + '.tmp', output)
+        url = '%s/%s' % (DIST, hashed)
+        files[filename] = url
+        if ext in COMPRESSIBLE and len(data) >= MIN_COMPRESS_SIZE:
+            encodings[url] = _compress(output, data)
+
+    for root, dirs, names in os.walk(static_folder):
+        # 跳过构建目录本身
+        dirs[:] = sorted(d for d in dirs if os.path.abspath(os.path.join(root, d)) != target)
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                add(os.path.relpath(path, static_folder).replace(os.sep, '/'), f.read())
+
+    with open(os.path.join(static_folder, MOMENT_SOURCE), encoding='utf-8') as f:
+        bundle = trim_moment(f.read(), moment_locales)
+    add(moment_bundle_name(moment_locales), bundle.encode('utf-8'))
+
+    version = hashlib.sha256(json.dumps(files, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    manifest = {'version': version, 'files': files, 'encodings': encodings}
+    with open(os.path.join(target, MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+class Assets(object):
+    """使用构建清单中的带摘要文件名
+
+    url_for('static', filename='style.css') 生成 /static/dist/style.<摘要>.css，
+    这些文件的内容永远不变，以 immutable 缓存一年；客户端支持时直接发送预压缩的 .br / .gz。
+    没有构建清单时 (如开发环境) 保持 Flask 默认行为，只存在于构建结果中的精简 Moment
+    (moment-zh-cn.min.js) 改用完整的 moment-with-locales.min.js。
+    """
+
+    def init_app(self, app):
+        self.load(app)
+        app.url_defaults(self._hashed_url)
+        app.view_functions['static'] = self.send_static
+
+    def load(self, app):
+        """读取构建清单，重新构建后调用"""
+        manifest = {'version': '', 'files': {}, 'encodings': {}}
+        if app.config['WATCHLIST_ASSETS']:
+            path = os.path.join(app.config['WATCHLIST_ASSETS_DIR'], MANIFEST)
+            try:
+                with open(path, encoding='utf-8') as f:
+                    manifest = json.load(f)
+            except FileNotFoundError:
+                pass
+        manifest['hashed'] = set(manifest['files'].values())
+        app.extensions['watchlist_assets'] = manifest
+        return manifest
+
+    @staticmethod
+    def _hashed_url(endpoint, values):
+        if endpoint == 'static' and 'filename' in values:
+            files = current_app.extensions['watchlist_assets']['files']
+            hashed = files.get(values['filename'])
+            if hashed is None and _is_moment_bundle(values['filename']):
+                hashed = files.get(MOMENT_SOURCE, MOMENT_SOURCE)
+            if hashed is not None:
+                values['filename'] = hashed
+
+    @staticmethod
+    def send_static(filename):
+        manifest = current_app.extensions['watchlist_assets']
+        if filename not in manifest['hashed']:
+            return current_app.send_static_file(filename)
+
+        directory = current_app.config['WATCHLIST_ASSETS_DIR']
+        name = filename[len(DIST) + 1:]
+        mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        available = manifest['encodings'].get(filename, [])
+        for encoding, ext in (('br', '.br'), ('gzip', '.gz')):
+            if encoding in available and encoding in request.accept_encodings:
+                response = send_from_directory(directory, name + ext, mimetype=mimetype)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(directory, name, mimetype=mimetype)
+        if available:
+            response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = IMMUTABLE
+        return response
+
+
+assets = Assets()
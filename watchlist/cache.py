@@ -0,0 +1,472 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from datetime import datetime
+from functools import wraps, lru_cache
+from urllib.parse import urlencode
+
+from flask import current_app, has_app_context, request, session
+from flask_login import current_user
+from werkzeug.local import LocalProxy
+
+from watchlist import app_extension
+
+
+class VersionStamps(object):
+    """数据版本戳
+
+    每个名字对应 WATCHLIST_STAMP_DIR 下的一个空文件，版本号即文件的修改时间 (纳秒)。
+    写操作调用 bump() 更新版本，读取只需一次 stat，多个 worker 进程共享同一目录，
+    无需查询数据库就能知道数据是否变化。
+    """
+
+    def _path(self, name):
+        return os.path.join(current_app.config['WATCHLIST_STAMP_DIR'], name + '.stamp')
+
+    def get(self, name):
+        try:
+            return os.stat(self._path(name)).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def bump(self, name):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        now = time.time_ns()
+        with open(path, 'a'):
+            os.utime(path, ns=(now, now))
+        return now
+
+
+stamps = VersionStamps()
+
+
+def movie_stamp(user_id):
+    """用户 user_id 的电影清单的版本戳，修改一个用户的清单不会让其他用户的页面失效
+
+    'movie' 版本戳仍表示所有用户的电影 (initdb、recount 等命令)，清单页面同时依赖两者。
+    """
+    return 'movie-%d' % user_id
+
+
+def _stamp_versions(tables, kwargs):
+    # tables 中的可调用对象以视图参数调用，返回按请求确定的版本戳名
+    return tuple(stamps.get(table(**kwargs) if callable(table) else table) for table in tables)
+
+
+class LRUCache(object):
+    """线程安全的 LRU 缓存，条目可设置存活时间 (秒)，并统计命中率"""
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def reset_stats(self):
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+# 模板中展示所需的用户数据
+Owner = namedtuple('Owner', ['id', 'name', 'username'])
+
+
+class OwnerCache(object):
+    """进程内缓存站点所有者 (第一个用户) 以及按用户名查找的清单所有者
+
+    缓存与 'user' 版本戳绑定，版本变化时才重新查询数据库。每个程序实例一个 (见 owner_cache)。
+    """
+
+    def __init__(self, app):
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._owner = None
+        self.users = LRUCache(app.config['WATCHLIST_OWNER_CACHE_SIZE'])
+
+    def _sync(self):
+        # 先读版本戳再查询，查询期间发生的更新会在下一次调用时被发现
+        stamp = stamps.get('user')
+        if stamp != self._stamp:
+            owner = self._load()
+            with self._lock:
+                self._owner, self._stamp = owner, stamp
+                self.users.clear()
+
+    def get(self):
+        self._sync()
+        return self._owner
+
+    def find(self, username):
+        """按用户名查找，用户不存在时返回 None"""
+        self._sync()
+        owner = self.users.get(username)
+        if owner is None:
+            owner = self._load(username)
+            if owner is not None:
+                self.users.set(username, owner)
+        return owner
+
+    def for_request(self, username=None):
+        """页面展示的清单所有者：指定的用户，否则为已登录用户，匿名访问时为站点所有者"""
+        if username is not None:
+            return self.find(username)
+        if current_user.is_authenticated:
+            return Owner(current_user.id, current_user.name, current_user.username)
+        return self.get()
+
+    def _load(self, username=None):
+        from watchlist.models import User
+        query = User.query.with_entities(User.id, User.name, User.username)
+        if username is not None:
+            query = query.filter(User.username == username)
+        row = query.order_by(User.id).first()
+        return Owner(*row) if row is not None else None
+
+    def invalidate(self):
+        """用户数据写入后调用，通知所有进程重新加载"""
+        stamps.bump('user')
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._owner, self._stamp = None, None
+            self.users.clear()
+
+
+owner_cache = LocalProxy(lambda: app_extension('watchlist_owner_cache', OwnerCache))
+
+
+class UserCache(object):
+    """user_loader 使用的用户缓存
+
+    只缓存列数据，每次请求用 merge(load=False) 把对象放回当前会话的 identity map，
+    这样无需查询数据库，current_user 也能像普通的持久化对象一样修改和提交。
+    缓存同样绑定 'user' 版本戳，任何进程修改用户后所有进程都会清空缓存。每个程序实例一个 (见 user_cache)。
+    """
+
+    def __init__(self, app):
+        self.lru = LRUCache(app.config['WATCHLIST_USER_CACHE_SIZE'], app.config['WATCHLIST_USER_CACHE_TTL'])
+        self._stamp = None
+
+    def get(self, user_id):
+        from sqlalchemy.orm import make_transient_to_detached
+        from watchlist import db
+        from watchlist.models import User
+
+        stamp = stamps.get('user')
+        if stamp != self._stamp:
+            self.lru.clear()
+            self._stamp = stamp
+
+        data = self.lru.get(user_id)
+        if data is None:
+            user = User.query.get(user_id)
+            if user is not None:
+                self.lru.set(user_id, {c.key: getattr(user, c.key) for c in User.__table__.columns})
+            return user
+
+        user = User(**data)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def invalidate(self, user_id):
+        self.lru.delete(user_id)
+
+    def clear(self):
+        self.lru.clear()
+        self.lru.reset_stats()
+        self._stamp = None
+
+    def stats(self):
+        """命中率等统计数据"""
+        return self.lru.stats()
+
+
+user_cache = LocalProxy(lambda: app_extension('watchlist_user_cache', UserCache))
+
+
+class MemoryBackend(object):
+    """进程内 LRU 后端 (默认)"""
+
+    def __init__(self, maxsize):
+        self.lru = LRUCache(maxsize)
+
+    def get(self, key):
+        return self.lru.get(key)
+
+    def set(self, key, value):
+        self.lru.set(key, value)
+
+    def delete(self, key):
+        self.lru.delete(key)
+
+    def clear(self):
+        self.lru.clear()
+
+    def stats(self):
+        return self.lru.stats()
+
+
+class FileBackend(object):
+    """文件后端，多个 worker 进程共享同一目录
+
+    目录放在 /dev/shm 下即相当于共享内存缓存。条目数超过 maxsize 时删除修改时间最早的文件，
+    目录 (以及 /dev/shm 占用的内存) 不会无限增长。
+    """
+
+    def __init__(self, directory, maxsize=256):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _entries(self):
+        # 以 . 开头的是正在写入的临时文件
+        return [entry for entry in os.scandir(self.directory) if not entry.name.startswith('.')]
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.PickleError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        # 先写临时文件再原子替换，其他进程不会读到写了一半的文件
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self._path(key))
+        self._evict()
+
+    def _evict(self):
+        entries = self._entries()
+        if len(entries) <= self.maxsize:
+            return
+        oldest = []
+        for entry in entries:
+            try:
+                oldest.append((entry.stat().st_mtime_ns, entry.path))
+            except FileNotFoundError:
+                pass
+        oldest.sort()
+        for _, path in oldest[:len(oldest) - self.maxsize]:
+            self._remove(path)
+
+    @staticmethod
+    def _remove(path):
+        # 其他进程可能已经删除了同一个文件
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def delete(self, key):
+        self._remove(self._path(key))
+
+    def clear(self):
+        for entry in self._entries():
+            self._remove(entry.path)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+class ResponseCache(object):
+    """匿名 GET 请求的整页响应缓存
+
+    每个条目记录生成时所依赖数据表的版本戳，读取时版本戳不一致即视为失效，
+    因此写操作只需 bump 对应表的版本戳就能精确地让相关页面失效。
+    后端由 WATCHLIST_RESPONSE_CACHE 选择：memory (默认)、file 或 null (关闭)，
+    两种后端都最多保存 WATCHLIST_RESPONSE_CACHE_SIZE 个页面。后端按程序实例保存在 app.extensions 中。
+    """
+
+    @staticmethod
+    def _create(app):
+        config = app.config
+        kind = config['WATCHLIST_RESPONSE_CACHE']
+        backend = None
+        if kind == 'memory':
+            backend = MemoryBackend(config['WATCHLIST_RESPONSE_CACHE_SIZE'])
+        elif kind == 'file':
+            backend = FileBackend(config['WATCHLIST_RESPONSE_CACHE_DIR'], config['WATCHLIST_RESPONSE_CACHE_SIZE'])
+        elif kind != 'null':
+            raise ValueError('Unknown response cache backend: %r' % kind)
+        return {'backend': backend}
+
+    @property
+    def backend(self):
+        return app_extension('watchlist_response_cache', self._create)['backend']
+
+    def cached(self, *tables, args=()):
+        """视图装饰器，tables 为页面内容所依赖的数据表 (或以视图参数调用、返回版本戳名的函数)，
+        args 为视图读取的查询参数
+
+        缓存键只包含 args 中的参数，附加其他参数的请求共用同一个条目，不会产生新的缓存条目。
+        """
+        names = args
+
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                backend = self.backend
+                # 已登录用户或有待显示的闪现消息时，页面内容因人而异，不缓存
+                if backend is None or request.method != 'GET' or '_flashes' in session \
+                        or current_user.is_authenticated:
+                    return f(*args, **kwargs)
+
+                key = request.path + '?' + urlencode([(name, request.args[name])
+                                                      for name in names if name in request.args])
+                # 在生成页面前读取版本戳，生成期间发生的写入会让该条目立即失效
+                versions = _stamp_versions(tables, kwargs)
+                entry = backend.get(key)
+                if entry is not None:
+                    if entry[0] == versions:
+                        _, body, status, headers = entry
+                        return current_app.response_class(body, status, headers)
+                    # 过期的条目立即删除，即使新页面不能缓存 (如 404) 也不会一直占用空间
+                    backend.delete(key)
+
+                response = current_app.make_response(f(*args, **kwargs))
+                if response.status_code == 200 and not response.is_streamed:
+                    backend.set(key, (versions, response.get_data(), response.status_code,
+                                      list(response.headers.items())))
+                return response
+            return decorated_function
+        return decorator
+
+    def clear(self):
+        """清空当前程序实例的缓存，下次使用时按当前配置重新创建后端"""
+        if not has_app_context():
+            return
+        state = current_app.extensions.pop('watchlist_response_cache', None)
+        if state is not None and state['backend'] is not None:
+            state['backend'].clear()
+
+    def stats(self):
+        state = current_app.extensions.get('watchlist_response_cache')
+        return state['backend'].stats() if state is not None and state['backend'] is not None else {}
+
+
+response_cache = ResponseCache()
+
+
+@lru_cache(maxsize=None)
+def _templates_digest(directory):
+    """模板文件内容的摘要，部署新模板后 ETag 随之改变"""
+    digest = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(directory)):
+        for name in sorted(files):
+            with open(os.path.join(root, name), 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def conditional(*tables):
+    """视图装饰器，为 GET 响应添加 ETag / Last-Modified，并在内容未变化时返回 304
+
+    ETag 由请求路径、登录身份、模板摘要、静态文件清单版本以及 tables 的版本戳计算得出，
+    判断是否返回 304 只需读取版本戳，不会访问数据库。tables 的含义与 ResponseCache.cached() 相同。
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            # 有待显示的闪现消息时页面内容会变化，不能返回 304
+            if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+                return f(*args, **kwargs)
+
+            versions = list(_stamp_versions(tables, kwargs))
+            digest = hashlib.sha1()
+            for part in [request.full_path, session.get('_user_id', ''),
+                         _templates_digest(os.path.join(current_app.root_path, current_app.template_folder)),
+                         current_app.extensions.get('watchlist_assets', {}).get('version', '')] + versions:
+                digest.update(str(part).encode('utf-8') + b'\0')
+            etag = digest.hexdigest()
+            # HTTP 日期只精确到秒：向上取整，并且在这一秒过去之前不发送 Last-Modified，
+            # 否则同一秒内的第二次写入之后，只带 If-Modified-Since 的客户端会得到过期的 304
+            last_modified = None
+            if any(versions):
+                seconds = -(-max(versions) // 10 ** 9)
+                if seconds <= time.time():
+                    last_modified = datetime.utcfromtimestamp(seconds)
+
+            if etag in request.if_none_match or (
+                    not request.if_none_match and last_modified is not None
+                    and request.if_modified_since is not None
+                    and request.if_modified_since.replace(tzinfo=None) >= last_modified):
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            # 浏览器和 CDN 每次都需要验证，验证通过时只返回 304
+            response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+            return response
+        return decorated_function
+    return decorator
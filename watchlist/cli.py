@@ -0,0 +1,51 @@
+import importlib
+
+import click
+
+
+# 命令名: (命令对象的导入路径, 简短说明)
+# `flask --help` 只读取这里的说明，执行某个命令时才导入 watchlist.commands
+COMMANDS = {
+    'initdb': ('watchlist.commands:initdb', 'Initialize the database.'),
+    'forge': ('watchlist.commands:forge', 'Generate fake data.'),
+    'admin': ('watchlist.commands:admin', 'Create user.'),
+    'create-user': ('watchlist.commands:create_user', 'Create another user with their own watchlist.'),
+    'migrate-owners': ('watchlist.commands:migrate_owners',
+                       'Add movie owners to an existing database and backfill them in batches.'),
+    'check-db': ('watchlist.commands:check_db', 'Show the SQLite pragmas in effect on a pooled connection.'),
+    'reindex': ('watchlist.commands:reindex', 'Rebuild the full-text search index.'),
+    'recount': ('watchlist.commands:recount', 'Check or repair the movie and message counters.'),
+    'compile-templates': ('watchlist.commands:compile_templates',
+                          'Compile all templates into the Jinja bytecode cache.'),
+    'build-assets': ('watchlist.commands:build_assets', 'Build fingerprinted and precompressed static files.'),
+    'import-movies': ('watchlist.commands:import_movies', 'Import movies from a CSV or JSON Lines file.'),
+    'export-movies': ('watchlist.commands:export_movies', 'Export movies to a CSV or JSON Lines file.'),
+    'import-messages': ('watchlist.commands:import_messages',
+                        'Import guestbook messages from a CSV or JSON Lines file.'),
+    'export-messages': ('watchlist.commands:export_messages',
+                        'Export guestbook messages to a CSV or JSON Lines file.'),
+    'archive-messages': ('watchlist.commands:archive_messages',
+                         'Move old guestbook messages to the archive and reclaim the space.'),
+}
+
+
+def load_command(import_path):
+    module, name = import_path.split(':')
+    return getattr(importlib.import_module(module), name)
+
+
+class LazyCommand(click.Command):
+    """命令的占位对象：列出命令时只提供名称和说明，解析参数时才导入真正的命令"""
+
+    def __init__(self, name, import_path, help):
+        super(LazyCommand, self).__init__(name, help=help)
+        self.import_path = import_path
+
+    def make_context(self, info_name, args, parent=None, **extra):
+        # 返回真正命令的上下文，之后的 invoke 直接交给真正的命令处理
+        return load_command(self.import_path).make_context(info_name, args, parent=parent, **extra)
+
+
+def init_app(app):
+    for name, (import_path, help) in COMMANDS.items():
+        app.cli.add_command(LazyCommand(name, import_path, help))
@@ -1,12 +1,30 @@
+import csv
+import json
+import os
+import time
+from datetime import datetime, timezone
+
 import click
+from flask import current_app
+from flask.cli import with_appcontext
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
 
-from watchlist import app, db
-from watchlist.models import User, Movie
+from watchlist import db
+from watchlist.models import User, Movie, Message, ArchivedMessage
+from watchlist.cache import stamps, movie_stamp, owner_cache
+from watchlist.sqlite import check_pragmas
+from watchlist.search import reindex as rebuild_search_index
+from watchlist.templating import warm_up
+from watchlist import counters, archive
+from watchlist.assets import assets, build as build_static_assets
 
 
 # 自定义命令
-@app.cli.command()
+@click.command()
 @click.option('--drop', is_flag=True, help='Create after drop.')
+@with_appcontext
 def initdb(drop):
     """Initialize the database."""
 
@@ -14,16 +32,23 @@ def initdb(drop):
         db.drop_all()
     db.create_all()
 
+    # 数据可能已被重建，使所有缓存与 ETag 失效
+    stamps.bump('movie')
+    stamps.bump('message')
+    owner_cache.invalidate()
+
     # 操作完成后显示提示信息
     click.echo('Initialized database.')
 
 
-@app.cli.command()
+@click.command()
+@with_appcontext
 def forge():
     """Generate fake data."""
     db.create_all()
 
     name = 'Whxcer'
+    username = 'whxcer'
     movies = [
         {'title': '两杆大烟枪', 'year': '1998'},
         {'title': '偷拐抢骗', 'year': '2000'},
@@ -43,25 +68,35 @@ def forge():
         {'title': '流浪地球', 'year': '2019'},
     ]
 
-    user = User(name=name)
-    db.session.add(user)
+    # 清单页面为 /user/whxcer；之后执行 flask admin 可以修改用户名和密码
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        user = User(name=name, username=username)
+        db.session.add(user)
 
     for m in movies:
-        movie = Movie(title=m['title'], year=m['year'])
+        movie = Movie(title=m['title'], year=m['year'], user=user)
         db.session.add(movie)
 
     db.session.commit()
+    stamps.bump(movie_stamp(user.id))
+    owner_cache.invalidate()
     click.echo('Done.')
 
 
-@app.cli.command()
+@click.command()
 @click.option('--username', prompt=True, help='The username used to login.')
 @click.option('--password', prompt=True, hide_input=True, confirmation_prompt=True, help='The password used to login.')
+@with_appcontext
 def admin(username, password):
     """Create user."""
     db.create_all()
 
     user = User.query.first()
+    # username 有唯一索引
+    existing = User.query.filter_by(username=username).first()
+    if existing is not None and existing is not user:
+        raise click.ClickException('User %s already exists.' % username)
     if user is not None:
         click.echo('Updating user...')
         user.username = username
@@ -73,5 +108,389 @@ def admin(username, password):
         db.session.add(user)
 
     db.session.commit()
+    owner_cache.invalidate()
     click.echo('Done.')
 
+
+@click.command('create-user')
+@click.option('--username', prompt=True, help='The username used to login.')
+@click.option('--password', prompt=True, hide_input=True, confirmation_prompt=True, help='The password used to login.')
+@click.option('--name', help='The name shown on the watchlist, same as the username by default.')
+@with_appcontext
+def create_user(username, password, name):
+    """Create another user with their own watchlist."""
+    name = name or username
+    if len(username) > 20 or len(name) > 20:
+        raise click.ClickException('The username and name must be at most 20 characters.')
+    if User.query.filter_by(username=username).first() is not None:
+        raise click.ClickException('User %s already exists.' % username)
+
+    user = User(username=username, name=name)
+    user.set_password(password)
+    db.session.add(user)
+    db.session.commit()
+    owner_cache.invalidate()
+    click.echo('Created user %s, watchlist at /user/%s.' % (username, username))
+
+
+def _find_user(username=None):
+    """按用户名查找用户，未指定时为站点所有者 (第一个用户)"""
+    if username:
+        user = User.query.filter_by(username=username).first()
+    else:
+        user = User.query.order_by(User.id).first()
+    if user is None:
+        raise click.ClickException('User %s not found.' % username if username else
+                                   'No user yet, create one with flask admin.')
+    return user
+
+
+@click.command('check-db')
+@with_appcontext
+def check_db():
+    """Show the SQLite pragmas in effect on a pooled connection."""
+    config = current_app.config
+    pragmas = config['WATCHLIST_SQLITE_PRAGMAS'] if config['WATCHLIST_SQLITE_TUNING'] else {}
+    click.echo('%s: %s' % (type(db.engine.pool).__name__, db.engine.pool.status()))
+    with db.engine.connect() as connection:
+        results = check_pragmas(connection, pragmas)
+        auto_vacuum = connection.execute('PRAGMA auto_vacuum').scalar()
+
+    for name, expected, actual, ok in results:
+        click.echo('%-14s %-12s %s' % (name, actual, 'OK' if ok else 'MISMATCH (expected %s)' % expected))
+    # 只影响能否回收空闲页，不算配置错误
+    click.echo('%-14s %-12s %s' % ('auto_vacuum', auto_vacuum, 'incremental' if auto_vacuum == 2 else
+                                   'run flask archive-messages --vacuum to enable incremental vacuum'))
+    if not all(ok for _, _, _, ok in results):
+        raise click.ClickException('Some pragmas are not in effect.')
+
+
+@click.command()
+@with_appcontext
+def reindex():
+    """Rebuild the full-text search index."""
+    start = time.perf_counter()
+    try:
+        counts = rebuild_search_index()
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    for table, count in counts.items():
+        click.echo('Indexed %d %s rows.' % (count, table))
+    click.echo('Done in %.2fs.' % (time.perf_counter() - start))
+
+
+@click.command()
+@click.option('--check', is_flag=True, help='Only report mismatches, exit with status 1 if any.')
+@with_appcontext
+def recount(check):
+    """Check or repair the movie and message counters."""
+    results = counters.check() if check else counters.recount()
+    for name, stored, actual in results:
+        click.echo('%-8s counter %-8s rows %-8d %s' % (name, stored, actual, 'OK' if stored == actual else 'MISMATCH'))
+    if check and any(stored != actual for _, stored, actual in results):
+        raise click.ClickException('Counters are out of date, run flask recount to repair them.')
+    if not check:
+        stamps.bump('movie')
+        stamps.bump('message')
+        click.echo('Done.')
+
+
+@click.command('compile-templates')
+@click.option('--cache-dir', help='Bytecode cache directory, WATCHLIST_TEMPLATE_CACHE_DIR by default.')
+@with_appcontext
+def compile_templates(cache_dir):
+    """Compile all templates into the Jinja bytecode cache."""
+    cache_dir = cache_dir or current_app.config['WATCHLIST_TEMPLATE_CACHE_DIR']
+    if not cache_dir:
+        raise click.ClickException('Set WATCHLIST_TEMPLATE_CACHE_DIR or pass --cache-dir.')
+
+    # 使用新的 Environment，保证每个模板都会重新编译并写入缓存
+    os.makedirs(cache_dir, exist_ok=True)
+    env = current_app.create_jinja_environment()
+    env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    start = time.perf_counter()
+    names = warm_up(env)
+    click.echo('Compiled %d templates into %s in %.2fs.' % (len(names), cache_dir, time.perf_counter() - start))
+
+
+@click.command('build-assets')
+@with_appcontext
+def build_assets():
+    """Build fingerprinted and precompressed static files."""
+    target = current_app.config['WATCHLIST_ASSETS_DIR']
+    start = time.perf_counter()
+    manifest = build_static_assets(current_app.static_folder, target)
+    for filename, hashed in sorted(manifest['files'].items()):
+        path = os.path.join(target, hashed.split('/', 1)[1])
+        sizes = ['%d' % os.path.getsize(path)] + ['%s %d' % (ext[1:], os.path.getsize(path + ext))
+                                                  for ext in ('.gz', '.br') if os.path.exists(path + ext)]
+        click.echo('%-28s -> %s (%s)' % (filename, hashed, ', '.join(sizes)))
+    assets.load(current_app)
+    click.echo('Built %d files into %s in %.2fs.' % (len(manifest['files']), target, time.perf_counter() - start))
+
+
+# 批量导入导出
+def _guess_format(path, fmt):
+    if fmt is not None:
+        return fmt
+    return 'csv' if os.path.splitext(path)[1].lower() == '.csv' else 'jsonl'
+
+
+def _read_rows(path, fmt):
+    """逐行读取 CSV 或 JSON Lines 文件，内存占用与文件大小无关；无法解析的行返回 None"""
+    with open(path, encoding='utf-8', newline='') as f:
+        if fmt == 'csv':
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        yield None
+
+
+def _text(value, max_length):
+    """非空且不超长的字符串原样返回，否则 (包括 JSON 中的数字、列表等) 返回 None"""
+    if isinstance(value, str) and value and len(value) <= max_length:
+        return value
+    return None
+
+
+def _clean_movie(row):
+    title, year = _text(row.get('title'), 60), row.get('year')
+    # JSON 中的年份可以是整数
+    if isinstance(year, int) and not isinstance(year, bool):
+        year = str(year)
+    year = _text(year, 4)
+    if title is None or year is None:
+        return None
+    return {'title': title, 'year': year}
+
+
+def _clean_message(row):
+    name, body, timestamp = _text(row.get('name'), 20), _text(row.get('body'), 200), row.get('timestamp')
+    if name is None or body is None:
+        return None
+    try:
+        timestamp = datetime.fromisoformat(timestamp) if timestamp else datetime.utcnow()
+    except (TypeError, ValueError):
+        return None
+    # 程序中的时间都是不带时区的 UTC 时间 (datetime.utcnow())
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return {'name': name, 'body': body, 'timestamp': timestamp}
+
+
+def _bulk_import(model, rows, clean, batch_size):
+    """按批次用 executemany 插入数据，每批提交一次"""
+    table = model.__table__
+    start = time.perf_counter()
+    imported = skipped = 0
+    batch = []
+
+    def flush():
+        nonlocal imported
+        db.session.execute(table.insert(), batch)
+        db.session.commit()
+        imported += len(batch)
+        batch.clear()
+        click.echo('  %d rows imported...' % imported)
+
+    for row in rows:
+        # 无法解析的行，或 JSON 中不是对象的行
+        row = clean(row) if isinstance(row, dict) else None
+        if row is None:
+            skipped += 1
+            continue
+        batch.append(row)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    elapsed = time.perf_counter() - start
+    click.echo('Imported %d rows, skipped %d invalid rows in %.2fs (%d rows/s).'
+               % (imported, skipped, elapsed, imported / elapsed if elapsed else 0))
+    return imported
+
+
+def _bulk_export(columns, path, fmt, batch_size, where=None):
+    """按主键顺序分批读取并写出，内存占用与表大小无关"""
+    fields = [column.key for column in columns]
+    query = db.session.query(*columns)
+    if where is not None:
+        query = query.filter(where)
+    query = query.order_by(columns[0]).yield_per(batch_size)
+    start = time.perf_counter()
+    exported = 0
+
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f) if fmt == 'csv' else None
+        if writer is not None:
+            writer.writerow(fields)
+        for row in query:
+            values = [v.isoformat() if isinstance(v, datetime) else v for v in row]
+            if writer is not None:
+                writer.writerow(values)
+            else:
+                f.write(json.dumps(dict(zip(fields, values)), ensure_ascii=False) + '\n')
+            exported += 1
+            if exported % batch_size == 0:
+                click.echo('  %d rows exported...' % exported)
+
+    elapsed = time.perf_counter() - start
+    click.echo('Exported %d rows in %.2fs (%d rows/s).' % (exported, elapsed, exported / elapsed if elapsed else 0))
+    return exported
+
+
+format_option = click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+                             help='File format, guessed from the file extension by default.')
+batch_size_option = click.option('--batch-size', default=5000, show_default=True, help='Rows per batch.')
+
+
+@click.command('import-movies')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--username', help='Owner of the imported movies, the first user by default.')
+@format_option
+@batch_size_option
+@with_appcontext
+def import_movies(path, username, fmt, batch_size):
+    """Import movies from a CSV or JSON Lines file."""
+    db.create_all()
+    user_id = _find_user(username).id
+
+    def clean(row):
+        row = _clean_movie(row)
+        if row is not None:
+            row['user_id'] = user_id
+        return row
+
+    _bulk_import(Movie, _read_rows(path, _guess_format(path, fmt)), clean, batch_size)
+    stamps.bump(movie_stamp(user_id))
+
+
+@click.command('export-movies')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--username', help='Only export the movies of this user.')
+@format_option
+@batch_size_option
+@with_appcontext
+def export_movies(path, username, fmt, batch_size):
+    """Export movies to a CSV or JSON Lines file."""
+    where = Movie.user_id == _find_user(username).id if username else None
+    _bulk_export([Movie.id, Movie.title, Movie.year], path, _guess_format(path, fmt), batch_size, where)
+
+
+@click.command('import-messages')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@format_option
+@batch_size_option
+@with_appcontext
+def import_messages(path, fmt, batch_size):
+    """Import guestbook messages from a CSV or JSON Lines file."""
+    db.create_all()
+    _bulk_import(Message, _read_rows(path, _guess_format(path, fmt)), _clean_message, batch_size)
+    stamps.bump('message')
+
+
+@click.command('export-messages')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@format_option
+@batch_size_option
+@with_appcontext
+def export_messages(path, fmt, batch_size):
+    """Export guestbook messages to a CSV or JSON Lines file."""
+    _bulk_export([Message.id, Message.name, Message.body, Message.timestamp], path,
+                 _guess_format(path, fmt), batch_size)
+
+
+@click.command('archive-messages')
+@click.option('--max-age', type=int, help='Keep messages from the last N days, WATCHLIST_MESSAGE_MAX_AGE by default.')
+@click.option('--max-rows', type=int, help='Keep the newest N messages, WATCHLIST_MESSAGE_MAX_ROWS by default.')
+@click.option('--vacuum', is_flag=True,
+              help='Rebuild the database file with VACUUM, also enables incremental vacuum on old databases.')
+@batch_size_option
+@with_appcontext
+def archive_messages(max_age, max_rows, vacuum, batch_size):
+    """Move old guestbook messages to the archive and reclaim the space."""
+    config = current_app.config
+    max_age = config['WATCHLIST_MESSAGE_MAX_AGE'] if max_age is None else max_age
+    max_rows = config['WATCHLIST_MESSAGE_MAX_ROWS'] if max_rows is None else max_rows
+    if not max_age and not max_rows:
+        raise click.ClickException('No retention policy, set --max-age or --max-rows.')
+    # 旧数据库没有归档表
+    ArchivedMessage.__table__.create(db.engine, checkfirst=True)
+
+    start = time.perf_counter()
+    moved = 0
+    cutoff = archive.boundary(max_age, max_rows)
+    if cutoff is not None:
+        moved = archive.archive(cutoff, batch_size, lambda n: click.echo('  %d messages archived...' % n))
+    if moved:
+        stamps.bump('message')
+        stamps.bump('archive')
+    click.echo('Archived %d messages in %.2fs.' % (moved, time.perf_counter() - start))
+
+    # 不需要归档时也执行：可用于定期 (如 cron) 整理数据库
+    before, after = archive.compact(vacuum)
+    click.echo('Free pages: %d -> %d.' % (before, after))
+
+
+@click.command('migrate-owners')
+@click.option('--username', help='Owner of the existing movies, the first user by default.')
+@batch_size_option
+@with_appcontext
+def migrate_owners(username, batch_size):
+    """Add movie owners to an existing database and backfill them in batches."""
+    db.create_all()
+    # create_all() 不会修改已有的表：补上 user_id 列以及新增的索引
+    if 'user_id' not in {column['name'] for column in inspect(db.engine).get_columns('movie')}:
+        db.session.execute('ALTER TABLE movie ADD COLUMN user_id INTEGER REFERENCES user (id)')
+        db.session.commit()
+        click.echo('Added column movie.user_id.')
+    for table in (User.__table__, Movie.__table__):
+        existing = {index['name'] for index in inspect(db.engine).get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name in existing:
+                continue
+            try:
+                index.create(db.engine)
+            except IntegrityError:
+                raise click.ClickException('Cannot create %s, usernames must be unique.' % index.name)
+            click.echo('Created index %s.' % index.name)
+    # 复合索引都以 user_id 开头，旧版本的单列索引只会增加写入开销
+    existing = {index['name'] for index in inspect(db.engine).get_indexes('movie')}
+    for name in ('ix_movie_title', 'ix_movie_year'):
+        if name in existing:
+            db.session.execute('DROP INDEX %s' % name)
+            db.session.commit()
+            click.echo('Dropped index %s.' % name)
+
+    user = _find_user(username)
+    # 先安装按用户计数的触发器，回填时由触发器维护每个用户的计数器
+    counters.recount()
+
+    # 按主键范围分批更新，每批一个短事务，不会长时间持有写锁
+    table = Movie.__table__
+    start = time.perf_counter()
+    last = 0
+    assigned = 0
+    while True:
+        upper = db.session.execute(
+            'SELECT max(id) FROM (SELECT id FROM movie WHERE id > :last ORDER BY id LIMIT :limit)',
+            {'last': last, 'limit': batch_size}).scalar()
+        if upper is None:
+            break
+        result = db.session.execute(
+            table.update().where(table.c.id > last).where(table.c.id <= upper)
+            .where(table.c.user_id.is_(None)).values(user_id=user.id))
+        db.session.commit()
+        assigned += result.rowcount
+        last = upper
+        click.echo('  %d movies assigned...' % assigned)
+
+    stamps.bump(movie_stamp(user.id))
+    owner_cache.invalidate()
+    click.echo('Assigned %d movies to %s in %.2fs.' % (assigned, user.username or user.name,
+                                                      time.perf_counter() - start))
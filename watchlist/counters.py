@@ -0,0 +1,138 @@
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+from watchlist import db
+from watchlist.models import Stat
+
+
+# 需要维护总数的表，计数器名即表名
+COUNTED_TABLES = ('movie', 'message')
+# 另外按用户维护总数的表，计数器名为 <表名>:<user_id>
+PER_USER_TABLES = ('movie',)
+
+
+def _trigger_statements(table):
+    # 触发器与写操作在同一事务中执行，无论数据来自视图函数、forge、导入命令还是异步写入，
+    # 计数器都与表中的行数保持一致
+    return [
+        "CREATE TRIGGER IF NOT EXISTS {table}_stat_ai AFTER INSERT ON {table} BEGIN "
+        "UPDATE stat SET value = value + 1 WHERE name = '{table}'; END",
+        "CREATE TRIGGER IF NOT EXISTS {table}_stat_ad AFTER DELETE ON {table} BEGIN "
+        "UPDATE stat SET value = value - 1 WHERE name = '{table}'; END",
+    ]
+
+
+def _user_trigger_statements(table):
+    # 计数器行在用户第一次写入时创建；user_id 为空时名称为 NULL，INSERT OR IGNORE 和 UPDATE 都不会生效
+    increment = ("INSERT OR IGNORE INTO stat (name, value) VALUES ('{table}:' || NEW.user_id, 0); "
+                 "UPDATE stat SET value = value + 1 WHERE name = '{table}:' || NEW.user_id;")
+    decrement = "UPDATE stat SET value = value - 1 WHERE name = '{table}:' || OLD.user_id;"
+    return [
+        "CREATE TRIGGER IF NOT EXISTS {table}_user_stat_ai AFTER INSERT ON {table} BEGIN %s END" % increment,
+        "CREATE TRIGGER IF NOT EXISTS {table}_user_stat_ad AFTER DELETE ON {table} BEGIN %s END" % decrement,
+        # 回填或转移数据时 user_id 会改变
+        "CREATE TRIGGER IF NOT EXISTS {table}_user_stat_au AFTER UPDATE OF user_id ON {table} "
+        "WHEN OLD.user_id IS NOT NEW.user_id BEGIN %s %s END" % (decrement, increment),
+    ]
+
+
+def _per_user(connection, table):
+    # 尚未执行 flask migrate-owners 的旧数据库没有 user_id 列，此时不能创建引用该列的触发器
+    return table in PER_USER_TABLES and any(
+        row[1] == 'user_id' for row in connection.execute('PRAGMA table_info(%s)' % table))
+
+
+def _user_counts(connection, table):
+    """返回 ({user_id: 计数器}, {user_id: 实际行数})"""
+    prefix = table + ':'
+    stored = {int(name[len(prefix):]): value for name, value in connection.execute(
+        'SELECT name, value FROM stat WHERE name LIKE ?', (prefix + '%',))}
+    actual = dict(connection.execute(
+        'SELECT user_id, count(*) FROM %s WHERE user_id IS NOT NULL GROUP BY user_id' % table).fetchall())
+    return stored, actual
+
+
+def _user_mismatches(connection, table):
+    """按用户的计数器中与实际行数不一致的项，返回 [(名称, 计数器, 实际行数)]"""
+    stored, actual = _user_counts(connection, table)
+    return [('%s:%d' % (table, user_id), stored.get(user_id), actual.get(user_id, 0))
+            for user_id in sorted(set(stored) | set(actual))
+            if stored.get(user_id, 0) != actual.get(user_id, 0)]
+
+
+def _install(connection, tables=COUNTED_TABLES):
+    """创建触发器并按实际行数重置计数器，返回 [(名称, 原计数, 实际行数)]
+
+    按用户的计数器只列出不一致的项。
+    """
+    results = []
+    for table in tables:
+        for statement in _trigger_statements(table):
+            connection.execute(statement.format(table=table))
+        stored = connection.execute('SELECT value FROM stat WHERE name = ?', (table,)).scalar()
+        actual = connection.execute('SELECT count(*) FROM %s' % table).scalar()
+        connection.execute('INSERT OR REPLACE INTO stat (name, value) VALUES (?, ?)', (table, actual))
+        results.append((table, stored, actual))
+
+        if _per_user(connection, table):
+            for statement in _user_trigger_statements(table):
+                connection.execute(statement.format(table=table))
+            results.extend(_user_mismatches(connection, table))
+            connection.execute('DELETE FROM stat WHERE name LIKE ?', (table + ':%',))
+            connection.execute("INSERT INTO stat (name, value) SELECT '%s:' || user_id, count(*) FROM %s "
+                               "WHERE user_id IS NOT NULL GROUP BY user_id" % (table, table))
+    return results
+
+
+@event.listens_for(db.metadata, 'after_create')
+def _after_create(metadata, connection, tables=(), **kw):
+    # 新建了 stat 表或被计数的表时 (包括在已有数据库上新增 stat 表)，安装触发器并初始化计数器
+    if connection.dialect.name != 'sqlite':
+        return
+    created = {table.name for table in tables}
+    if 'stat' in created or created & set(COUNTED_TABLES):
+        _install(connection)
+
+
+def get(name, user_id=None):
+    """读取计数器，O(1)；传入 user_id 时读取该用户的计数器
+
+    计数器缺失 (如非 SQLite 数据库、用户还没有数据，或旧数据库还没有执行 flask recount 创建 stat 表)
+    时退回 COUNT 查询，按用户计数时只扫描复合索引。
+    """
+    key = name if user_id is None else '%s:%d' % (name, user_id)
+    try:
+        value = db.session.query(Stat.value).filter(Stat.name == key).scalar()
+    except OperationalError:
+        # no such table: stat，SQLite 中失败的查询不会中止当前事务
+        value = None
+    if value is None:
+        table = db.metadata.tables[name]
+        query = db.select([db.func.count()]).select_from(table)
+        if user_id is not None:
+            query = query.where(table.c.user_id == user_id)
+        value = db.session.execute(query).scalar()
+    return value
+
+
+def check():
+    """比较计数器与实际行数，返回 [(名称, 计数器, 实际行数)]，没有 stat 表时计数器为 None"""
+    results = []
+    has_stat = db.engine.dialect.has_table(db.session.connection(), Stat.__tablename__)
+    for table in COUNTED_TABLES:
+        stored = db.session.query(Stat.value).filter(Stat.name == table).scalar() if has_stat else None
+        actual = db.session.execute('SELECT count(*) FROM %s' % table).scalar()
+        results.append((table, stored, actual))
+        if has_stat and _per_user(db.session.connection(), table):
+            results.extend(_user_mismatches(db.session.connection(), table))
+    db.session.rollback()
+    return results
+
+
+def recount():
+    """创建缺失的 stat 表和触发器，并在一个事务中按实际行数修复计数器"""
+    # 由不含计数器的旧版本创建的数据库没有 stat 表
+    Stat.__table__.create(db.session.connection(), checkfirst=True)
+    results = _install(db.session.connection())
+    db.session.commit()
+    return results
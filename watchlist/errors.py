@@ -1,18 +1,29 @@
-from flask import render_template
+from flask import Blueprint, render_template
 
-from watchlist import app
 
+bp = Blueprint('errors', __name__)
 
-@app.errorhandler(400)
+
+@bp.app_errorhandler(400)
 def bad_request(e):
     return render_template('errors/400.html'), 400
 
 
-@app.errorhandler(404)
+@bp.app_errorhandler(404)
 def page_not_found(e):
     return render_template('errors/404.html'), 404
 
 
-@app.errorhandler(500)
+@bp.app_errorhandler(429)
+def too_many_requests(e):
+    return render_template('errors/429.html'), 429, {'Retry-After': str(getattr(e, 'retry_after', 1))}
+
+
+@bp.app_errorhandler(500)
 def internal_server_error(e):
-    return render_template('errors/500.html'), 500
\ No newline at end of file
+    return render_template('errors/500.html'), 500
+
+
+@bp.app_errorhandler(503)
+def service_unavailable(e):
+    return render_template('errors/503.html'), 503, {'Retry-After': '1'}
@@ -0,0 +1,227 @@
+import json
+import threading
+import time
+from collections import deque, OrderedDict
+from datetime import datetime, timedelta
+
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+from watchlist import app_extension, db
+from watchlist.cache import stamps
+from watchlist.models import Message
+from watchlist.pagination import encode_cursor
+
+
+def _event(row):
+    """把一条留言 (包含 id、name、body、timestamp 的映射) 格式化为 SSE 事件
+
+    事件 id 即分页游标 <时间戳>_<id>，客户端重连时作为 Last-Event-ID 发回。
+    返回 (id, timestamp, 文本)，文本只生成一次，由所有客户端共享。
+    """
+    payload = json.dumps({
+        'id': row['id'],
+        'name': row['name'],
+        'body': row['body'],
+        'timestamp': row['timestamp'].strftime('%Y-%m-%dT%H:%M:%SZ'),
+    }, ensure_ascii=False, separators=(',', ':'))
+    return row['id'], row['timestamp'], 'id: %s\ndata: %s\n\n' % (encode_cursor(row['timestamp'], row['id']), payload)
+
+
+class Subscriber(object):
+    """一个 SSE 连接的事件缓冲区
+
+    缓冲区有界：客户端读取太慢、积压超过 maxsize 条时标记为 overflowed，
+    连接随即结束，客户端带着 Last-Event-ID 重连后从数据库补齐。
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.overflowed = False
+        self._events = deque()
+        self._cond = threading.Condition()
+
+    def put(self, events):
+        with self._cond:
+            if len(self._events) + len(events) > self.maxsize:
+                self.overflowed = True
+                self._events.clear()
+            else:
+                self._events.extend(events)
+            self._cond.notify()
+
+    def get(self, timeout):
+        """等待新事件，超时返回空列表"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._events or self.overflowed, timeout)
+            events = list(self._events)
+            self._events.clear()
+            return events
+
+
+class LiveHub(object):
+    """进程内的留言广播中心
+
+    留言提交后 (直接写入或异步批量写入) 调用 publish()，事件只格式化一次，
+    放入每个连接的缓冲区；没有连接时 publish() 不做任何事。
+    连接数超过 max_clients 时 subscribe() 返回 None，由视图函数返回 503。
+
+    每个程序实例一个 (见 hub)，只广播该实例的留言。
+    本进程的写入通过 bump() 更新 'message' 版本戳并记住这次变化，这些留言已经广播过，
+    连接发现版本戳变化时不需要查询数据库，只有其他进程的写入才会触发补查。
+    """
+
+    # 记住的本进程版本戳变化个数
+    OWN_STAMPS = 64
+
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._own = OrderedDict()
+        self.published = 0
+        self.overflows = 0
+        self.rejected = 0
+        self.catch_ups = 0
+
+    @property
+    def clients(self):
+        return len(self._subscribers)
+
+    def subscribe(self, max_clients, buffer_size):
+        with self._lock:
+            if len(self._subscribers) >= max_clients:
+                self.rejected += 1
+                return None
+            subscriber = Subscriber(buffer_size)
+            self._subscribers.add(subscriber)
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, rows):
+        """广播已提交的留言，rows 为包含 id、name、body、timestamp 的映射"""
+        if not self._subscribers or not rows:
+            return
+        events = [_event(row) for row in rows]
+        with self._lock:
+            subscribers = list(self._subscribers)
+            self.published += len(events)
+        for subscriber in subscribers:
+            overflowed = subscriber.overflowed
+            subscriber.put(events)
+            if subscriber.overflowed and not overflowed:
+                self.overflows += 1
+
+    def bump(self):
+        """本进程提交留言后更新 'message' 版本戳，记录 变化前 -> 变化后"""
+        previous = stamps.get('message')
+        current = stamps.bump('message')
+        with self._lock:
+            self._own[previous] = current
+            while len(self._own) > self.OWN_STAMPS:
+                self._own.popitem(last=False)
+        return current
+
+    def own_change(self, stamp, current):
+        """版本戳从 stamp 变为 current 是否只经过了本进程的写入"""
+        with self._lock:
+            for _ in range(self.OWN_STAMPS):
+                stamp = self._own.get(stamp)
+                if stamp is None:
+                    return False
+                if stamp == current:
+                    return True
+        return False
+
+    def stats(self):
+        return {
+            'clients': len(self._subscribers),
+            'published': self.published,
+            'overflows': self.overflows,
+            'rejected': self.rejected,
+            'catch_ups': self.catch_ups,
+        }
+
+
+hub = LocalProxy(lambda: app_extension('watchlist_live_hub', lambda app: LiveHub()))
+
+
+def _catch_up(since, limit):
+    """按 timestamp 索引取出 since 之后 (含) 的留言，超过 limit 条时返回 None"""
+    table = Message.__table__
+    try:
+        rows = db.session.execute(
+            table.select().where(table.c.timestamp >= since)
+            .order_by(table.c.timestamp, table.c.id).limit(limit + 1)).fetchall()
+    finally:
+        # 长连接不占用连接池中的数据库连接
+        db.session.close()
+    if len(rows) > limit:
+        return None
+    return [_event(row) for row in rows]
+
+
+def stream(subscriber, cursor=None):
+    """生成一个连接的 SSE 事件流，需要在请求上下文中迭代 (stream_with_context)
+
+    cursor 为 (timestamp, id)，来自 Last-Event-ID 或页面中最新一条留言，先从数据库补齐其后的留言，
+    之后只转发广播的新留言。其他 worker 进程写入的留言通过 'message' 版本戳发现：
+    空闲时每隔 WATCHLIST_LIVE_POLL_INTERVAL 秒检查一次，版本变化且不是本进程的写入时从最近发送的时间往前
+    WATCHLIST_LIVE_LOOKBACK 秒补查一次 (异步写入的留言提交时间晚于时间戳)。
+    已发送的 id 会被跳过；需要补齐的留言超过 WATCHLIST_LIVE_BACKLOG 条时让客户端刷新页面。
+    连接最长保持 WATCHLIST_LIVE_TIMEOUT 秒，之后由客户端自动重连，释放 worker 线程。
+    """
+    config = current_app.config
+    interval = config['WATCHLIST_LIVE_POLL_INTERVAL']
+    lookback = timedelta(seconds=config['WATCHLIST_LIVE_LOOKBACK'])
+    backlog = config['WATCHLIST_LIVE_BACKLOG']
+    deadline = time.monotonic() + config['WATCHLIST_LIVE_TIMEOUT']
+    sent = deque(maxlen=backlog * 2)
+    stamp = stamps.get('message')
+    last = datetime.utcnow()
+    since = None
+    if cursor is not None:
+        last, since = cursor[0], cursor[0]
+        sent.append(cursor[1])
+
+    try:
+        yield 'retry: %d\n\n' % (interval * 1000)
+        while True:
+            if since is not None:
+                events = _catch_up(since, backlog)
+                since = None
+                if events is None:
+                    yield 'event: reload\ndata: \n\n'
+                    return
+            else:
+                events = subscriber.get(max(0, min(interval, deadline - time.monotonic())))
+                if subscriber.overflowed:
+                    return
+                if not events:
+                    if time.monotonic() >= deadline:
+                        return
+                    current = stamps.get('message')
+                    if current != stamp:
+                        # 本进程写入的留言已经通过广播收到
+                        if not hub.own_change(stamp, current):
+                            hub.catch_ups += 1
+                            since = last - lookback
+                        stamp = current
+                    else:
+                        # 心跳，同时让服务器发现已断开的连接
+                        yield ':\n\n'
+                    continue
+
+            chunk = []
+            for id, timestamp, text in events:
+                if id in sent:
+                    continue
+                sent.append(id)
+                last = max(last, timestamp)
+                chunk.append(text)
+            if chunk:
+                yield ''.join(chunk)
+    finally:
+        hub.unsubscribe(subscriber)
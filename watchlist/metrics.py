@@ -0,0 +1,250 @@
+import hmac
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+from flask import current_app, g, request, abort, has_app_context, has_request_context
+from flask_login import current_user
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+logger = logging.getLogger(__name__)
+
+# 默认的耗时分桶 (秒)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# 每个请求执行的 SQL 语句条数分桶
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+                             for k, v in labels)
+
+
+class Histogram(object):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def expose(self):
+        lines = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    lines.append('%s_bucket%s %d' % (self.name, _format_labels(key + (('le', bound),)), cumulative))
+                lines.append('%s_bucket%s %d' % (self.name, _format_labels(key + (('le', '+Inf'),)), count))
+                lines.append('%s_sum%s %r' % (self.name, _format_labels(key), total))
+                lines.append('%s_count%s %d' % (self.name, _format_labels(key), count))
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+class Counter(object):
+
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def expose(self):
+        with self._lock:
+            return ['%s%s %r' % (self.name, _format_labels(key), value) for key, value in sorted(self._values.items())]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Gauge(object):
+    """导出时调用 func 取值，func 返回 {labels 元组: 值}"""
+
+    type = 'gauge'
+
+    def __init__(self, name, help, func):
+        self.name = name
+        self.help = help
+        self.func = func
+
+    def expose(self):
+        return ['%s%s %r' % (self.name, _format_labels(key), value) for key, value in sorted(self.func().items())]
+
+    def clear(self):
+        pass
+
+
+class TimedTemplate(Template):
+    """记录模板渲染耗时的 Template 类，嵌套的 extends/include 只计算最外层一次"""
+
+    def render(self, *args, **kwargs):
+        stats = g.get('_request_metrics') if has_request_context() else None
+        if stats is None:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        finally:
+            stats['template'] += time.perf_counter() - start
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+    if not has_app_context() or not current_app.config['WATCHLIST_METRICS']:
+        return
+
+    stats = g.get('_request_metrics') if has_request_context() else None
+    if stats is not None:
+        stats['queries'] += 1
+        stats['sql'] += elapsed
+    if elapsed >= current_app.config['WATCHLIST_SLOW_QUERY_THRESHOLD']:
+        metrics.slow_queries.inc()
+        logger.warning('Slow query (%.3fs): %s', elapsed, statement)
+
+
+def _cache_stats():
+    from watchlist.cache import user_cache, response_cache
+    values = {}
+    for name, cache in (('user', user_cache), ('response', response_cache)):
+        for stat, value in cache.stats().items():
+            values[(('cache', name), ('stat', stat))] = value
+    return values
+
+
+def _write_behind_stats():
+    from watchlist.writebehind import message_writer
+    return {(('stat', stat),): value for stat, value in message_writer.stats().items()}
+
+
+def _rate_limit_rejected():
+    from watchlist.ratelimit import limiter
+    if not has_app_context():
+        return {}
+    return {(('limit', name), ('scope', scope)): value
+            for (name, scope), value in limiter.stats()['rejected'].items()}
+
+
+def _rate_limit_buckets():
+    from watchlist.ratelimit import limiter
+    if not has_app_context():
+        return {}
+    return {(('limit', name),): value for name, value in limiter.stats()['buckets'].items()}
+
+
+def _live_stats():
+    from watchlist.live import hub
+    return {(('stat', stat),): value for stat, value in hub.stats().items()}
+
+
+class Metrics(object):
+    """按路由统计请求耗时、模板渲染耗时以及 SQL 语句条数和耗时
+
+    由 WATCHLIST_METRICS 开启，数据以 Prometheus 文本格式在 /metrics 导出，
+    访问需要 Authorization: Bearer <WATCHLIST_METRICS_TOKEN> 或登录。
+    """
+
+    def __init__(self):
+        self.request_duration = Histogram('watchlist_request_duration_seconds', 'Request latency.')
+        self.template_duration = Histogram('watchlist_template_render_seconds', 'Template render time per request.')
+        self.sql_queries = Histogram('watchlist_sql_queries', 'SQL statements per request.', COUNT_BUCKETS)
+        self.sql_duration = Histogram('watchlist_sql_duration_seconds', 'Total SQL time per request.')
+        self.requests = Counter('watchlist_requests_total', 'Requests by route and status.')
+        self.slow_queries = Counter('watchlist_slow_queries_total', 'Queries slower than the threshold.')
+        self.collectors = [self.request_duration, self.template_duration, self.sql_queries,
+                           self.sql_duration, self.requests, self.slow_queries,
+                           Gauge('watchlist_cache', 'Cache statistics.', _cache_stats),
+                           Gauge('watchlist_write_behind', 'Guestbook write-behind queue statistics.',
+                                 _write_behind_stats),
+                           Gauge('watchlist_rate_limit_rejected', 'Requests rejected by the rate limiter.',
+                                 _rate_limit_rejected),
+                           Gauge('watchlist_rate_limit_buckets', 'Token buckets held by the rate limiter.',
+                                 _rate_limit_buckets),
+                           Gauge('watchlist_live', 'Guestbook event stream statistics.', _live_stats)]
+
+    def init_app(self, app):
+        app.jinja_env.template_class = TimedTemplate
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.add_url_rule('/metrics', 'metrics', self.view)
+        if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    def _before_request(self):
+        if current_app.config['WATCHLIST_METRICS']:
+            g._request_metrics = {'start': time.perf_counter(), 'template': 0.0, 'queries': 0, 'sql': 0.0}
+
+    def _after_request(self, response):
+        stats = g.pop('_request_metrics', None)
+        if stats is not None:
+            route = request.endpoint or 'none'
+            self.request_duration.observe(time.perf_counter() - stats['start'], route=route)
+            self.template_duration.observe(stats['template'], route=route)
+            self.sql_queries.observe(stats['queries'], route=route)
+            self.sql_duration.observe(stats['sql'], route=route)
+            self.requests.inc(route=route, status=response.status_code)
+        return response
+
+    def expose(self):
+        lines = []
+        for collector in self.collectors:
+            lines.append('# HELP %s %s' % (collector.name, collector.help))
+            lines.append('# TYPE %s %s' % (collector.name, collector.type))
+            lines.extend(collector.expose())
+        return '\n'.join(lines) + '\n'
+
+    def view(self):
+        config = current_app.config
+        if not config['WATCHLIST_METRICS']:
+            abort(404)
+        token = config['WATCHLIST_METRICS_TOKEN']
+        authorization = request.headers.get('Authorization', '')
+        if not current_user.is_authenticated and not (
+                token and hmac.compare_digest(authorization, 'Bearer ' + token)):
+            abort(403)
+        return self.expose(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+    def clear(self):
+        for collector in self.collectors:
+            collector.clear()
+
+
+metrics = Metrics()
@@ -1,32 +1,62 @@
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 
 from watchlist import db
+from watchlist.passwords import hash_password, password_verifier
 
 
 # 创建数据库模型
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(20))
-    username = db.Column(db.String(20))
+    username = db.Column(db.String(20), unique=True, index=True)
     password_hash = db.Column(db.String(128))
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def validate_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        # 还没有设置密码的用户 (如 flask forge 生成的用户) 不能登录
+        if not self.password_hash:
+            return False
+        # 在有界线程池中校验，排队过多时抛出 PasswordQueueFull
+        return password_verifier.verify(self.password_hash, password)
 
 
 class Movie(db.Model):
+    # 所有查询都按用户过滤，复合索引让每个用户的列表、排序和年份筛选只扫描该用户的行
+    __table_args__ = (
+        db.Index('ix_movie_user_id_id', 'user_id', 'id'),
+        db.Index('ix_movie_user_id_title', 'user_id', 'title'),
+        db.Index('ix_movie_user_id_year', 'user_id', 'year'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(60))
     year = db.Column(db.String(4))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user = db.relationship('User')
 
 
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(20))
     body = db.Column(db.String(200))
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
\ No newline at end of file
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
+class ArchivedMessage(db.Model):
+    """flask archive-messages 从 message 表移出的旧留言，在 /guestbook/archive 按需浏览
+
+    使用自己的自增 id (按归档顺序即时间顺序分配)：message 表删除最新的行后 id 可能被复用。
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(20))
+    body = db.Column(db.String(200))
+    timestamp = db.Column(db.DateTime, index=True)
+
+
+class Stat(db.Model):
+    """反规范化的计数器，如电影和留言的总数，由触发器在写入的同一事务中维护 (见 watchlist/counters.py)"""
+    name = db.Column(db.String(20), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
@@ -0,0 +1,70 @@
+from datetime import datetime
+
+from flask import abort
+from flask_sqlalchemy import Pagination
+from sqlalchemy import tuple_
+
+
+# 游标格式：<时间戳>_<id>，如 20200801123000000000_42
+# (timestamp, id) 作为排序键，id 用于区分同一时刻的多条记录
+CURSOR_TIME_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def encode_cursor(timestamp, id):
+    """将 (timestamp, id) 编码为字符串游标"""
+    return '%s_%d' % (timestamp.strftime(CURSOR_TIME_FORMAT), id)
+
+
+def decode_cursor(cursor):
+    """解析字符串游标，格式错误时返回 None"""
+    try:
+        timestamp, id = cursor.split('_')
+        return datetime.strptime(timestamp, CURSOR_TIME_FORMAT), int(id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def keyset_before(query, model, cursor, limit):
+    """按 (timestamp, id) 倒序取出游标之前的 limit 条记录
+
+    message.id 是 INTEGER PRIMARY KEY (即 rowid)，SQLite 的 timestamp 索引
+    本身就按 (timestamp, rowid) 排序，所以行值比较和排序都能直接走该索引。
+    多取一条用于判断是否还有下一页，返回 (items, next_cursor)。
+    """
+    if cursor is not None:
+        query = query.filter(tuple_(model.timestamp, model.id) < cursor)
+
+    items = query.order_by(model.timestamp.desc(), model.id.desc()).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(items[-1].timestamp, items[-1].id)
+    return items, next_cursor
+
+
+def count_before(query, model, cursor):
+    """统计游标之前 (更早) 的记录数，只扫描 timestamp 索引"""
+    return query.filter(tuple_(model.timestamp, model.id) < cursor).order_by(None).count()
+
+
+def chunks(items, size=500):
+    """把列表按 size 分段：SQLite 对单条语句的参数个数有上限 (3.32 之前为 999)，IN 列表分段执行"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def paginate(query, page, per_page, max_per_page, total=None):
+    """与 query.paginate() 相同，但可以传入已知的总数 (如计数器的值)，省去 COUNT 查询"""
+    per_page = min(per_page, max_per_page)
+    if page < 1 or per_page < 1:
+        abort(404)
+    items = query.limit(per_page).offset((page - 1) * per_page).all()
+    if not items and page != 1:
+        abort(404)
+    if total is None:
+        if page == 1 and len(items) < per_page:
+            total = len(items)
+        else:
+            total = query.order_by(None).count()
+    return Pagination(query, page, per_page, total, items)
@@ -0,0 +1,118 @@
+import hashlib
+import hmac
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from werkzeug.local import LocalProxy
+from werkzeug.security import gen_salt, generate_password_hash, check_password_hash
+
+from watchlist import app_extension
+
+
+class PasswordQueueFull(Exception):
+    """等待校验的密码过多"""
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt.encode('utf-8'), n=n, r=r, p=p,
+                          maxmem=132 * n * r * p).hex()
+
+
+def _hash(password, method, params):
+    if method == 'scrypt':
+        n, r, p = params
+        salt = gen_salt(16)
+        return 'scrypt:%d:%d:%d$%s$%s' % (n, r, p, salt, _scrypt(password, salt, n, r, p))
+    return generate_password_hash(password, 'pbkdf2:sha256:%d' % params)
+
+
+def _check(pwhash, password):
+    if not pwhash:
+        return False
+    if pwhash.startswith('scrypt:'):
+        method, salt, hashval = pwhash.split('$', 2)
+        n, r, p = (int(x) for x in method.split(':')[1:])
+        return hmac.compare_digest(_scrypt(password, salt, n, r, p), hashval)
+    return check_password_hash(pwhash, password)
+
+
+def _current_method():
+    config = current_app.config
+    method = config['WATCHLIST_PASSWORD_HASH']
+    if method == 'scrypt':
+        return method, tuple(config['WATCHLIST_SCRYPT_PARAMS'])
+    return 'pbkdf2', config['WATCHLIST_PBKDF2_ITERATIONS']
+
+
+def hash_password(password):
+    """按当前配置生成密码哈希
+
+    pbkdf2 使用 werkzeug 的格式 pbkdf2:sha256:<迭代次数>$salt$hash，
+    scrypt 使用 scrypt:<n>:<r>:<p>$salt$hash (与新版 werkzeug 相同)。
+    """
+    return _hash(password, *_current_method())
+
+
+def needs_rehash(pwhash):
+    """哈希的算法或参数与当前配置不同"""
+    method, params = _current_method()
+    if method == 'scrypt':
+        prefix = 'scrypt:%d:%d:%d$' % params
+    else:
+        prefix = 'pbkdf2:sha256:%d$' % params
+    return not pwhash.startswith(prefix)
+
+
+class PasswordVerifier(object):
+    """在有界线程池中校验密码
+
+    PBKDF2 与 scrypt 在 hashlib 中计算时会释放 GIL，线程池限制同时进行的哈希计算个数，
+    登录请求集中到来时不会占满 CPU，同一 worker 中的页面渲染不受影响。
+    排队的请求超过 queue_size 时直接拒绝 (PasswordQueueFull)，由视图函数返回 503。
+    每个程序实例一个 (见 password_verifier)，按该实例的配置创建线程池。
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def start(self, max_workers, queue_size):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='password')
+                self._slots = threading.BoundedSemaphore(max_workers + queue_size)
+
+    def submit(self, fn, *args):
+        if self._executor is None:
+            config = current_app.config
+            self.start(config['WATCHLIST_PASSWORD_WORKERS'], config['WATCHLIST_PASSWORD_QUEUE_SIZE'])
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise PasswordQueueFull()
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def verify(self, pwhash, password):
+        """在线程池中校验密码并等待结果"""
+        return self.submit(_check, pwhash, password).result()
+
+    def hash(self, password):
+        """在线程池中按当前配置生成密码哈希并等待结果"""
+        return self.submit(_hash, password, *_current_method()).result()
+
+    def stop(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+
+password_verifier = LocalProxy(lambda: app_extension('watchlist_password_verifier', lambda app: PasswordVerifier()))
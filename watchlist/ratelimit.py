@@ -0,0 +1,119 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request
+from werkzeug.exceptions import TooManyRequests
+
+
+class BucketStore(object):
+    """令牌桶的存储：每个键一个桶，超出容量时淘汰最久未使用的桶，所有操作均为 O(1)"""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.evictions = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, now=None):
+        """从桶中取一个令牌，成功返回 0，否则返回需要等待的秒数
+
+        桶初始是满的 (burst 个令牌)，每秒补充 rate 个；淘汰后的桶重新视为满桶。
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                tokens = burst
+            else:
+                tokens, last = bucket
+                tokens = min(burst, tokens + (now - last) * rate)
+                self._buckets.move_to_end(key)
+
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+                self.evictions += 1
+            return wait
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class RateLimiter(object):
+    """按客户端 IP 与全局两级的令牌桶限流
+
+    WATCHLIST_RATE_LIMITS 为每个限流名称配置 ip / global 两项 (每秒补充的令牌数, 桶容量)，
+    先检查客户端 IP 的桶，单个客户端刷请求时不会耗尽全局的桶。超出限制时返回 429，
+    Retry-After 为下一个令牌可用的秒数。桶保存在程序实例中，每个名称各有一个有界存储。
+    """
+
+    def init_app(self, app):
+        app.extensions['watchlist_ratelimit'] = {'stores': {}, 'rejected': {}, 'lock': threading.Lock()}
+
+    def _state(self):
+        return current_app.extensions['watchlist_ratelimit']
+
+    def _store(self, state, name):
+        store = state['stores'].get(name)
+        if store is None:
+            with state['lock']:
+                store = state['stores'].setdefault(
+                    name, BucketStore(current_app.config['WATCHLIST_RATE_LIMIT_BUCKETS']))
+        return store
+
+    def check(self, name):
+        """检查并消耗令牌，超出限制时抛出 429 异常"""
+        config = current_app.config
+        limits = config['WATCHLIST_RATE_LIMITS'].get(name)
+        if not config['WATCHLIST_RATE_LIMIT'] or not limits:
+            return
+
+        state = self._state()
+        store = self._store(state, name)
+        for scope, key in (('ip', request.remote_addr), ('global', None)):
+            if scope not in limits:
+                continue
+            rate, burst = limits[scope]
+            wait = store.take((scope, key), rate, burst)
+            if wait:
+                with state['lock']:
+                    state['rejected'][(name, scope)] = state['rejected'].get((name, scope), 0) + 1
+                e = TooManyRequests()
+                e.retry_after = int(math.ceil(wait))
+                raise e
+
+    def limit(self, name, methods=('POST',)):
+        """视图函数装饰器，只对 methods 中的请求方法限流"""
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                if request.method in methods:
+                    self.check(name)
+                return f(*args, **kwargs)
+            return decorated_function
+        return decorator
+
+    def stats(self):
+        """{'rejected': {(名称, ip/global): 次数}, 'buckets': {名称: 桶数}, 'evictions': {名称: 淘汰次数}}"""
+        state = self._state()
+        with state['lock']:
+            return {
+                'rejected': dict(state['rejected']),
+                'buckets': {name: len(store) for name, store in state['stores'].items()},
+                'evictions': {name: store.evictions for name, store in state['stores'].items()},
+            }
+
+
+limiter = RateLimiter()
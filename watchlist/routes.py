@@ -1,70 +1,239 @@
-from flask import render_template, request, url_for, redirect, flash
+from flask import Blueprint, current_app, render_template, request, url_for, redirect, flash, abort, jsonify, \
+    stream_with_context
 from flask_login import login_user, login_required, logout_user, current_user
 
-from watchlist import app, db
-from watchlist.models import User, Movie, Message
+from watchlist import db
+from watchlist.models import User, Movie, Message, ArchivedMessage
+from watchlist.cache import stamps, movie_stamp, owner_cache, user_cache, response_cache, conditional
+from watchlist.writebehind import message_writer
+from watchlist.ratelimit import limiter
+from watchlist.passwords import PasswordQueueFull, needs_rehash, password_verifier
+from watchlist.pagination import decode_cursor, encode_cursor, keyset_before, count_before, paginate, chunks
+from watchlist import counters, live
+from watchlist.search import search_movies, search_messages
 
 
-@app.route('/', methods=['GET', 'POST'])
-def index():
+bp = Blueprint('main', __name__)
+
+# 主页翻页、排序链接保留的查询参数
+MOVIE_LIST_ARGS = ('sort', 'order', 'limit', 'year_from', 'year_to')
+
+# 主页允许的排序字段
+MOVIE_SORT_COLUMNS = {
+    'id': Movie.id,
+    'title': Movie.title,
+    'year': Movie.year,
+}
+
+
+def owner_movies(username=None):
+    """清单页面依赖的版本戳：所有者自己的电影，其他用户修改清单时页面缓存和 ETag 仍然有效"""
+    owner = owner_cache.for_request(username)
+    return movie_stamp(owner.id) if owner is not None else 'movie'
+
+
+def valid_movie(title, year):
+    """电影名不超过 60 个字符，年份不超过 4 个字符，都不能为空"""
+    return bool(title) and bool(year) and len(title) <= 60 and len(year) <= 4
+
+
+@bp.route('/', methods=['GET', 'POST'])
+@bp.route('/user/<username>')
+@conditional('movie', owner_movies, 'user')
+@response_cache.cached('movie', owner_movies, 'user', args=MOVIE_LIST_ARGS + ('page',))
+def index(username=None):
+    """清单页面：/user/<username> 为指定用户的清单，/ 为已登录用户自己的清单，匿名访问时为站点所有者的清单"""
     if request.method == 'POST':
         if not current_user.is_authenticated:
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
 
         # 获取表单数据
         title = request.form.get('title')
         year = request.form.get('year')
 
         # 验证表单数据
-        if not title or not year or len(title) > 60 or len(year) > 4:
+        if not valid_movie(title, year):
             flash('输入格式错误 -- 数据太短或是超长')
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
 
         # 将表单数据保存到数据库
-        movie = Movie(title=title, year=year)
+        movie = Movie(title=title, year=year, user_id=current_user.id)
         db.session.add(movie)
         db.session.commit()
+        stamps.bump(movie_stamp(current_user.id))
         flash('已创建一条清单')
-        return redirect(url_for('index'))
-
-    movies = Movie.query.all()
-    return render_template('index.html', movies=movies)
-
-
-@app.route('/movie/edit/<int:movie_id>', methods=['GET', 'POST'])
+        return redirect(url_for('main.index'))
+
+    # 分页、排序与年份筛选都在 SQL 中完成；不筛选时总数直接读取计数器，筛选时才需要 COUNT 查询
+    page = request.args.get('page', 1, type=int)
+    limit = request.args.get('limit', current_app.config['WATCHLIST_MOVIE_PER_PAGE'], type=int)
+    sort = request.args.get('sort', 'id')
+    order = request.args.get('order', 'asc')
+    year_from = request.args.get('year_from', '')
+    year_to = request.args.get('year_to', '')
+
+    if sort not in MOVIE_SORT_COLUMNS or order not in ('asc', 'desc') or limit < 1:
+        abort(400)
+    for year in (year_from, year_to):
+        if year and (not year.isdigit() or len(year) > 4):
+            abort(400)
+
+    owner = owner_cache.for_request(username)
+    if owner is None and username is not None:
+        abort(404)
+
+    # 每个查询都以 user_id 开头，走 (user_id, ...) 复合索引，耗时与用户总数无关；
+    # 还没有任何用户时 (如刚执行 flask initdb) 显示空清单
+    query = Movie.query.filter(Movie.user_id == owner.id if owner is not None else db.false())
+    # year 是 4 位数字的字符串，补齐位数后按字符串比较仍能使用索引
+    if year_from:
+        query = query.filter(Movie.year >= year_from.zfill(4))
+    if year_to:
+        query = query.filter(Movie.year <= year_to.zfill(4))
+
+    column = MOVIE_SORT_COLUMNS[sort]
+    if order == 'desc':
+        query = query.order_by(column.desc(), Movie.id.desc())
+    else:
+        query = query.order_by(column, Movie.id)
+
+    if owner is None:
+        total = 0
+    else:
+        total = None if year_from or year_to else counters.get('movie', owner.id)
+    pagination = paginate(query, page, limit, current_app.config['WATCHLIST_MOVIE_MAX_PER_PAGE'], total)
+    # 翻页、排序链接需要保留的查询参数；只保留已知参数，_scheme 等会被 url_for() 当作选项
+    args = {k: request.args[k] for k in MOVIE_LIST_ARGS if k in request.args}
+    if username is not None:
+        args['username'] = username
+    editable = owner is not None and current_user.is_authenticated and current_user.id == owner.id
+    return render_template('index.html', movies=pagination.items, pagination=pagination, args=args,
+                           sort=sort, order=order, year_from=year_from, year_to=year_to,
+                           user=owner, editable=editable)
+
+
+@bp.route('/movie/edit/<int:movie_id>', methods=['GET', 'POST'])
 @login_required
 def edit(movie_id):
-    movie = Movie.query.get_or_404(movie_id)
+    movie = Movie.query.filter_by(id=movie_id, user_id=current_user.id).first_or_404()
 
     if request.method == 'POST':
         title = request.form.get('title')
         year = request.form.get('year')
 
-        if not title or not year or len(title) > 60 or len(year) > 4:
+        if not valid_movie(title, year):
             flash('输入格式错误 -- 数据太短或是超长')
-            return redirect(url_for('edit', movie_id=movie_id))
+            return redirect(url_for('main.edit', movie_id=movie_id))
 
         movie.title = title
         movie.year = year
         db.session.commit()
+        stamps.bump(movie_stamp(current_user.id))
         flash('该条清单更新成功')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
     return render_template('edit.html', movie=movie)
 
 
-@app.route('/movie/delete/<int:movie_id>', methods=['POST'])
+@bp.route('/movie/delete/<int:movie_id>', methods=['POST'])
 @login_required
 def delete(movie_id):
-    movie = Movie.query.get_or_404(movie_id)
+    movie = Movie.query.filter_by(id=movie_id, user_id=current_user.id).first_or_404()
 
     db.session.delete(movie)
     db.session.commit()
+    stamps.bump(movie_stamp(current_user.id))
     flash('该条清单已删除')
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/movie/batch', methods=['POST'])
+@login_required
+def batch():
+    """批量修改、删除电影，所有改动在同一个事务中完成
+
+    JSON: {"update": [{"id": 1, "title": "...", "year": "..."}], "delete": [2, 3]}
+    表单: 多个 delete=<id>，以及 title-<id> / year-<id> 表示修改
+    先验证全部条目，有任何无效条目时不做任何改动并返回 400。其他用户的电影视为 not_found。
+    """
+    if request.is_json:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            abort(400)
+        updates = data.get('update') or []
+        deletes = data.get('delete') or []
+    else:
+        form = request.form
+        deletes = form.getlist('delete')
+        updates = [{'id': key[len('title-'):], 'title': form[key], 'year': form.get('year-' + key[len('title-'):])}
+                   for key in form if key.startswith('title-')]
+
+    # 验证全部条目
+    results = []
+    update_rows = {}
+    delete_ids = set()
+    for item in updates:
+        try:
+            movie_id = int(item['id'])
+            title, year = item.get('title'), item.get('year')
+        except (TypeError, KeyError, ValueError, AttributeError):
+            results.append({'id': None, 'action': 'update', 'status': 'invalid'})
+            continue
+        if not isinstance(title, str) or not isinstance(year, str) or not valid_movie(title, year) \
+                or movie_id in update_rows:
+            results.append({'id': movie_id, 'action': 'update', 'status': 'invalid'})
+            continue
+        update_rows[movie_id] = {'b_id': movie_id, 'title': title, 'year': year}
+    for value in deletes:
+        try:
+            movie_id = int(value)
+        except (TypeError, ValueError):
+            results.append({'id': None, 'action': 'delete', 'status': 'invalid'})
+            continue
+        if movie_id in update_rows or movie_id in delete_ids:
+            results.append({'id': movie_id, 'action': 'delete', 'status': 'invalid'})
+            continue
+        delete_ids.add(movie_id)
+
+    total = len(update_rows) + len(delete_ids)
+    if results or total > current_app.config['WATCHLIST_BATCH_MAX'] or not total:
+        if request.is_json:
+            return jsonify(results=results, updated=0, deleted=0), 400
+        flash('输入格式错误 -- 数据太短或是超长')
+        return redirect(url_for('main.index'))
+
+    # 只对当前用户存在的条目执行改动，其余报告为 not_found
+    ids = sorted(set(update_rows) | delete_ids)
+    existing = set()
+    for chunk in chunks(ids):
+        existing.update(id for id, in db.session.query(Movie.id).filter(Movie.user_id == current_user.id,
+                                                                        Movie.id.in_(chunk)))
+
+    rows = [row for movie_id, row in sorted(update_rows.items()) if movie_id in existing]
+    if rows:
+        table = Movie.__table__
+        db.session.execute(table.update().where(table.c.id == db.bindparam('b_id'))
+                           .where(table.c.user_id == current_user.id)
+                           .values(title=db.bindparam('title'), year=db.bindparam('year')), rows)
+    to_delete = sorted(delete_ids & existing)
+    for chunk in chunks(to_delete):
+        Movie.query.filter(Movie.user_id == current_user.id, Movie.id.in_(chunk)).delete(synchronize_session=False)
+    db.session.commit()
+    stamps.bump(movie_stamp(current_user.id))
+
+    for movie_id in sorted(update_rows):
+        results.append({'id': movie_id, 'action': 'update', 'status': 'ok' if movie_id in existing else 'not_found'})
+    for movie_id in sorted(delete_ids):
+        results.append({'id': movie_id, 'action': 'delete', 'status': 'ok' if movie_id in existing else 'not_found'})
+
+    if request.is_json:
+        return jsonify(results=results, updated=len(rows), deleted=len(to_delete))
+    flash('已更新 %d 条、删除 %d 条清单' % (len(rows), len(to_delete)))
+    return redirect(url_for('main.index'))
+
+
+@bp.route('/login', methods=['GET', 'POST'])
+@limiter.limit('login')
 def login():
     if request.method == 'POST':
         username = request.form['username']
@@ -72,29 +241,45 @@ def login():
 
         if not username or not password:
             flash('输入的数据不能为空')
-            return redirect(url_for('login'))
-
-        user = User.query.first()
-        if username == user.username and user.validate_password(password):
+            return redirect(url_for('main.login'))
+
+        # username 有唯一索引
+        user = User.query.filter_by(username=username).first()
+        try:
+            valid = user is not None and user.validate_password(password)
+        except PasswordQueueFull:
+            abort(503)
+        if valid:
+            # 旧算法或旧参数生成的哈希按当前配置重新生成，与校验共用线程池；
+            # 线程池已满时本次跳过，下次登录时再重新生成
+            if needs_rehash(user.password_hash):
+                try:
+                    user.password_hash = password_verifier.hash(password)
+                except PasswordQueueFull:
+                    pass
+                else:
+                    db.session.commit()
+                    owner_cache.invalidate()
             login_user(user)
             flash('登录成功')
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
 
         flash('验证失败，输入的用户名或密码错误')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
     return render_template('login.html')
 
 
-@app.route('/logout')
+@bp.route('/logout')
 @login_required
 def logout():
+    user_cache.invalidate(current_user.id)
     logout_user()
     flash('拜拜')
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
 
-@app.route('/settings', methods=['GET', 'POST'])
+@bp.route('/settings', methods=['GET', 'POST'])
 @login_required
 def settings():
     if request.method == 'POST':
@@ -102,17 +287,21 @@ def settings():
 
         if not name or len(name) > 20:
             flash('无效的输入')
-            return redirect(url_for('settings'))
+            return redirect(url_for('main.settings'))
 
         current_user.name = name
         db.session.commit()
+        owner_cache.invalidate()
         flash('用户名更改成功')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
     return render_template('settings.html')
 
 
-@app.route('/guestbook', methods=['get', 'post'])
+@bp.route('/guestbook', methods=['get', 'post'])
+@limiter.limit('guestbook')
+@conditional('message', 'user')
+@response_cache.cached('message', 'user', args=('before', 'start'))
 def guestbook():
     if request.method == 'POST':
         name = request.form['name']
@@ -120,14 +309,110 @@ def guestbook():
 
         if not name or not body or len(name) > 20 or len(body) > 200:
             flash('输入格式错误 -- 数据太短或是超长')
-            return redirect(url_for('guestbook'))
-
-        # 将表单数据保存到数据库
-        message = Message(name=name, body=body)
-        db.session.add(message)
-        db.session.commit()
+            return redirect(url_for('main.guestbook'))
+
+        # 异步写入模式下放入队列，由后台线程批量写入；队列已满时返回 503
+        if current_app.config['WATCHLIST_WRITE_BEHIND']:
+            if not message_writer.submit(name, body):
+                abort(503)
+        else:
+            # 将表单数据保存到数据库
+            message = Message(name=name, body=body)
+            db.session.add(message)
+            db.session.flush()
+            row = {'id': message.id, 'name': name, 'body': body, 'timestamp': message.timestamp}
+            db.session.commit()
+            live.hub.bump()
+            live.hub.publish([row])
         flash('您的消息已发送给全世界！')
-        return redirect(url_for('guestbook'))
-
-    messages = Message.query.order_by(Message.timestamp.desc()).all()
-    return render_template('guestbook.html', messages=messages)
\ No newline at end of file
+        return redirect(url_for('main.guestbook'))
+
+    # 游标分页：?before=<timestamp>_<id> 取该条留言之前的留言
+    cursor = None
+    before = request.args.get('before')
+    if before:
+        cursor = decode_cursor(before)
+        if cursor is None:
+            abort(400)
+
+    per_page = current_app.config['WATCHLIST_MESSAGE_PER_PAGE']
+    messages, next_cursor = keyset_before(Message.query, Message, cursor, per_page)
+    total = counters.get('message')
+
+    # start 为当前页第一条留言的编号 (最早的留言为 #1)，由 "加载更多" 链接传递，
+    # 缺失或不合理时才按游标统计一次
+    if cursor is None:
+        start = total
+    else:
+        start = request.args.get('start', type=int)
+        if start is None or not len(messages) <= start <= total:
+            start = count_before(Message.query, Message, cursor)
+
+    # 最后一页提示更早的留言已归档；'archive' 版本戳在第一次归档时创建，不需要查询数据库
+    archived = next_cursor is None and stamps.get('archive') != 0
+
+    # 第一页订阅新留言，从页面中最新的一条之后开始
+    live_updates = cursor is None and current_app.config['WATCHLIST_LIVE']
+    since = encode_cursor(messages[0].timestamp, messages[0].id) if live_updates and messages else None
+
+    return render_template('guestbook.html', messages=messages, total=total, start=start,
+                           before=before, next_cursor=next_cursor, live=live_updates, since=since,
+                           archived=archived)
+
+
+@bp.route('/guestbook/archive')
+@conditional('archive', 'user')
+@response_cache.cached('archive', 'user', args=('before',))
+def guestbook_archive():
+    """flask archive-messages 归档的旧留言，与留言板相同的游标分页，只有归档时才会变化"""
+    cursor = None
+    before = request.args.get('before')
+    if before:
+        cursor = decode_cursor(before)
+        if cursor is None:
+            abort(400)
+
+    per_page = current_app.config['WATCHLIST_MESSAGE_PER_PAGE']
+    messages, next_cursor = keyset_before(ArchivedMessage.query, ArchivedMessage, cursor, per_page)
+    return render_template('archive.html', messages=messages, before=before, next_cursor=next_cursor)
+
+
+@bp.route('/guestbook/events')
+def guestbook_events():
+    """新留言的 SSE 事件流，重连时根据 Last-Event-ID 补齐断开期间的留言"""
+    config = current_app.config
+    if not config['WATCHLIST_LIVE']:
+        abort(404)
+
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('since')
+    if cursor is not None:
+        cursor = decode_cursor(cursor)
+        if cursor is None:
+            abort(400)
+
+    subscriber = live.hub.subscribe(config['WATCHLIST_LIVE_MAX_CLIENTS'], config['WATCHLIST_LIVE_BUFFER'])
+    if subscriber is None:
+        abort(503)
+    response = current_app.response_class(stream_with_context(live.stream(subscriber, cursor)),
+                                          mimetype='text/event-stream')
+    # 生成器没有开始迭代就被关闭时也要释放名额
+    response.call_on_close(lambda: live.hub.unsubscribe(subscriber))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@bp.route('/search')
+def search():
+    """搜索留言以及 ?user=<username> (默认同清单页面) 的电影"""
+    q = request.args.get('q', '').strip()
+    username = request.args.get('user')
+    owner = owner_cache.for_request(username)
+    if owner is None:
+        abort(404)
+    movies = messages = []
+    if q:
+        limit = current_app.config['WATCHLIST_SEARCH_LIMIT']
+        movies = search_movies(q, owner.id, limit)
+        messages = search_messages(q, limit)
+    return render_template('search.html', q=q, movies=movies, messages=messages, user=owner, username=username)
@@ -0,0 +1,128 @@
+import logging
+
+from sqlalchemy import DDL, event, text
+
+from watchlist import db
+from watchlist.models import Movie, Message
+
+
+logger = logging.getLogger(__name__)
+
+# trigram 分词器按三个字符切分，不依赖空格分词，适用于中文标题
+# 少于三个字符的查询无法使用索引，退回到对原表的 LIKE 查询
+MIN_MATCH_LENGTH = 3
+
+# 外部内容 (external content) FTS5 表：只保存索引，内容从原表读取，由触发器保持同步
+FTS_TABLES = {
+    'movie': ('movie_fts', ['title']),
+    'message': ('message_fts', ['name', 'body']),
+}
+
+
+def _create_statements(table, fts_table, columns):
+    cols = ', '.join(columns)
+    new = ', '.join('new.%s' % c for c in columns)
+    old = ', '.join('old.%s' % c for c in columns)
+    statements = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({cols}, content='{table}', "
+        "content_rowid='id', tokenize='trigram')",
+        "CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+        "INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new}); END",
+        "CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+        "INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old}); END",
+        "CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE ON {table} BEGIN "
+        "INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old}); "
+        "INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new}); END",
+    ]
+    return [s.format(fts=fts_table, table=table, cols=cols, new=new, old=old) for s in statements]
+
+
+_fts5_available = None
+
+
+def fts5_available(connection):
+    """当前 SQLite 是否支持 FTS5 与 trigram 分词器 (SQLite 3.34+)，结果在进程内缓存"""
+    global _fts5_available
+    if connection.dialect.name != 'sqlite':
+        return False
+    if _fts5_available is None:
+        try:
+            connection.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x, tokenize='trigram')")
+            connection.execute('DROP TABLE temp.fts5_probe')
+            _fts5_available = True
+        except Exception:
+            logger.warning('SQLite FTS5 trigram tokenizer is not available, search falls back to LIKE.')
+            _fts5_available = False
+    return _fts5_available
+
+
+def _sqlite_with_fts5(ddl, target, bind, **kw):
+    return fts5_available(bind)
+
+
+for _table, (_fts_table, _columns) in FTS_TABLES.items():
+    _model_table = db.metadata.tables[_table]
+    for _statement in _create_statements(_table, _fts_table, _columns):
+        event.listen(_model_table, 'after_create', DDL(_statement).execute_if(callable_=_sqlite_with_fts5))
+    # 删除原表时触发器会一并删除，索引表需要单独删除
+    event.listen(_model_table, 'before_drop', DDL(
+        'DROP TABLE IF EXISTS %s' % _fts_table
+    ).execute_if(dialect='sqlite'))
+
+
+def reindex():
+    """创建缺失的索引表和触发器，并从原表批量重建索引，返回 {表名: 行数}"""
+    connection = db.session.connection()
+    if not fts5_available(connection):
+        raise RuntimeError('SQLite FTS5 with the trigram tokenizer is not available.')
+
+    counts = {}
+    for table, (fts_table, columns) in FTS_TABLES.items():
+        for statement in _create_statements(table, fts_table, columns):
+            db.session.execute(statement)
+        db.session.execute("INSERT INTO %s(%s) VALUES ('rebuild')" % (fts_table, fts_table))
+        counts[table] = db.session.execute('SELECT count(*) FROM %s' % table).scalar()
+    db.session.commit()
+    return counts
+
+
+def _match_phrase(q):
+    # 作为一个短语整体匹配，避免用户输入被解析成 FTS5 查询语法
+    return '"%s"' % q.replace('"', '""')
+
+
+def _like_pattern(q):
+    return '%' + q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def _use_fts(q):
+    return len(q) >= MIN_MATCH_LENGTH and fts5_available(db.session.connection())
+
+
+def _fts_join(query, model, fts_table, q):
+    """连接 FTS5 索引表并按相关度 (bm25) 排序"""
+    fts = db.table(fts_table, db.column('rowid'), db.column('rank'))
+    return query.join(fts, fts.c.rowid == model.id) \
+        .filter(text('%s MATCH :q' % fts_table)).params(q=_match_phrase(q)).order_by(fts.c.rank)
+
+
+def search_movies(q, user_id, limit=20):
+    """搜索某个用户的电影"""
+    query = Movie.query.with_entities(Movie.id, Movie.title, Movie.year).filter(Movie.user_id == user_id)
+    if _use_fts(q):
+        query = _fts_join(query, Movie, 'movie_fts', q)
+    else:
+        query = query.filter(Movie.title.like(_like_pattern(q), escape='\\')).order_by(Movie.id)
+    return [row._asdict() for row in query.limit(limit)]
+
+
+def search_messages(q, limit=20):
+    query = Message.query.with_entities(Message.id, Message.name, Message.body, Message.timestamp)
+    if _use_fts(q):
+        query = _fts_join(query, Message, 'message_fts', q)
+    else:
+        pattern = _like_pattern(q)
+        query = query.filter(db.or_(Message.name.like(pattern, escape='\\'),
+                                    Message.body.like(pattern, escape='\\'))) \
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+    return [row._asdict() for row in query.limit(limit)]
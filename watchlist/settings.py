@@ -0,0 +1,132 @@
+"""默认配置，由 create_app() 通过 app.config.from_object() 加载
+
+大部分配置项都可以通过同名环境变量覆盖，测试时直接向 create_app() 传入配置字典。
+"""
+import os
+import sys
+
+
+if sys.platform.startswith('win'):
+    # 如果是 Windows 系统，则使用三个斜线
+    prefix = 'sqlite:///'
+else:
+    # 否则使用四个斜线
+    prefix = 'sqlite:////'
+
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SQLALCHEMY_DATABASE_URI = prefix + os.path.join(basedir, os.getenv('DATABASE_FILE', 'data.db'))
+SQLALCHEMY_TRACK_MODIFICATIONS = False  # 关闭对模型修改的监控
+SECRET_KEY = os.getenv('SECRET_KEY', 'dev')
+
+# SQLite 性能配置：文件数据库使用连接池，每个新连接执行以下 PRAGMA
+WATCHLIST_SQLITE_TUNING = os.getenv('WATCHLIST_SQLITE_TUNING', '1') == '1'
+WATCHLIST_SQLITE_PRAGMAS = {
+    'auto_vacuum': 'INCREMENTAL',           # 只对新建的数据库生效，归档后可以截断空闲页
+    'journal_mode': 'WAL',                  # 写操作不再阻塞读操作
+    'synchronous': 'NORMAL',                # WAL 模式下只在检查点时 fsync
+    'busy_timeout': 5000,                   # 等待写锁的毫秒数
+    'cache_size': -16000,                   # 负数表示 KiB，即 16 MB 页缓存
+    'mmap_size': 128 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+WATCHLIST_SQLITE_POOL_SIZE = 5
+WATCHLIST_SQLITE_POOL_OVERFLOW = 10
+WATCHLIST_SQLITE_POOL_TIMEOUT = 30
+
+# 分页：每页条数
+WATCHLIST_MOVIE_PER_PAGE = int(os.getenv('WATCHLIST_MOVIE_PER_PAGE', 20))
+WATCHLIST_MOVIE_MAX_PER_PAGE = 100                # 主页 limit 参数的上限
+WATCHLIST_MESSAGE_PER_PAGE = int(os.getenv('WATCHLIST_MESSAGE_PER_PAGE', 20))
+WATCHLIST_BATCH_MAX = 1000                        # 批量修改、删除的最大条目数
+WATCHLIST_SEARCH_LIMIT = 20                       # 每类搜索结果的最大条数
+WATCHLIST_API_PER_PAGE = 100                      # JSON API 的默认 limit
+WATCHLIST_API_MAX_LIMIT = 1000                    # JSON API 的 limit 与 ids 个数上限
+
+# 留言保留策略：flask archive-messages 把超过天数、超出条数的旧留言移入归档表，0 表示不限制
+WATCHLIST_MESSAGE_MAX_AGE = int(os.getenv('WATCHLIST_MESSAGE_MAX_AGE', 0))
+WATCHLIST_MESSAGE_MAX_ROWS = int(os.getenv('WATCHLIST_MESSAGE_MAX_ROWS', 0))
+
+# 缓存：数据版本戳目录，多个 worker 进程共享
+WATCHLIST_STAMP_DIR = os.getenv('WATCHLIST_STAMP_DIR', os.path.join(basedir, '.stamps'))
+# 按用户名查找的清单所有者缓存的条目数
+WATCHLIST_OWNER_CACHE_SIZE = 1024
+# 已登录用户缓存的条目数与存活秒数
+WATCHLIST_USER_CACHE_SIZE = 128
+WATCHLIST_USER_CACHE_TTL = int(os.getenv('WATCHLIST_USER_CACHE_TTL', 300))
+# 匿名页面缓存后端：memory / file / null，两种后端最多缓存的页面数，file 后端的目录可放在 /dev/shm 下
+WATCHLIST_RESPONSE_CACHE = os.getenv('WATCHLIST_RESPONSE_CACHE', 'memory')
+WATCHLIST_RESPONSE_CACHE_SIZE = 256
+WATCHLIST_RESPONSE_CACHE_DIR = os.getenv('WATCHLIST_RESPONSE_CACHE_DIR', os.path.join(basedir, '.cache'))
+
+
+# 留言异步批量写入：队列容量、每批条数、最长等待秒数，以及一批留言最多尝试写入的次数
+WATCHLIST_WRITE_BEHIND = os.getenv('WATCHLIST_WRITE_BEHIND', '0') == '1'
+WATCHLIST_WRITE_BEHIND_QUEUE_SIZE = 1000
+WATCHLIST_WRITE_BEHIND_BATCH_SIZE = 100
+WATCHLIST_WRITE_BEHIND_INTERVAL = 0.5
+WATCHLIST_WRITE_BEHIND_MAX_ATTEMPTS = 5
+
+
+# 性能统计：是否开启、/metrics 的访问令牌以及慢查询日志的阈值 (秒)
+WATCHLIST_METRICS = os.getenv('WATCHLIST_METRICS', '0') == '1'
+WATCHLIST_METRICS_TOKEN = os.getenv('WATCHLIST_METRICS_TOKEN')
+WATCHLIST_SLOW_QUERY_THRESHOLD = float(os.getenv('WATCHLIST_SLOW_QUERY_THRESHOLD', 0.1))
+
+
+# 限流：是否开启、每个限流名称的 (每秒补充的令牌数, 桶容量)，以及每个名称最多保存的桶数
+WATCHLIST_RATE_LIMIT = os.getenv('WATCHLIST_RATE_LIMIT', '1') == '1'
+WATCHLIST_RATE_LIMITS = {
+    'guestbook': {'ip': (0.2, 5), 'global': (20, 100)},     # 每个 IP 每 5 秒一条，可突发 5 条
+    'login': {'ip': (0.1, 10), 'global': (5, 20)},          # 密码校验 (PBKDF2) 开销较大
+}
+WATCHLIST_RATE_LIMIT_BUCKETS = 10000
+# 程序前面的反向代理 (nginx、PythonAnywhere 等) 层数。为 0 时客户端 IP 为 TCP 连接的对端地址，
+# 在反向代理后面所有访客会共用代理的 IP 和同一个限流桶；设置后按 X-Forwarded-For 等请求头
+# 中由这些代理添加的最后几项确定客户端 IP 和协议。没有代理时不要设置，否则客户端可以伪造 IP
+WATCHLIST_TRUSTED_PROXIES = int(os.getenv('WATCHLIST_TRUSTED_PROXIES', 0))
+
+
+# 密码哈希：算法 pbkdf2 / scrypt 及其参数，旧参数生成的哈希在登录成功时重新生成
+WATCHLIST_PASSWORD_HASH = os.getenv('WATCHLIST_PASSWORD_HASH', 'pbkdf2')
+WATCHLIST_PBKDF2_ITERATIONS = int(os.getenv('WATCHLIST_PBKDF2_ITERATIONS', 150000))
+WATCHLIST_SCRYPT_PARAMS = (32768, 8, 1)                 # (n, r, p)
+# 校验密码的线程数，以及最多排队等待的校验个数 (超出时返回 503)
+WATCHLIST_PASSWORD_WORKERS = int(os.getenv('WATCHLIST_PASSWORD_WORKERS', 2))
+WATCHLIST_PASSWORD_QUEUE_SIZE = 16
+
+
+# 模板：Jinja 字节码缓存目录 (为空时不使用)，以及是否在启动时预先编译全部模板
+WATCHLIST_TEMPLATE_CACHE_DIR = os.getenv('WATCHLIST_TEMPLATE_CACHE_DIR')
+WATCHLIST_TEMPLATE_WARMUP = os.getenv('WATCHLIST_TEMPLATE_WARMUP', '0') == '1'
+
+
+# 留言的相对时间 ("3 分钟前")：server 由服务器生成，页面中一个脚本统一刷新；
+# moment 使用 Flask-Moment 在浏览器中生成 (每条留言一个定时器，需要加载 moment.js)
+WATCHLIST_RELATIVE_TIME = os.getenv('WATCHLIST_RELATIVE_TIME', 'server')
+
+
+# 静态文件：是否使用 flask build-assets 的构建结果 (带摘要的文件名)，以及构建目录
+WATCHLIST_ASSETS = os.getenv('WATCHLIST_ASSETS', '1') == '1'
+WATCHLIST_ASSETS_DIR = os.getenv('WATCHLIST_ASSETS_DIR', os.path.join(basedir, 'watchlist', 'static', 'dist'))
+
+
+# 留言实时推送 (SSE)：最大连接数、每个连接缓冲的事件数、重连时最多补齐的留言数，
+# 检查其他进程写入的间隔、补查时往前回溯的秒数 (应大于异步写入的间隔)，以及单个连接的最长时间。
+# 每个连接在 WSGI 服务器中会占用一个 worker 线程最多 WATCHLIST_LIVE_TIMEOUT 秒，所以默认关闭，
+# 只在 ASGI 入口 (asgi.py) 中默认开启
+WATCHLIST_LIVE = os.getenv('WATCHLIST_LIVE', '0') == '1'
+WATCHLIST_LIVE_MAX_CLIENTS = int(os.getenv('WATCHLIST_LIVE_MAX_CLIENTS', 100))
+WATCHLIST_LIVE_BUFFER = 50
+WATCHLIST_LIVE_BACKLOG = 100
+WATCHLIST_LIVE_POLL_INTERVAL = 5
+WATCHLIST_LIVE_LOOKBACK = 5
+WATCHLIST_LIVE_TIMEOUT = 300
+
+
+# ASGI 入口 (asgi.py)：处理请求的线程数 (不超过 SQLite 连接池大小)、等待线程的请求上限，
+# 读取流式响应 (SSE 等长连接) 的线程数，以及读入内存的请求体上限 (字节，设置了 MAX_CONTENT_LENGTH 时以它为准)
+WATCHLIST_ASGI_WORKERS = int(os.getenv('WATCHLIST_ASGI_WORKERS', 8))
+WATCHLIST_ASGI_MAX_PENDING = int(os.getenv('WATCHLIST_ASGI_MAX_PENDING', 256))
+WATCHLIST_ASGI_STREAM_WORKERS = int(os.getenv('WATCHLIST_ASGI_STREAM_WORKERS', 128))
+WATCHLIST_ASGI_MAX_BODY = int(os.getenv('WATCHLIST_ASGI_MAX_BODY', 1024 * 1024))
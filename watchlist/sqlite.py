@@ -0,0 +1,84 @@
+import logging
+from functools import partial
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool, StaticPool
+
+
+logger = logging.getLogger(__name__)
+
+# PRAGMA 查询时返回的是整数，比较前先转换
+PRAGMA_ENUMS = {
+    'auto_vacuum': {'NONE': 0, 'FULL': 1, 'INCREMENTAL': 2},
+    'synchronous': {'OFF': 0, 'NORMAL': 1, 'FULL': 2, 'EXTRA': 3},
+    'temp_store': {'DEFAULT': 0, 'FILE': 1, 'MEMORY': 2},
+}
+
+# 只在创建数据库时生效的 PRAGMA，已有的数据库需要 VACUUM 才会改变，检查配置时不比较
+CREATE_ONLY_PRAGMAS = ('auto_vacuum',)
+
+
+def _normalize(name, value):
+    if isinstance(value, str):
+        value = PRAGMA_ENUMS.get(name, {}).get(value.upper(), value.lower())
+    return value
+
+
+def set_pragmas(pragmas, dbapi_connection, connection_record):
+    """engine 的 connect 事件钩子，每个新建的连接执行一次"""
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+        if name == 'journal_mode':
+            # journal_mode 返回实际生效的模式，内存数据库始终为 memory
+            mode = cursor.fetchone()[0]
+            if mode not in (str(value).lower(), 'memory'):
+                logger.warning('SQLite journal_mode is %s, expected %s.', mode, value)
+    cursor.close()
+
+
+def check_pragmas(connection, pragmas):
+    """读取连接上实际生效的 PRAGMA，返回 [(name, expected, actual, ok), ...]，不包括 CREATE_ONLY_PRAGMAS"""
+    results = []
+    for name, value in pragmas.items():
+        if name in CREATE_ONLY_PRAGMAS:
+            continue
+        actual = connection.execute('PRAGMA %s' % name).scalar()
+        expected = _normalize(name, value)
+        ok = _normalize(name, actual) == expected or (name == 'journal_mode' and actual == 'memory')
+        results.append((name, value, actual, ok))
+    return results
+
+
+class TunedSQLAlchemy(SQLAlchemy):
+    """为 SQLite 应用性能配置的 SQLAlchemy 扩展
+
+    - 文件数据库使用 QueuePool 复用连接，避免每次请求重新打开文件和执行 PRAGMA
+    - 每个新连接执行 WATCHLIST_SQLITE_PRAGMAS 中的 PRAGMA (WAL、synchronous 等)
+    """
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super(TunedSQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+        # 内存数据库已被设置为 StaticPool，只能使用同一个连接
+        if sa_url.drivername != 'sqlite' or options.get('poolclass') is StaticPool \
+                or not app.config['WATCHLIST_SQLITE_TUNING']:
+            return
+
+        options['poolclass'] = QueuePool
+        options['pool_size'] = app.config['WATCHLIST_SQLITE_POOL_SIZE']
+        options['max_overflow'] = app.config['WATCHLIST_SQLITE_POOL_OVERFLOW']
+        options['pool_timeout'] = app.config['WATCHLIST_SQLITE_POOL_TIMEOUT']
+        connect_args = options.setdefault('connect_args', {})
+        # 连接由线程池中的多个线程轮流使用
+        connect_args['check_same_thread'] = False
+        # 写锁被占用时等待而不是立即报 "database is locked"
+        connect_args['timeout'] = app.config['WATCHLIST_SQLITE_PRAGMAS'].get('busy_timeout', 5000) / 1000.0
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super(TunedSQLAlchemy, self).create_engine(sa_url, engine_opts)
+        config = self.get_app().config
+        if engine.dialect.name == 'sqlite' and config['WATCHLIST_SQLITE_TUNING']:
+            pragmas = config['WATCHLIST_SQLITE_PRAGMAS']
+            event.listen(engine, 'connect', partial(set_pragmas, pragmas))
+        return engine
@@ -0,0 +1,79 @@
+// 留言实时更新：订阅 /guestbook/events，把新留言插入到列表顶部
+(function () {
+    var list = document.querySelector('.message-list');
+    if (!list || !list.getAttribute('data-events') || !window.EventSource) {
+        return;
+    }
+    var total = document.getElementById('message-total').firstChild;
+    // 最近收到的事件 id，手动重连时从这里继续
+    var since = list.getAttribute('data-since');
+
+    function element(tag, className, text) {
+        var node = document.createElement(tag);
+        if (className) {
+            node.className = className;
+        }
+        if (text !== undefined) {
+            node.textContent = text;
+        }
+        return node;
+    }
+
+    function render(message, number) {
+        var time = element('time', 'relative-time');
+        time.setAttribute('datetime', message.timestamp);
+        var right = element('span', 'float-right');
+        right.appendChild(time);
+        var title = element('div', 'message-title');
+        title.appendChild(element('strong', null, message.name));
+        title.appendChild(document.createTextNode(' '));
+        title.appendChild(element('span', 'item-num', '#' + number));
+        title.appendChild(right);
+        var content = element('div', 'message-content');
+        content.appendChild(element('span', null, message.body));
+        var item = element('li', 'message-list-item');
+        item.id = 'message-' + message.id;
+        item.appendChild(title);
+        item.appendChild(content);
+        list.insertBefore(item, list.firstChild);
+
+        // 之后由 relative-time.js 的定时器统一刷新；使用 Flask-Moment 时退回到 moment
+        if (window.relativeTime) {
+            relativeTime.refresh(item);
+        } else {
+            var update = function () {
+                time.textContent = moment(message.timestamp).fromNow();
+            };
+            update();
+            setInterval(update, 60000);
+        }
+    }
+
+    function connect() {
+        var url = list.getAttribute('data-events');
+        var source = new EventSource(since ? url + '?since=' + encodeURIComponent(since) : url);
+        source.onmessage = function (event) {
+            var message = JSON.parse(event.data);
+            since = event.lastEventId;
+            if (document.getElementById('message-' + message.id)) {
+                return;
+            }
+            var count = parseInt(total.nodeValue.trim(), 10) + 1;
+            total.nodeValue = total.nodeValue.replace(/\d+/, count);
+            render(message, count);
+        };
+        // 断开期间的留言太多，直接刷新页面
+        source.addEventListener('reload', function () {
+            source.close();
+            location.reload();
+        });
+        // 服务器拒绝连接 (如连接数已满) 时 EventSource 不会自动重连
+        source.onerror = function () {
+            if (source.readyState === EventSource.CLOSED) {
+                setTimeout(connect, 30000);
+            }
+        };
+    }
+
+    connect();
+})();
@@ -0,0 +1,61 @@
+// 相对时间：刷新页面中所有 <time class="relative-time" datetime="..."> 的文字
+// 整个页面只有一个定时器，文字与服务器的 watchlist/timeago.py (以及 moment.js zh-cn) 一致
+(function () {
+    var units = {
+        s: '几秒', m: '1 分钟', mm: '%d 分钟', h: '1 小时', hh: '%d 小时', d: '1 天', dd: '%d 天',
+        M: '1 个月', MM: '%d 个月', y: '1 年', yy: '%d 年'
+    };
+
+    function bucket(seconds) {
+        seconds = Math.abs(seconds);
+        var minutes = Math.round(seconds / 60);
+        var hours = Math.round(seconds / 3600);
+        var days = Math.round(seconds / 86400);
+        var months = Math.round(seconds / 86400 * 4800 / 146097);
+        var years = Math.round(seconds / 86400 * 400 / 146097);
+        if (Math.round(seconds) < 45) { return ['s', 0]; }
+        if (minutes <= 1) { return ['m', 1]; }
+        if (minutes < 45) { return ['mm', minutes]; }
+        if (hours <= 1) { return ['h', 1]; }
+        if (hours < 22) { return ['hh', hours]; }
+        if (days <= 1) { return ['d', 1]; }
+        if (days < 26) { return ['dd', days]; }
+        if (months <= 1) { return ['M', 1]; }
+        if (months < 11) { return ['MM', months]; }
+        if (years <= 1) { return ['y', 1]; }
+        return ['yy', years];
+    }
+
+    function format(datetime, now) {
+        var seconds = ((now || Date.now()) - Date.parse(datetime)) / 1000;
+        var b = bucket(seconds);
+        return units[b[0]].replace('%d', b[1]) + (seconds < 0 ? '内' : '前');
+    }
+
+    function refresh(root) {
+        var nodes = (root || document).querySelectorAll('time.relative-time');
+        var now = Date.now();
+        for (var i = 0; i < nodes.length; i++) {
+            var text = format(nodes[i].getAttribute('datetime'), now);
+            // 只有文字变化时才修改 DOM
+            if (nodes[i].textContent !== text) {
+                nodes[i].textContent = text;
+            }
+        }
+    }
+
+    // 页面可能来自缓存，先按当前时间刷新一次；页面不可见时不刷新，重新可见时立即刷新
+    refresh();
+    setInterval(function () {
+        if (!document.hidden) {
+            refresh();
+        }
+    }, 60000);
+    document.addEventListener('visibilitychange', function () {
+        if (!document.hidden) {
+            refresh();
+        }
+    });
+
+    window.relativeTime = {format: format, refresh: refresh};
+})();
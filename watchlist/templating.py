@@ -0,0 +1,26 @@
+import os
+
+from jinja2 import FileSystemBytecodeCache
+
+
+def warm_up(env):
+    """加载 (编译) 全部模板，返回模板名列表"""
+    names = env.list_templates(extensions=['html'])
+    for name in names:
+        env.get_template(name)
+    return names
+
+
+def init_app(app):
+    """配置 Jinja 字节码缓存，并在创建程序实例时预先编译全部模板
+
+    WATCHLIST_TEMPLATE_CACHE_DIR 非空时，编译结果保存在该目录，新启动的 worker 直接读取，
+    不再解析模板；WATCHLIST_TEMPLATE_WARMUP 开启时，启动时就加载全部模板，
+    第一个请求不需要再承担编译的开销。
+    """
+    cache_dir = app.config['WATCHLIST_TEMPLATE_CACHE_DIR']
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    if app.config['WATCHLIST_TEMPLATE_WARMUP']:
+        warm_up(app.jinja_env)
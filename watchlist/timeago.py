@@ -0,0 +1,81 @@
+from datetime import datetime
+from functools import lru_cache
+
+from markupsafe import Markup
+
+
+# moment.js zh-cn 的相对时间文字，阈值与 moment 的默认值相同 (ss 44, s 45, m 45, h 22, d 26, M 11)，
+# 服务器生成的文字与 static/relative-time.js 相同，也与 Flask-Moment 的 fromNow() 一致
+# (月份按平均长度计算，moment 按日历月份计算，几个月前的留言在边界附近可能相差一个月)
+_UNITS = {
+    's': '几秒', 'm': '1 分钟', 'mm': '%d 分钟', 'h': '1 小时', 'hh': '%d 小时', 'd': '1 天', 'dd': '%d 天',
+    'M': '1 个月', 'MM': '%d 个月', 'y': '1 年', 'yy': '%d 年',
+}
+
+
+def _round(value):
+    # 与 JavaScript 的 Math.round 相同，而不是银行家舍入
+    return int(value + 0.5)
+
+
+def bucket(seconds):
+    """把时间差 (秒，不区分前后) 归入 (单位, 数量)，相同单位与数量的文字相同"""
+    seconds = abs(seconds)
+    minutes = _round(seconds / 60)
+    hours = _round(seconds / 3600)
+    days = _round(seconds / 86400)
+    months = _round(seconds / 86400 * 4800 / 146097)
+    years = _round(seconds / 86400 * 400 / 146097)
+    if _round(seconds) < 45:
+        return 's', 0
+    if minutes <= 1:
+        return 'm', 1
+    if minutes < 45:
+        return 'mm', minutes
+    if hours <= 1:
+        return 'h', 1
+    if hours < 22:
+        return 'hh', hours
+    if days <= 1:
+        return 'd', 1
+    if days < 26:
+        return 'dd', days
+    if months <= 1:
+        return 'M', 1
+    if months < 11:
+        return 'MM', months
+    if years <= 1:
+        return 'y', 1
+    return 'yy', years
+
+
+@lru_cache(maxsize=512)
+def _text(unit, count, future):
+    text = _UNITS[unit]
+    if '%d' in text:
+        text = text % count
+    return text + ('内' if future else '前')
+
+
+def from_now(timestamp, now=None):
+    """timestamp (UTC，不带时区) 相对于现在的描述，如 "3 分钟前"
+
+    一个页面中的几十条留言只会落在少数几个区间里，文字按区间缓存，只生成一次。
+    """
+    delta = ((now or datetime.utcnow()) - timestamp).total_seconds()
+    unit, count = bucket(delta)
+    return _text(unit, count, delta < 0)
+
+
+def relative_time(timestamp):
+    """模板函数：生成 <time> 元素，服务器算好初始文字，页面中的 relative-time.js 统一刷新
+
+    页面可能来自缓存 (响应缓存、304)，脚本加载后会立即按 datetime 重新计算一次。
+    """
+    return Markup('<time class="relative-time" datetime="%s">%s</time>') % (
+        timestamp.strftime('%Y-%m-%dT%H:%M:%SZ'), from_now(timestamp))
+
+
+def init_app(app):
+    app.add_template_global(relative_time)
+    app.add_template_filter(from_now, 'from_now')
@@ -0,0 +1,206 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+
+from werkzeug.local import LocalProxy
+
+from watchlist import app_extension
+
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter(object):
+    """留言的异步批量写入 (write-behind)
+
+    通过验证的留言先放入有界队列，后台线程在队列达到 WATCHLIST_WRITE_BEHIND_BATCH_SIZE
+    或每隔 WATCHLIST_WRITE_BEHIND_INTERVAL 秒时，把队列中的留言合并到一个事务中写入，
+    突发的留言只需一次提交 (一次 fsync、一次写锁)。队列满时 submit() 返回 False，
+    由视图函数返回 503。进程退出时会写入剩余的留言。
+
+    写入失败 (如暂时的 database is locked) 时这一批留言保留在队首，按指数退避重试，
+    连续失败 WATCHLIST_WRITE_BEHIND_MAX_ATTEMPTS 次后才丢弃，丢弃的条数计入 dropped。
+
+    每个程序实例一个 (见 message_writer)，留言总是写入提交它的程序实例的数据库。
+    """
+
+    def __init__(self, app):
+        self._queue = None
+        self._thread = None
+        self._app = app
+        self._start_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self.batch_size = app.config['WATCHLIST_WRITE_BEHIND_BATCH_SIZE']
+        self.interval = app.config['WATCHLIST_WRITE_BEHIND_INTERVAL']
+        self.max_attempts = app.config['WATCHLIST_WRITE_BEHIND_MAX_ATTEMPTS']
+        # 写入失败、等待重试的一批留言，已失败的次数，以及下次重试的时间 (time.monotonic())
+        self._retry = []
+        self._attempts = 0
+        self._retry_at = 0.0
+        # 统计数据
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.rejected = 0
+        self.retries = 0
+        self.dropped = 0
+        self.flush_seconds = 0.0
+        self.last_flush_seconds = 0.0
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            config = self._app.config
+            self._queue = queue.Queue(config['WATCHLIST_WRITE_BEHIND_QUEUE_SIZE'])
+            self.batch_size = config['WATCHLIST_WRITE_BEHIND_BATCH_SIZE']
+            self.interval = config['WATCHLIST_WRITE_BEHIND_INTERVAL']
+            self.max_attempts = config['WATCHLIST_WRITE_BEHIND_MAX_ATTEMPTS']
+            self._retry = []
+            self._attempts = 0
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+            self._thread.start()
+            _running.add(self)
+
+    def submit(self, name, body):
+        """加入写入队列，队列已满时返回 False"""
+        if self._thread is None:
+            self.start()
+        try:
+            self._queue.put_nowait({'name': name, 'body': body, 'timestamp': datetime.utcnow()})
+        except queue.Full:
+            self.rejected += 1
+            return False
+        if self._queue.qsize() >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            with self._app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception('Failed to write queued guestbook messages.')
+
+    def flush(self, force=False):
+        """把队列中的留言按批写入数据库，返回写入的条数；需要在应用上下文中调用
+
+        有等待重试的一批留言时先写入它，未到重试时间且 force 为 False 时不写入。
+        写入失败时抛出异常。
+        """
+        from watchlist import db
+        from watchlist.live import hub
+        from watchlist.models import Message
+
+        if self._queue is None:
+            return 0
+
+        written = 0
+        with self._flush_lock:
+            if self._retry and not force and time.monotonic() < self._retry_at:
+                return 0
+            while True:
+                batch, self._retry = self._retry, []
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if not batch:
+                    break
+
+                start = time.perf_counter()
+                try:
+                    db.session.execute(Message.__table__.insert(), batch)
+                    if hub.clients:
+                        # 同一事务持有写锁，这一批的 rowid 是连续的
+                        last = db.session.execute('SELECT max(id) FROM message').scalar()
+                        for i, row in enumerate(batch):
+                            row['id'] = last - len(batch) + 1 + i
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    for row in batch:
+                        row.pop('id', None)
+                    self._failed(batch)
+                    raise
+                self._attempts = 0
+                self.last_flush_seconds = time.perf_counter() - start
+                self.flush_seconds += self.last_flush_seconds
+                self.flushes += 1
+                self.flushed_rows += len(batch)
+                written += len(batch)
+                if 'id' in batch[0]:
+                    hub.publish(batch)
+
+        if written:
+            hub.bump()
+        return written
+
+    def _failed(self, batch):
+        """写入失败：放回队首并推迟重试，达到最大次数后丢弃"""
+        self._attempts += 1
+        if self._attempts >= self.max_attempts:
+            self.dropped += len(batch)
+            self._attempts = 0
+            logger.error('Dropped %d guestbook messages after %d attempts.', len(batch), self.max_attempts)
+            return
+        self.retries += 1
+        self._retry = batch
+        # 退避时间从一个写入间隔开始逐次加倍，最长 30 秒
+        self._retry_at = time.monotonic() + min(30.0, self.interval * 2 ** (self._attempts - 1))
+        logger.warning('Failed to write %d guestbook messages, retry %d of %d.',
+                       len(batch), self._attempts, self.max_attempts - 1)
+
+    def stop(self):
+        """停止后台线程并写入剩余的留言"""
+        with self._start_lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            self._stopping.set()
+            self._wakeup.set()
+            thread.join()
+            _running.discard(self)
+            # 退出前不再等待退避时间，立即重试剩余的留言
+            with self._app.app_context():
+                for _ in range(self.max_attempts):
+                    try:
+                        self.flush(force=True)
+                        break
+                    except Exception:
+                        logger.exception('Failed to write queued guestbook messages.')
+            self._queue = None
+
+    def stats(self):
+        return {
+            'queue_length': (self._queue.qsize() if self._queue is not None else 0) + len(self._retry),
+            'flushes': self.flushes,
+            'flushed_rows': self.flushed_rows,
+            'rejected': self.rejected,
+            'retries': self.retries,
+            'dropped': self.dropped,
+            'last_flush_seconds': self.last_flush_seconds,
+            'avg_flush_seconds': self.flush_seconds / self.flushes if self.flushes else 0.0,
+        }
+
+
+# 已启动后台线程的 MessageWriter，进程退出时写入它们剩余的留言
+_running = set()
+
+
+def _stop_all():
+    for writer in list(_running):
+        writer.stop()
+
+
+message_writer = LocalProxy(lambda: app_extension('watchlist_write_behind', MessageWriter))
+atexit.register(_stop_all)
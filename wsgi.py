@@ -6,4 +6,9 @@ dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 if os.path.exists(dotenv_path):
     load_dotenv(dotenv_path)
 
-from watchlist import app
+# 部署时在启动 worker 之前预先编译全部模板
+os.environ.setdefault('WATCHLIST_TEMPLATE_WARMUP', '1')
+
+from watchlist import create_app
+
+app = create_app()